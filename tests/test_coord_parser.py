@@ -0,0 +1,46 @@
+import random
+
+import numpy as np
+
+from wikiparse import synthetic
+from wikiparse.coord_parser import parse_coord_string, parse_coord_strings
+from wikiparse.indexer import Dump
+
+def per_string(coord_string):
+    "(lat, lon), (0, 0) when unreadable, and the keywords, with the Dump methods"
+    try:
+        position = tuple(Dump.convert_to_decimal(None, Dump.extract_lat_lon(None, coord_string)))
+    except Exception:
+        position = (0, 0)
+    return position, Dump.get_keywords(None, coord_string)
+
+def coord_strings(n, seed=0):
+    rng = random.Random(seed)
+    strings = [synthetic.coord_template(rng)[2:-2] for _ in range(n)]
+    tokens = ['1', '-2.5', ' 3 ', '45.', '.5', '1,5', 'N', 's', 'E', 'w', 'ne', '', 'x', 'Coord',
+              'LAT', 'display=title', 'region:GB_type:city', 'a=b=c', ' name = X ']
+    for _ in range(n):
+        parts = [rng.choice(tokens) for _ in range(rng.randint(0, 10))]
+        strings.append('|'.join(['Coord'] + parts))
+    return strings
+
+def test_matches_per_string_methods():
+    for coord_string in coord_strings(2000):
+        position, kws = parse_coord_string(coord_string)
+        assert (position or (0, 0), kws) == per_string(coord_string), coord_string
+
+def test_parse_coord_strings():
+    strings = ['Coord|51|30|N|0|7|W|display=title', 'Coord|1.5|-2.5|name=X', 'Coord|north|east', 'Coord|1|2|3']
+    lat, lon, valid, columns = parse_coord_strings(strings, ['display', 'name'])
+    assert np.allclose(lat, [51.5, 1.5, 0, 0]) and np.allclose(lon, [-7/60, -2.5, 0, 0])
+    assert valid.tolist() == [True, True, False, False]
+    assert columns == {'display': ['title', None, None, None], 'name': [None, 'X', None, None]}
+
+def test_batch_matches_per_string_methods():
+    strings = coord_strings(2000, seed=1)
+    lat, lon, valid, columns = parse_coord_strings(strings)
+    for i, coord_string in enumerate(strings):
+        position, kws = per_string(coord_string)
+        assert (lat[i], lon[i]) == position, coord_string
+        assert {kw: column[i] for kw, column in columns.items() if column[i] is not None} == \
+            {kw: value for kw, value in kws.items() if kw in columns}, coord_string
@@ -0,0 +1,31 @@
+import sqlite3
+
+import pytest
+
+from wikiparse.extraction import TemplateExtractor, TemplateSchema
+
+def test_identifiers_are_quoted():
+    schema = TemplateSchema('Infobox settlement', {'order': 'INTEGER', 'group': 'TEXT', 'say "hi"': 'TEXT', '1': 'TEXT'},
+                            table='select "from"')
+    db = sqlite3.connect(':memory:')
+    TemplateExtractor([schema]).create_tables(db)
+    text = '{{Infobox settlement|first|order=12,345 (2011)|group=a|say "hi"=b}}'
+    for table, row in TemplateExtractor([schema]).extract(text):
+        db.execute(schema.insert_sql(), (7,) + row)
+    assert db.execute('SELECT * FROM "select ""from"""').fetchall() == [
+        (7, 0, 'Infobox settlement|first|order=12,345 (2011)|group=a|say "hi"=b', 12345, 'a', 'b', 'first')]
+    # replacing the table drops it by its quoted name
+    TemplateExtractor([schema]).create_tables(db)
+    assert db.execute('SELECT Count(*) FROM "select ""from"""').fetchone() == (0,)
+
+@pytest.mark.parametrize('columns', [
+    ['name', 'Name '],
+    ['population total', 'population-total'],
+    ['1', 'param_1'],
+    ['Page num'],
+    ['wikitext'],
+    ['!!!'],
+])
+def test_colliding_columns_are_rejected(columns):
+    with pytest.raises(ValueError):
+        TemplateSchema('Infobox settlement', columns)
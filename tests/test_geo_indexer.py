@@ -0,0 +1,129 @@
+import pytest
+
+from wikiparse import geo_indexer, synthetic
+from wikiparse.checkpoint import Checkpoint
+from wikiparse.extraction import TemplateSchema
+from wikiparse.geo_indexer import Indexer
+from wikiparse.tokenize import create_doc_freq, update_doc_freq
+
+TABLES = ['indices', 'coords', 'revisions', 'tpl_infobox_settlement']
+SCHEMAS = [TemplateSchema('Infobox settlement', {'name': 'TEXT', 'population_total': 'INTEGER'})]
+
+def rows(indexer):
+    return {table: sorted(indexer.db.execute(f'SELECT * FROM {table}').fetchall(), key=repr)
+            for table in TABLES}
+
+def test_fresh_load_replaces_earlier_rows(tmp_path):
+    xml = tmp_path / 'dump.xml'
+    synthetic.write_dump(xml, 300, seed=1)
+    indexer = Indexer(str(xml), str(tmp_path / 'reloaded'))
+    indexer.load(templates=SCHEMAS)
+    # rows an earlier load, with different numbering or text, left behind
+    for table in TABLES:
+        indexer.db.execute(f'UPDATE {table} SET page_num = page_num + 100000')
+    indexer.db.execute("UPDATE indices SET title = 'stale'")
+    indexer.db.commit()
+    indexer.load()
+
+    fresh = Indexer(str(xml), str(tmp_path / 'fresh'))
+    fresh.load(templates=SCHEMAS)
+    expected = rows(fresh)
+    assert all(expected[table] for table in TABLES)
+    assert rows(indexer) == expected
+
+def test_update_with_mmap_and_pages_held(tmp_path):
+    old, new = tmp_path / 'old.xml', tmp_path / 'new.xml'
+    synthetic.write_dump(old, 200, seed=2)
+    synthetic.write_dump(new, 250, seed=3)
+    indexer = Indexer(str(old), str(tmp_path / 'scratch'), use_mmap=True)
+    indexer.load()
+    page = indexer.get_page_by_num(3)
+    raw = indexer.get_raw_bytes(4)
+    title = page.title
+    indexer.update(str(new))
+    assert page.title == title and bytes(raw)
+    assert indexer.get_page_by_num(3).title
+
+def test_parallel_load_matches_serial(tmp_path):
+    xml = tmp_path / 'dump.xml'
+    synthetic.write_dump(xml, 500, seed=4)
+    serial = Indexer(str(xml), str(tmp_path / 'serial'))
+    serial.load(templates=SCHEMAS)
+    parallel = Indexer(str(xml), str(tmp_path / 'parallel'))
+    parallel.load(workers=3, templates=SCHEMAS)
+    expected = rows(serial)
+    assert all(expected[table] for table in TABLES)
+    assert rows(parallel) == expected
+    titles = 'SELECT * FROM titles ORDER BY page_num'
+    assert parallel.db.execute(titles).fetchall() == serial.db.execute(titles).fetchall()
+    assert [parallel.offsets.get(n) for n in range(500)] == [serial.offsets.get(n) for n in range(500)]
+
+def test_resumed_load_matches_fresh(tmp_path, monkeypatch):
+    xml = tmp_path / 'dump.xml'
+    synthetic.write_dump(xml, 500, seed=5)
+    fresh = Indexer(str(xml), str(tmp_path / 'fresh'))
+    fresh.load(templates=SCHEMAS)
+
+    parse_batch = geo_indexer._parse_batch
+    def interrupted(batch, extractor):
+        if batch[0][0] >= 250:
+            raise KeyboardInterrupt
+        return parse_batch(batch, extractor)
+    monkeypatch.setattr(geo_indexer, 'PARSE_BATCH', 20)
+    monkeypatch.setattr(geo_indexer, 'CHECKPOINT_PAGES', 100)
+    monkeypatch.setattr(geo_indexer, '_parse_batch', interrupted)
+    indexer = Indexer(str(xml), str(tmp_path / 'resumed'))
+    with pytest.raises(KeyboardInterrupt):
+        indexer.load(templates=SCHEMAS)
+    assert Checkpoint.read(indexer.metadata).page_num == 200
+    indexer.db.close()
+    indexer.metadata.close()
+
+    monkeypatch.setattr(geo_indexer, '_parse_batch', parse_batch)
+    resumed = Indexer(str(xml), str(tmp_path / 'resumed'))
+    resumed.load(resume=True)
+    assert rows(resumed) == rows(fresh)
+    assert [resumed.offsets.get(n) for n in range(500)] == [fresh.offsets.get(n) for n in range(500)]
+
+def edited_dump(path, new_path):
+    "A later dump of path: some pages deleted, some edited, one newly geotagged and some appended"
+    data = path.read_bytes()
+    synthetic.write_dump(new_path, 260, seed=8)
+    appended = new_path.read_bytes()
+    pages = list(synthetic._page.finditer(data))
+    out = [data[:pages[0].start()]]
+    geotagged = False
+    for k, match in enumerate(pages):
+        page = match.group()
+        if k % 17 == 3:
+            continue
+        if k % 11 == 5:
+            page = page.replace(b'</text>', b' zebrafish quokka</text>').replace(b'<sha1>', b'<sha1>e')
+        if not geotagged and k > 40 and b'Coord|' not in page and b'#REDIRECT' not in page:
+            geotagged = True
+            page = page.replace(b'</text>', b' {{Coord|12|34|display=inline,title}}</text>').replace(b'<sha1>', b'<sha1>c')
+        out.append(page)
+    # pages of another dump, with page ids no page above has
+    for match in synthetic._page.finditer(appended):
+        out.append(match.group().replace(b'<id>', b'<id>100', 1))
+    out.append(data[pages[-1].end():])
+    new_path.write_bytes(b''.join(out))
+
+def test_update_matches_fresh_load(tmp_path):
+    old, new = tmp_path / 'old.xml', tmp_path / 'new.xml'
+    synthetic.write_dump(old, 300, seed=6)
+    edited_dump(old, new)
+    indexer = Indexer(str(old), str(tmp_path / 'updated'))
+    indexer.load(templates=SCHEMAS)
+    (tmp_path / 'old_freq').mkdir()
+    doc_freq = dict(create_doc_freq(indexer, tmp_path / 'old_freq', threshold=0).items())
+    update = indexer.update(str(new))
+    assert update.changed and update.added and update.deleted and update.unchanged
+
+    fresh = Indexer(str(new), str(tmp_path / 'fresh'))
+    fresh.load(templates=SCHEMAS)
+    assert rows(indexer) == rows(fresh)
+    (tmp_path / 'new_freq').mkdir()
+    expected = dict(create_doc_freq(fresh, tmp_path / 'new_freq', threshold=0).items())
+    assert update_doc_freq(doc_freq, update, indexer) == expected
+    assert expected['zebrafish']
@@ -0,0 +1,29 @@
+import importlib
+from pathlib import Path
+import sqlite3
+
+import pytest
+
+from wikiparse.coord_parser import coord_string_to_dict, coords_table_sql, page_coords
+
+PACKAGE = Path(__file__).resolve().parent.parent / 'wikiparse'
+
+# config reads config.json from the working directory when it is imported
+MODULES = sorted(path.stem for path in PACKAGE.glob('*.py') if path.stem != 'config')
+
+@pytest.mark.parametrize('module', MODULES)
+def test_module_imports(module):
+    importlib.import_module(f'wikiparse.{module}')
+
+def test_coord_row_fits_coords_table():
+    db = sqlite3.connect(':memory:')
+    db.execute(coords_table_sql())
+    row = coord_string_to_dict('Coord|51|30|N|0|7|W|region:GB_type:city|display=inline,title')
+    row['page_num'] = 3
+    db.execute(f'INSERT INTO coords ({",".join(row)}) VALUES ({",".join("?" for _ in row)})', list(row.values()))
+    lat, lon, display = db.execute('SELECT lat, lon, display FROM coords').fetchone()
+    assert (round(lat, 4), round(lon, 4), display) == (51.5, -0.1167, 'inline,title')
+
+def test_page_coords():
+    assert page_coords('text {{coord|1.5|2.5|display=title}} more') == [1.5, 2.5]
+    assert page_coords('no coordinates here') == [None, None]
@@ -0,0 +1,16 @@
+from wikiparse import synthetic
+from wikiparse.indexer import Dump
+
+def coords_rows(dump):
+    dump.extract_coord_strings()
+    dump.create_coords_db()
+    return dump.db.execute('SELECT * FROM coords ORDER BY page_num').fetchall()
+
+def test_multistream_coords_match_plain_dump(tmp_path):
+    xml = tmp_path / 'dump.xml'
+    synthetic.write_dump(xml, 250, seed=8)
+    synthetic.write_multistream(xml, str(tmp_path / 'dump.xml.bz2'))
+    plain = Dump(str(xml), build_index=True, scratch_folder=str(tmp_path / 'plain'))
+    multistream = Dump(str(tmp_path / 'dump.xml.bz2'), scratch_folder=str(tmp_path / 'multistream'))
+    expected = coords_rows(plain)
+    assert expected and coords_rows(multistream) == expected
@@ -0,0 +1,22 @@
+import pytest
+
+from wikiparse import links, synthetic
+from wikiparse.indexer import Dump, Page, category_map
+
+def test_pages_are_parsed_until_links_are_indexed(tmp_path):
+    xml = tmp_path / 'dump.xml'
+    synthetic.write_dump(xml, 200, seed=6)
+    lazy = Dump(str(xml), scratch_folder=str(tmp_path / 'lazy'))
+    assert lazy.links is None and not links.has_tables(lazy.db)
+    parsed = Page(lazy.get_raw_bytes(5))
+    assert lazy.categories(5) == parsed.categories() and lazy.lang_equiv(5, 'fr') == parsed.lang_equiv('fr')
+    assert not links.has_tables(lazy.db)
+    with pytest.raises(Exception):
+        category_map(lazy)
+
+    eager = Dump(str(xml), scratch_folder=str(tmp_path / 'eager'), index_links=True)
+    assert eager.links is not None
+    expected = category_map(eager)
+    lazy.index_links()
+    assert expected and category_map(lazy) == expected
+    assert lazy.categories(5) == parsed.categories() and lazy.get_page_by_num(5).link_tables is lazy.links
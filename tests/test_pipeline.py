@@ -0,0 +1,86 @@
+import threading
+import time
+
+import pytest
+
+from wikiparse.pipeline import Pipeline, Step, batched
+
+def square(x):
+    return x * x
+
+def jitter(x):
+    time.sleep((x * 7919 % 10) / 10_000)
+    return x + 1
+
+def odd_or_none(x):
+    return x if x % 2 else None
+
+def fail_at_50(x):
+    if x == 50:
+        raise ValueError('step failed')
+    return x
+
+def counting(n, consumed):
+    for i in range(n):
+        consumed[0] += 1
+        yield i
+
+def test_ordered_output():
+    steps = [Step('jitter', jitter, workers=4), Step('square', square, kind='process', workers=3),
+             Step('batches', list, batch_size=7, workers=2)]
+    with Pipeline(range(500), steps, ordered=True) as pipeline:
+        results = [x for batch in pipeline for x in batch]
+    assert results == [(i + 1) ** 2 for i in range(500)]
+
+def test_unordered_output_has_every_item():
+    with Pipeline(range(500), [Step('jitter', jitter, workers=4)]) as pipeline:
+        results = list(pipeline)
+    assert sorted(results) == list(range(1, 501))
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_none_drops_the_item(ordered):
+    with Pipeline(range(200), [Step('jitter', jitter, workers=3), Step('odd', odd_or_none, workers=2)],
+                  ordered=ordered) as pipeline:
+        results = list(pipeline)
+    expected = [i for i in range(1, 201) if i % 2]
+    assert (results if ordered else sorted(results)) == expected
+
+@pytest.mark.parametrize('kind', ['thread', 'process'])
+def test_step_error_is_raised_from_the_loop(kind):
+    steps = [Step('fail', fail_at_50, kind=kind, workers=2), Step('square', square)]
+    with pytest.raises(ValueError, match='step failed'):
+        with Pipeline(range(100_000), steps, queue_size=4) as pipeline:
+            for _ in pipeline:
+                pass
+
+def test_breaking_out_stops_every_step():
+    before = threading.active_count()
+    steps = [Step('square', square, workers=2), Step('process', square, kind='process', workers=2)]
+    with Pipeline(iter(range(10**9)), steps, queue_size=4) as pipeline:
+        for i, _ in enumerate(pipeline):
+            if i == 50:
+                break
+    assert pipeline._threads == [] and pipeline._pools == []
+    assert threading.active_count() <= before
+
+def test_close_before_the_end():
+    pipeline = Pipeline(range(10**9), [Step('square', square, workers=2)], queue_size=4)
+    results = iter(pipeline)
+    assert next(results) is not None
+    pipeline.close()
+    # what was already in the last queue, at most
+    assert len(list(results)) <= 4
+    assert pipeline._threads == []
+
+@pytest.mark.parametrize('kind', ['thread', 'process'])
+def test_source_is_read_only_as_fast_as_results_are_used(kind):
+    consumed = [0]
+    steps = [Step('square', square, kind=kind, workers=2), Step('square again', square)]
+    with Pipeline(counting(10**6, consumed), steps, queue_size=4) as pipeline:
+        next(iter(pipeline))
+        time.sleep(0.5)
+        # a few full queues and the items handed to the pool, not the whole source
+        assert consumed[0] <= 30
+
+def test_batched():
+    assert list(batched(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
@@ -0,0 +1,60 @@
+import asyncio
+import json
+import os
+import socket
+from urllib.parse import quote
+
+import pytest
+
+from wikiparse import synthetic
+from wikiparse.geo_indexer import OFFSETS_FILENAME, Indexer
+from wikiparse.server import PageServer
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+async def get(port, path):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET {path} HTTP/1.0\r\n\r\n'.encode())
+    await writer.drain()
+    data = await reader.read()
+    writer.close()
+    await writer.wait_closed()
+    head, _, body = data.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(body)
+
+@pytest.fixture
+def scratch(tmp_path):
+    xml = tmp_path / 'dump.xml'
+    synthetic.write_dump(xml, 200, seed=7)
+    indexer = Indexer(str(xml), str(tmp_path / 'scratch'))
+    indexer.load()
+    title, page_num = indexer.db.execute('SELECT title, page_num FROM titles LIMIT 1').fetchone()
+    indexer.offsets.close()
+    indexer.db.close()
+    indexer.metadata.close()
+    return xml, tmp_path / 'scratch', title, page_num
+
+@pytest.mark.parametrize('offsets', [True, False])
+def test_pages(scratch, offsets):
+    xml, folder, title, page_num = scratch
+    if not offsets:
+        os.remove(folder / OFFSETS_FILENAME)
+    server = PageServer(str(xml), str(folder), threads=4)
+    port = free_port()
+
+    async def requests():
+        serving = asyncio.create_task(server.serve(port=port))
+        await asyncio.sleep(0.2)
+        try:
+            return [await get(port, f'/page/{page_num}'), await get(port, f'/page?title={quote(title)}'),
+                    await get(port, '/page/100000'), await get(port, f'/coords/{page_num}')]
+        finally:
+            serving.cancel()
+
+    by_num, by_title, missing, coords = asyncio.run(requests())
+    assert by_num == (200, by_title[1]) and by_num[1]['title'] == title
+    assert missing[0] == 404
+    assert coords[0] == 200 and coords[1]['page_num'] == page_num
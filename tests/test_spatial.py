@@ -0,0 +1,48 @@
+import random
+import sqlite3
+
+import pytest
+
+from wikiparse import spatial
+from wikiparse.coord_parser import coords_table_sql
+
+def coords_db(rtree):
+    db = sqlite3.connect(':memory:')
+    db.execute(coords_table_sql())
+    rng = random.Random(0)
+    points = [(rng.uniform(-90, 90), rng.uniform(-180, 180)) for _ in range(2000)]
+    # crowd the antimeridian and the poles, and add a failed parse at (0, 0)
+    points += [(rng.uniform(-10, 10), rng.choice([-1, 1]) * rng.uniform(175, 180)) for _ in range(300)]
+    points += [(rng.choice([-1, 1]) * rng.uniform(85, 90), rng.uniform(-180, 180)) for _ in range(100)]
+    points.append((0, 0))
+    db.executemany('INSERT INTO coords (page_num, lat, lon) VALUES (?, ?, ?)',
+                   [(i, lat, lon) for i, (lat, lon) in enumerate(points)])
+    assert spatial.create_spatial_index(db)
+    if not rtree:
+        db.execute(f'DROP TABLE {spatial.RTREE_TABLE}')
+        db.execute(f'CREATE INDEX {spatial.LAT_LON_INDEX} ON coords (lat, lon)')
+    return db, points
+
+def in_box(lat, lon, south, west, north, east):
+    in_lon = west <= lon <= east if west <= east else lon >= west or lon <= east
+    return south <= lat <= north and in_lon and (lat, lon) != (0, 0)
+
+@pytest.mark.parametrize('rtree', [True, False])
+def test_pages_in_bbox(rtree):
+    db, points = coords_db(rtree)
+    for box in [(-20, -30, 40, 60), (-5, 170, 5, -170), (-10, 179, 10, -179), (80, -180, 90, 180)]:
+        expected = {i for i, (lat, lon) in enumerate(points) if in_box(lat, lon, *box)}
+        assert expected and {row[0] for row in spatial.pages_in_bbox(db, *box)} == expected
+    assert len(spatial.pages_in_bbox(db, -5, 170, 5, -170, limit=3)) == 3
+
+@pytest.mark.parametrize('rtree', [True, False])
+def test_pages_near(rtree):
+    db, points = coords_db(rtree)
+    for lat, lon, radius in [(0, 179.9, 500), (0, -179.9, 300), (40, 10, 1000), (89, 0, 300), (-88, 120, 500)]:
+        distances = sorted((spatial.haversine(lat, lon, *point), i) for i, point in enumerate(points)
+                           if point != (0, 0))
+        expected = [i for distance, i in distances if distance <= radius][:20]
+        hits = spatial.pages_near(db, lat, lon, radius, limit=20)
+        assert expected and [hit[0] for hit in hits] == expected
+    # neighbours across the antimeridian are found
+    assert any(hit[2] < 0 for hit in spatial.pages_near(db, 0, 179.9, 500, limit=100))
@@ -0,0 +1,31 @@
+from wikiparse.syntax_parser import scan_templates
+
+def spans(text, names=None):
+    return [(t.name, text[t.start:t.end], t.params) for t in scan_templates(text, names)]
+
+def test_nesting():
+    text = 'a {{Infobox|map={{Coord|1|2}}|link=[[x|y]]}} b'
+    assert spans(text) == [
+        ('Infobox', '{{Infobox|map={{Coord|1|2}}|link=[[x|y]]}}', ['map={{Coord|1|2}}', 'link=[[x|y]]']),
+        ('Coord', '{{Coord|1|2}}', ['1', '2']),
+    ]
+    assert spans(text, ['coord']) == [('Coord', '{{Coord|1|2}}', ['1', '2'])]
+
+def test_unterminated_and_unbalanced():
+    assert spans('{{Coord|1|2') == []
+    assert spans('{{Outer|{{Coord|1|2}}') == [('Coord', '{{Coord|1|2}}', ['1', '2'])]
+    assert spans('{{Coord|1|2}}}} }}') == [('Coord', '{{Coord|1|2}}', ['1', '2'])]
+    assert spans('{{Coord|[[x|y}}') == [('Coord', '{{Coord|[[x|y}}', ['[[x|y'])]
+    # a stray brace stays in the text
+    assert spans('{{{Coord|1}}') == [('Coord', '{{Coord|1}}', ['1'])]
+
+def test_parameters():
+    assert spans('{{{1}}} {{{name|default}}}') == []
+    text = '{{Coord|{{{lat}}}|{{{lon|0}}}}}'
+    assert spans(text) == [('Coord', text, ['{{{lat}}}', '{{{lon|0}}}'])]
+    text = '{{{{{tpl}}}|x}}'
+    assert spans(text) == [('{{{tpl}}}', text, ['x'])]
+
+def test_parser_functions_and_magic_words():
+    text = '{{!}} {{=}} {{PAGENAME}} {{#if:{{{1|}}}|{{Coord|1|2}}}} {{lc:ABC}} {{DEFAULTSORT:X}} {{Lc}}'
+    assert [name for name, _, _ in spans(text)] == ['Coord', 'Lc']
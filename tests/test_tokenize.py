@@ -0,0 +1,50 @@
+import os
+
+from pandas import concat
+
+from wikiparse import synthetic
+from wikiparse.geo_indexer import OFFSETS_FILENAME, Indexer
+from wikiparse.tokenize import SparseTfidf, create_doc_freq, make_tfidf_df
+
+def test_doc_freq_without_offset_table(tmp_path):
+    xml = tmp_path / 'dump.xml'
+    synthetic.write_dump(xml, 300, seed=3)
+    scratch = tmp_path / 'scratch'
+    indexer = Indexer(str(xml), str(scratch))
+    indexer.load()
+    (tmp_path / 'with').mkdir()
+    expected = dict(create_doc_freq(indexer, tmp_path / 'with', threshold=0).items())
+    indexer.offsets.close()
+    indexer.db.close()
+    indexer.metadata.close()
+
+    # an index built before offsets.bin existed
+    os.remove(scratch / OFFSETS_FILENAME)
+    indexer = Indexer(str(xml), str(scratch))
+    assert indexer.offsets is None
+    (tmp_path / 'without').mkdir()
+    doc_freq = create_doc_freq(indexer, tmp_path / 'without', threshold=0)
+    assert expected and dict(doc_freq.items()) == expected
+
+def test_sparse_tfidf_matches_pandas(tmp_path):
+    xml = tmp_path / 'dump.xml'
+    synthetic.write_dump(xml, 400, seed=4)
+    indexer = Indexer(str(xml), str(tmp_path / 'scratch'))
+    indexer.load()
+    wikipedia = dict(create_doc_freq(indexer, tmp_path, threshold=0).items())
+    pages = indexer.get_pages_by_num(sorted(indexer.get_page_numbers()))
+    engine = SparseTfidf(wikipedia)
+    # the vocabulary carries over from one batch to the next
+    sparse = concat([engine.transform(pages[:50]), engine.transform(pages[50:])])
+    for page in pages:
+        rows = sparse[sparse.article == page.title]
+        expected = make_tfidf_df(page, wikipedia)
+        every_word = make_tfidf_df(page, wikipedia, top_n=None)
+        assert len(rows) == len(expected)
+        assert rows.tf_idf.tolist() == sorted(expected.tf_idf, reverse=True)
+        for word, row in rows.iterrows():
+            assert row.tolist() == every_word.loc[word].tolist()
+        # only words tied at the cutoff may be chosen differently
+        cutoff = expected.tf_idf.min()
+        assert set(rows.index[rows.tf_idf > cutoff]) == set(expected.index[expected.tf_idf > cutoff])
+    assert list(sparse.columns) == list(expected.columns) and (sparse.dtypes == expected.dtypes).all()
@@ -0,0 +1,49 @@
+from collections import Counter
+import os
+import random
+import threading
+
+from wikiparse import vocabulary
+from wikiparse.vocabulary import MappedVocabulary, SpillingCounter, apply_delta
+
+WORDS = [f'{prefix}{i}' for prefix in ['word', 'ünïcode', '字', 'a'] for i in range(300)]
+
+def documents(n, seed=0):
+    rng = random.Random(seed)
+    return [set(rng.choices(WORDS, k=rng.randint(1, 40))) for _ in range(n)]
+
+def test_spill_and_merge_matches_counter(tmp_path, monkeypatch):
+    # merge runs into one as soon as there are three of them
+    monkeypatch.setattr(vocabulary, 'MERGE_FAN_IN', 3)
+    docs = documents(2000)
+    expected = Counter(token for doc in docs for token in doc)
+    counter = SpillingCounter(tmp_path, max_bytes=4000)
+    threads = [threading.Thread(target=lambda part: [counter.update(doc) for doc in part], args=(docs[k::4],))
+               for k in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.update_counts(Counter({'word1': 5, 'extra': 20}), documents=2)
+    assert counter._run_count > 3 and 0 < len(counter.runs) < 3 and counter.documents == 2002
+    expected.update({'word1': 5, 'extra': 20})
+
+    vocab = counter.finish(tmp_path / 'doc_freq.vocab', threshold=10)
+    assert dict(vocab.items()) == {token: count for token, count in expected.items() if count > 10}
+    assert list(vocab) == sorted(vocab, key=lambda token: token.encode('utf-8'))
+    assert vocab['extra'] == 20 and vocab.get('never seen') is None and 'never seen' not in vocab
+    # the runs are gone once merged
+    assert os.listdir(tmp_path) == ['doc_freq.vocab']
+
+    vocab = apply_delta(vocab, {'extra': -15, 'new': 30}, threshold=10)
+    assert 'extra' not in vocab and vocab['new'] == 30
+    assert dict(MappedVocabulary.open(tmp_path).items()) == dict(vocab.items())
+
+def test_without_spilling(tmp_path):
+    docs = documents(200, seed=1)
+    counter = SpillingCounter(tmp_path)
+    for doc in docs:
+        counter.update(doc)
+    vocab = counter.finish(tmp_path / 'doc_freq.vocab', threshold=0)
+    assert counter._run_count == 0
+    assert dict(vocab.items()) == Counter(token for doc in docs for token in doc)
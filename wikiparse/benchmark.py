@@ -0,0 +1,464 @@
+"""
+Micro-benchmarks for the index builders, the Coord parser, the tokenizer and
+spatial queries, a load generator for wikiparse.server, and a suite timing
+each pipeline stage on a synthetic dump.
+
+    python -m wikiparse.benchmark
+    python -m wikiparse.benchmark server wiki.xml ./py3
+    python -m wikiparse.benchmark pipeline 20000 results.json [baseline.json]
+    python -m wikiparse.benchmark compare baseline.json results.json
+
+The pipeline suite writes its timings as JSON, with the git revision they
+were taken at; compare flags stages that got slower between two such files.
+"""
+import asyncio
+from collections import Counter
+import json
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+
+from .coord_parser import parse_coord_strings
+from .geo_indexer import Indexer, page_generator
+from .indexer import Dump, getSizeAndMakeOffsets
+from .spatial import create_spatial_index, pages_in_bbox, pages_near
+from .sqlite_writer import BulkWriter
+from .synthetic import write_dump
+from .tokenize import create_doc_freq, create_tfidf, remove_metadata, tokenize_page
+
+# stages more than this much slower per item than the baseline are regressions
+REGRESSION_TOLERANCE = 0.10
+
+def _fresh_db(folder, name):
+    path = os.path.join(folder, name)
+    if os.path.exists(path):
+        os.remove(path)
+    return sqlite3.connect(path)
+
+def _offset_rows(n):
+    # roughly the spacing of pages in the enwiki dump
+    return [(page_num, page_num * 4_000) for page_num in range(1, n + 1)]
+
+def _title_rows(n):
+    return [(f'Some page title {page_num}', page_num * 4_000, page_num) for page_num in range(1, n + 1)]
+
+def bench_sqlite_writer(n=200_000, folder=None):
+    """
+    Time offset and title ingestion with one execute per row and a commit every
+    1000 rows (the old approach) against BulkWriter
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(dir=folder) as tmp:
+        offsets = _offset_rows(n)
+        titles = _title_rows(n)
+
+        db = _fresh_db(tmp, 'row.db')
+        db.execute("CREATE TABLE indices (title TEXT, coords TEXT, page_num INTEGER PRIMARY KEY, idx INTEGER)")
+        db.execute("CREATE TABLE titles (title TEXT PRIMARY KEY, idx INTEGER, page_num INTEGER)")
+        start = time.time()
+        for i, (page_num, idx) in enumerate(offsets):
+            db.execute(f"INSERT INTO indices VALUES ('', '', {page_num}, {idx})")
+            if i % 1000 == 0:
+                db.commit()
+        db.commit()
+        results['offsets_per_row'] = time.time() - start
+        start = time.time()
+        for i, row in enumerate(titles):
+            db.execute("INSERT INTO titles VALUES (?,?,?)", row)
+            if i % 1000 == 0:
+                db.commit()
+        db.commit()
+        results['titles_per_row'] = time.time() - start
+        db.close()
+
+        db = _fresh_db(tmp, 'bulk.db')
+        db.execute("CREATE TABLE indices (title TEXT, coords TEXT, page_num INTEGER PRIMARY KEY, idx INTEGER)")
+        db.execute("CREATE TABLE titles (title TEXT, idx INTEGER, page_num INTEGER)")
+        start = time.time()
+        with BulkWriter(db) as writer:
+            for row in offsets:
+                writer.insert("INSERT INTO indices VALUES ('', '', ?, ?)", row)
+        results['offsets_bulk'] = time.time() - start
+        start = time.time()
+        with BulkWriter(db) as writer:
+            writer.defer_index('titles_title', 'titles', ['title'])
+            for row in titles:
+                writer.insert("INSERT INTO titles VALUES (?,?,?)", row)
+        results['titles_bulk'] = time.time() - start
+        db.close()
+
+    for key in ['offsets', 'titles']:
+        per_row = results[f'{key}_per_row']
+        bulk = results[f'{key}_bulk']
+        print(f'{key:8} {n} rows: per-row {round(per_row, 2)}s, '
+              f'bulk {round(bulk, 2)}s ({round(per_row / bulk, 1)}x faster)')
+    return results
+
+def _remove_metadata_charwise(text):
+    "The original character-at-a-time remove_metadata, kept as a reference"
+    stack = []
+    result = ''
+    metachars = set('{}[]()\'<>|')
+    html_on = False
+
+    for i in range(len(text)):
+        if not stack and not html_on:
+            if text[i] not in metachars:
+                result += text[i]
+            elif text[i] == '|':
+                result += ' '
+        if text[i:i+2] == '{{':
+            stack.append(i)
+        elif text[i:i+2] == '}}':
+            try:
+                stack.pop()
+            except:
+                pass
+        elif text[i] == '<':
+            stack.append(i)
+            if text[i:i+2] == '</':
+                html_on = False
+            else:
+                html_on = True
+        elif text[i] == '>':
+            if i > 0 and text[i-1:i+1] == '/>':
+                html_on = False
+            try:
+                stack.pop()
+            except:
+                pass
+    result = result.split('==See also==')[0]
+    return result.replace('=', ' ')
+
+def _list_article(size):
+    "Wikitext shaped like a long 'List of ...' article, size characters long"
+    rows = []
+    length = 0
+    i = 0
+    while length < size:
+        row = (f"|-\n| [[Place {i}|Place {i}]] || {{{{Coord|{i % 90}|{i % 60}|N|{i % 180}|{i % 60}|E|display=inline}}}} "
+               f"|| {random.randint(100, 100_000)} || ''notes'' <ref>{{{{cite web|url=http://example.org/{i}|title=Source {i}}}}}</ref>\n")
+        rows.append(row)
+        length += len(row)
+        i += 1
+    text = "'''List of places''' in a region.\n{| class=\"wikitable\"\n" + ''.join(rows)
+    return text[:size]
+
+def bench_remove_metadata(sizes=(50_000, 100_000, 250_000, 500_000), repeat=3):
+    """
+    Time remove_metadata on list-article sized pages against the original
+    implementation. Time per KB should stay flat as pages grow.
+    """
+    results = {}
+    for size in sizes:
+        text = _list_article(size)
+        assert remove_metadata(text) == _remove_metadata_charwise(text)
+        timings = {}
+        for name, fn in [('remove_metadata', remove_metadata), ('charwise', _remove_metadata_charwise)]:
+            best = None
+            for _ in range(repeat):
+                start = time.time()
+                fn(text)
+                took = time.time() - start
+                best = took if best is None else min(best, took)
+            timings[name] = best
+        results[size] = timings
+        print(f'{size // 1000:5} KB: {round(1000 * timings["remove_metadata"], 1):8}ms '
+              f'({round(1000 * timings["remove_metadata"] / (size / 1000), 3)}ms / KB), '
+              f'charwise {round(1000 * timings["charwise"], 1)}ms '
+              f'({round(timings["charwise"] / timings["remove_metadata"], 1)}x slower)')
+    return results
+
+def bench_spatial(n=1_000_000, queries=1000, folder=None):
+    """
+    Time pages_near and pages_in_bbox over n random points, with the R*Tree
+    and with a full scan of the coords table
+    """
+    random.seed(0)
+    results = {}
+    with tempfile.TemporaryDirectory(dir=folder) as tmp:
+        db = _fresh_db(tmp, 'spatial.db')
+        db.execute("CREATE TABLE coords (coords TEXT, lat REAL, lon REAL, page_num INTEGER PRIMARY KEY)")
+        with BulkWriter(db) as writer:
+            for page_num in range(n):
+                writer.insert("INSERT INTO coords VALUES ('', ?, ?, ?)",
+                              (random.uniform(-90, 90), random.uniform(-180, 180), page_num))
+        start = time.time()
+        create_spatial_index(db)
+        results['build'] = time.time() - start
+        points = [(random.uniform(-80, 80), random.uniform(-180, 180)) for _ in range(queries)]
+        start = time.time()
+        for lat, lon in points:
+            pages_near(db, lat, lon, 50)
+        results['near'] = (time.time() - start) / queries
+        start = time.time()
+        for lat, lon in points:
+            pages_in_bbox(db, lat, lon, lat + 1, lon + 1)
+        results['bbox'] = (time.time() - start) / queries
+        start = time.time()
+        for lat, lon in points[:10]:
+            db.execute("SELECT page_num FROM coords WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?",
+                       (lat, lat + 1, lon, lon + 1)).fetchall()
+        results['scan'] = (time.time() - start) / 10
+        db.close()
+    print(f'spatial index over {n} points built in {round(results["build"], 2)}s; '
+          f'pages_near {round(1000 * results["near"], 3)}ms, pages_in_bbox {round(1000 * results["bbox"], 3)}ms, '
+          f'table scan {round(1000 * results["scan"], 1)}ms per query')
+    return results
+
+def _coord_strings(n):
+    "Coord strings in the usual shapes, with some that can't be read"
+    strings = []
+    for i in range(n):
+        r = random.random()
+        if r < 0.6:
+            strings.append(f'Coord|{i % 90}|{i % 60}|{i % 59}|N|{i % 180}|{i % 60}|{i % 57}|W|'
+                           'region:US-NY_type:city|display=inline,title')
+        elif r < 0.95:
+            strings.append(f'Coord|{random.uniform(-90, 90):.4f}|{random.uniform(-180, 180):.4f}|'
+                           'type:landmark|display=title|name=Some place')
+        else:
+            strings.append(f'Coord|{i % 90}|N|{i % 180}|east|display=title')
+    return strings
+
+def bench_coord_parser(n=200_000):
+    "Time parse_coord_strings against the per-string Dump methods"
+    random.seed(0)
+    strings = _coord_strings(n)
+    start = time.time()
+    for coord_string in strings:
+        try:
+            Dump.convert_to_decimal(None, Dump.extract_lat_lon(None, coord_string))
+        except Exception:
+            pass
+        Dump.get_keywords(None, coord_string)
+    rowwise = time.time() - start
+    start = time.time()
+    parse_coord_strings(strings)
+    batch = time.time() - start
+    print(f'coords   {n} strings: per-string {round(rowwise, 2)}s, '
+          f'batch {round(batch, 2)}s ({round(rowwise / batch, 1)}x faster)')
+    return {'rowwise': rowwise, 'batch': batch}
+
+async def _fetch(reader, writer, path):
+    "One GET on a keep-alive connection; returns the status once the whole body is read"
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode('latin-1'))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    while (await reader.readline()) not in (b'\r\n', b''):
+        pass
+    while True:
+        size = int((await reader.readline()).strip(), 16)
+        # the chunk and the CRLF after it
+        await reader.readexactly(size + 2)
+        if size == 0:
+            return status
+
+async def _load(port, paths, concurrency):
+    latencies = []
+    statuses = Counter()
+    queue = iter(paths)
+
+    async def client():
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for path in queue:
+            start = time.perf_counter()
+            statuses[await _fetch(reader, writer, path)] += 1
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return latencies, statuses, time.perf_counter() - start
+
+def _server_paths(scratch_folder, n):
+    "A mix of page, title, coords and bbox requests over pages in the index"
+    db = sqlite3.connect(f'file:{os.path.abspath(os.path.join(scratch_folder, "index.db"))}?mode=ro', uri=True)
+    titles = db.execute('SELECT title, page_num FROM titles').fetchall()
+    db.close()
+    paths = []
+    for _ in range(n):
+        title, page_num = random.choice(titles)
+        r = random.random()
+        if r < 0.4:
+            paths.append(f'/page/{page_num}')
+        elif r < 0.7:
+            paths.append(f'/page?title={quote(title)}')
+        elif r < 0.9:
+            paths.append(f'/coords/{page_num}')
+        else:
+            lat, lon = random.uniform(-60, 60), random.uniform(-180, 170)
+            paths.append(f'/bbox?south={lat}&west={lon}&north={lat + 5}&east={lon + 10}&limit=500')
+    return paths
+
+def _wait_for_port(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise Exception(f"server didn't start listening on port {port}")
+
+def bench_server(xml_path, scratch_folder='./py3', concurrency=300, requests=10_000, port=8089):
+    """
+    Start wikiparse.server on an indexed dump and hit it with concurrency
+    keep-alive clients; reports p50 / p99 latency and throughput
+    """
+    random.seed(0)
+    paths = _server_paths(scratch_folder, requests)
+    server = subprocess.Popen([sys.executable, '-m', 'wikiparse.server', xml_path, scratch_folder,
+                               '--port', str(port)], stdout=subprocess.DEVNULL)
+    try:
+        _wait_for_port(port)
+        latencies, statuses, seconds = asyncio.run(_load(port, paths, concurrency))
+    finally:
+        server.terminate()
+        server.wait()
+    latencies.sort()
+    results = {
+        'p50': latencies[len(latencies) // 2],
+        'p99': latencies[int(len(latencies) * 0.99)],
+        'requests_per_second': len(latencies) / seconds,
+        'statuses': dict(statuses),
+    }
+    print(f'server   {len(latencies)} requests, {concurrency} concurrent: '
+          f'p50 {round(1000 * results["p50"], 1)}ms, p99 {round(1000 * results["p99"], 1)}ms, '
+          f'{round(results["requests_per_second"])} requests / s, statuses {results["statuses"]}')
+    return results
+
+def _git_revision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.decode().strip()
+
+def _timed(stages, name, fn, items, nbytes=None):
+    "Run fn once, record its time under stages[name] and return its result"
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+    items = items(result) if callable(items) else items
+    stage = {'seconds': seconds, 'items': items, 'ms_per_item': 1000 * seconds / max(items, 1)}
+    if nbytes:
+        stage['mb_per_second'] = nbytes / 1e6 / seconds
+    stages[name] = stage
+    return result
+
+def bench_pipeline(pages=20_000, folder=None, seed=0, lookups=2000):
+    """
+    Generate a synthetic dump of the given number of pages and time each stage
+    of the pipeline on it, from scanning the dump to create_tfidf. Returns a
+    dict that save_results writes as JSON.
+    """
+    random.seed(seed)
+    stages = {}
+    with tempfile.TemporaryDirectory(dir=folder) as tmp:
+        xml_path = os.path.join(tmp, 'synthetic.xml')
+        dump = write_dump(xml_path, pages, seed=seed)
+        size = os.path.getsize(xml_path)
+
+        def scan():
+            with open(xml_path, 'rb') as f:
+                return sum(1 for _ in page_generator(f))
+        _timed(stages, 'page_generator', scan, lambda n: n, size)
+
+        def offsets():
+            db = _fresh_db(tmp, 'offsets.db')
+            db.execute("CREATE TABLE indices (title TEXT, coords TEXT, page_num INTEGER PRIMARY KEY, idx INTEGER)")
+            with open(xml_path, 'rb') as f:
+                n = getSizeAndMakeOffsets(f, db, offsets_path=os.path.join(tmp, 'offsets.bin'))
+            db.close()
+            return n
+        _timed(stages, 'getSizeAndMakeOffsets', offsets, lambda n: n, size)
+
+        indexer = Indexer(xml_path, scratch_folder=os.path.join(tmp, 'scratch'))
+        _timed(stages, 'Indexer.load', indexer.load, pages, size)
+
+        page_nums = [random.randrange(pages) for _ in range(lookups)]
+        raws = _timed(stages, 'get_raw', lambda: [indexer.get_raw(n) for n in page_nums], lookups)
+        geo_pages = indexer.get_pages_by_num(indexer.get_page_numbers())
+        texts = [page.full_text or '' for page in geo_pages]
+        _timed(stages, 'remove_metadata', lambda: [remove_metadata(text) for text in texts],
+               len(texts), sum(len(text.encode('utf-8')) for text in texts))
+        # Page.text caches remove_metadata of the wikitext, which tokenize_page shouldn't be timed for
+        [page.text for page in geo_pages]
+        _timed(stages, 'tokenize_page', lambda: [tokenize_page(page) for page in geo_pages], len(geo_pages))
+
+        doc_freq = _timed(stages, 'create_doc_freq', lambda: create_doc_freq(indexer, tmp), len(geo_pages))
+        _timed(stages, 'create_tfidf', lambda: create_tfidf(indexer, tmp), len(geo_pages))
+        doc_freq.close()
+        indexer.db.close()
+        indexer.metadata.close()
+
+    results = {
+        'revision': _git_revision(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'pages': pages,
+        'geo_pages': len(geo_pages),
+        'redirects': dump['redirects'],
+        'dump_bytes': size,
+        'stages': stages,
+    }
+    print(f'\npipeline on {pages} synthetic pages ({round(size / 1e6, 1)} MB, {len(geo_pages)} with coordinates):')
+    for name, stage in stages.items():
+        throughput = f', {round(stage["mb_per_second"], 1)} MB / s' if 'mb_per_second' in stage else ''
+        print(f'  {name:22} {round(stage["seconds"], 3):8}s {round(stage["ms_per_item"], 4):10}ms / item{throughput}')
+    return results
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+def compare_results(baseline, results, tolerance=REGRESSION_TOLERANCE):
+    """
+    Compare the time per item of each stage in two bench_pipeline results.
+    Returns [(stage, ratio)] for the stages that got slower than tolerance allows.
+    """
+    regressions = []
+    print(f'{baseline.get("revision")} -> {results.get("revision")}')
+    for name, stage in results['stages'].items():
+        if name not in baseline['stages']:
+            print(f'  {name:22} new stage')
+            continue
+        ratio = stage['ms_per_item'] / baseline['stages'][name]['ms_per_item']
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append((name, ratio))
+            flag = '  REGRESSION'
+        print(f'  {name:22} {round(ratio, 2):6}x the baseline time per item{flag}')
+    return regressions
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['server']:
+        bench_server(*sys.argv[2:4])
+        sys.exit()
+    if sys.argv[1:2] == ['pipeline']:
+        results = bench_pipeline(int(sys.argv[2]) if len(sys.argv) > 2 else 20_000)
+        if len(sys.argv) > 3:
+            save_results(results, sys.argv[3])
+        if len(sys.argv) > 4:
+            sys.exit(1 if compare_results(load_results(sys.argv[4]), results) else 0)
+        sys.exit()
+    if sys.argv[1:2] == ['compare']:
+        sys.exit(1 if compare_results(load_results(sys.argv[2]), load_results(sys.argv[3])) else 0)
+    bench_sqlite_writer()
+    bench_remove_metadata()
+    bench_spatial()
+    bench_coord_parser()
@@ -0,0 +1,67 @@
+"""
+Fingerprints of dump files and checkpoints of a running Indexer.load.
+"""
+import hashlib
+import os
+
+# how many blocks of the dump are hashed, and how big they are
+FINGERPRINT_SAMPLES = 32
+FINGERPRINT_BLOCK = 64 * 1024
+
+def dump_fingerprint(path, known=None, samples=FINGERPRINT_SAMPLES, block_size=FINGERPRINT_BLOCK):
+    """
+    Cheap identity of a dump: its size plus a hash of evenly spaced blocks.
+    If known (an earlier fingerprint) has the same size and mtime the file is
+    assumed unchanged and the blocks aren't read again.
+    """
+    stat = os.stat(path)
+    if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+        return known
+    digest = hashlib.sha1(str(stat.st_size).encode())
+    with open(path, 'rb') as f:
+        last_block = max(stat.st_size - block_size, 0)
+        for k in range(samples):
+            f.seek(last_block * k // max(samples - 1, 1))
+            digest.update(f.read(block_size))
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'digest': digest.hexdigest()}
+
+class Checkpoint:
+    """
+    How far a load got: everything before byte_offset / page_num is in the
+    tables, which held indices_rows and coords_rows rows at that point.
+    Stored as a plain dict in the metadata shelf.
+    """
+    key = 'load_checkpoint'
+
+    def __init__(self, byte_offset=0, page_num=0, coords_count=0, failures=0,
+                 indices_rows=0, coords_rows=0, complete=False):
+        self.byte_offset = byte_offset
+        self.page_num = page_num
+        self.coords_count = coords_count
+        self.failures = failures
+        self.indices_rows = indices_rows
+        self.coords_rows = coords_rows
+        self.complete = complete
+
+    @classmethod
+    def read(cls, metadata):
+        "The last checkpoint saved in a metadata shelf, or None"
+        try:
+            return cls(**metadata[cls.key])
+        except KeyError:
+            return None
+
+    def save(self, metadata):
+        metadata[self.key] = dict(vars(self))
+        metadata.sync()
+
+    @classmethod
+    def clear(cls, metadata):
+        try:
+            del metadata[cls.key]
+        except KeyError:
+            pass
+        metadata.sync()
+
+    def __str__(self):
+        return f'page {self.page_num} at byte {self.byte_offset}'
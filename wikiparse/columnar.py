@@ -0,0 +1,106 @@
+"""
+Typed columnar (Parquet) files for the tokenization and geo stages.
+
+Files are written in row groups as the rows come in, so a writer never holds
+the whole table. Readers can pick columns, push filters down to the row
+group statistics (e.g. filters=[('tf_idf', '>', 0.1)]) and memory-map the
+file instead of reading it into Python objects.
+"""
+import json
+
+from pandas import DataFrame
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+TFIDF_FILENAME = 'tfidf.parquet'
+
+# one row per (page, significant word), as produced by create_tfidf
+TFIDF_SCHEMA = pa.schema([
+    ('word', pa.string()),
+    ('tf', pa.int64()),
+    ('article', pa.string()),
+    ('df', pa.int64()),
+    ('tf_idf', pa.float64()),
+])
+# repeated strings, read back as pandas categoricals
+TFIDF_CATEGORIES = ['word', 'article']
+
+# schema metadata key holding the CRS of a GeoDataFrame
+_CRS_KEY = b'wikiparse.crs'
+
+class ParquetAppender:
+    "Writes DataFrames to one Parquet file, each append becoming a row group"
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self.rows = 0
+        self._writer = pq.ParquetWriter(str(path), schema, compression='zstd')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def append(self, df):
+        table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        self._writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        self._writer.close()
+
+def tfidf_frame(df):
+    "A create_tfidf DataFrame (words as the index) in the column layout of TFIDF_SCHEMA"
+    df = df.rename_axis('word').reset_index()
+    return df[TFIDF_SCHEMA.names]
+
+def read_table(path, columns=None, filters=None, memory_map=True, categories=None):
+    """
+    Read a Parquet file into a DataFrame. Only the given columns are read,
+    row groups that can't match the filters are skipped, and string columns
+    in categories come back as pandas categoricals.
+    """
+    table = pq.read_table(str(path), columns=columns, filters=filters, memory_map=memory_map,
+                          read_dictionary=categories)
+    return table.to_pandas()
+
+def read_tfidf(path, columns=None, filters=None, memory_map=True):
+    "The TF-IDF table written by create_tfidf, with words and articles as categoricals"
+    categories = [c for c in TFIDF_CATEGORIES if columns is None or c in columns]
+    return read_table(path, columns, filters, memory_map, categories)
+
+def iter_batches(path, columns=None, batch_size=65_536, memory_map=True):
+    "Stream a Parquet file as DataFrames of up to batch_size rows"
+    parquet = pq.ParquetFile(str(path), memory_map=memory_map)
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=columns):
+        yield batch.to_pandas()
+
+def write_geo(gdf, path, row_group_size=100_000):
+    """
+    Write a GeoDataFrame of points as plain columns: the geometry is stored
+    as geometry_x / geometry_y and the CRS in the file's metadata
+    """
+    if not (gdf.geometry.geom_type == 'Point').all():
+        raise ValueError("write_geo only stores point geometries")
+    df = DataFrame(gdf.drop(columns=gdf.geometry.name))
+    df['geometry_x'] = gdf.geometry.x.values
+    df['geometry_y'] = gdf.geometry.y.values
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    crs = gdf.crs.to_string() if hasattr(gdf.crs, 'to_string') else gdf.crs
+    metadata = dict(table.schema.metadata or {})
+    metadata[_CRS_KEY] = json.dumps(crs).encode('utf-8')
+    table = table.replace_schema_metadata(metadata)
+    pq.write_table(table, str(path), row_group_size=row_group_size, compression='zstd')
+
+def read_geo(path, columns=None, filters=None, memory_map=True):
+    "Read a file written by write_geo back into a GeoDataFrame"
+    # only the geo stages need geopandas, and it is the hardest dependency to install
+    import geopandas
+    if columns is not None:
+        columns = list(columns) + ['geometry_x', 'geometry_y']
+    table = pq.read_table(str(path), columns=columns, filters=filters, memory_map=memory_map)
+    crs = json.loads(table.schema.metadata.get(_CRS_KEY, b'null'))
+    df = table.to_pandas()
+    geometry = geopandas.points_from_xy(df.pop('geometry_x'), df.pop('geometry_y'))
+    return geopandas.GeoDataFrame(df, geometry=geometry, crs=crs)
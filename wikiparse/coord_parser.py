@@ -0,0 +1,239 @@
+"""
+Batch parsing of Coord template strings, such as 'Coord|51|30|N|0|7|W|display=title'.
+
+parse_coord_strings gives the same results as Dump.extract_lat_lon,
+get_keywords and convert_to_decimal. The common shapes, 'Coord|lat|lon' and
+'Coord|d|m|s|N|d|m|s|E' (minutes and seconds optional), are taken apart for
+the whole batch with Arrow string kernels and converted with NumPy; only the
+other strings are split, stripped and lowercased one by one.
+"""
+import re
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .syntax_parser import scan_templates
+
+# keyword arguments of the Coord template that get their own column in coords
+COORD_KEYWORDS = [
+    'accessdate', 'date', 'dim', 'display',
+    'elevation', 'format', 'globe', 'id',
+    'name', 'nosave', 'notes', 'publisher',
+    'reason', 'region', 'scale', 'source',
+    'title', 'type', 'upright', 'url', 'work',
+]
+
+def coords_table_sql(table='coords'):
+    "CREATE TABLE statement of a coords table: the Coord string, its position and a column per keyword"
+    keywords = ''.join(f", {kw} TEXT DEFAULT ''" for kw in COORD_KEYWORDS)
+    return (f'CREATE TABLE {table} (coords TEXT, lat REAL DEFAULT 0, lon REAL DEFAULT 0, '
+            f'page_num INTEGER PRIMARY KEY{keywords})')
+
+# The common shapes, 'Coord|d|m|s|N|d|m|s|E' and 'Coord|lat|lon', with ASCII
+# numbers that float() reads. Positional parts end at the first keyword, so
+# anything after them must start with one. Written for RE2, which Arrow uses.
+_NUMBER = r'-?(?:\d+\.?\d*|\.\d+)'
+_DEGREES = rf'{_NUMBER}(?:\|{_NUMBER}(?:\|{_NUMBER})?)?'
+_TAIL = r'(?:\|[^|=:]*[=:].*)?'
+_DMS_COORD = rf'(?s)^Coord\|{_DEGREES}\|[NSns]\|{_DEGREES}\|[EWew]{_TAIL}$'
+_DECIMAL_COORD = rf'(?s)^Coord\|{_NUMBER}\|{_NUMBER}{_TAIL}$'
+
+def title_coord(coord_strings):
+    "The Coord string that positions the page itself: the last with display=title, else the first"
+    chosen = coord_strings[0]
+    for coord_string in coord_strings:
+        if 'display=title' in coord_string:
+            chosen = coord_string
+    return chosen
+
+def _keywords(items):
+    "{keyword: value} of the items of a Coord string that are 'keyword=value' or 'keyword:value'"
+    kws = {}
+    for item in items:
+        if '=' in item:
+            fields = item.split('=', 2)
+        elif ':' in item:
+            fields = item.split(':', 2)
+        else:
+            continue
+        kws[fields[0]] = fields[1]
+    return kws
+
+def _split(items):
+    "Positional parts (up to the first keyword) and {keyword: value} of a split Coord string"
+    parts = []
+    for i, item in enumerate(items):
+        if '=' in item or ':' in item:
+            return parts, _keywords(items[i:])
+        if 'Coord' not in item and 'LAT' not in item and 'LONG' not in item:
+            parts.append(item)
+    return parts, {}
+
+def _to_decimal(parts):
+    """
+    (lat, lon) of the positional parts of a Coord string, or None if they
+    can't be read. Raises ValueError or IndexError for malformed numbers.
+    """
+    parts = [s.strip().lower() for s in parts]
+    parts = [s for s in parts if s]
+    if len(parts) < 2:
+        return None
+    if len(parts) == 2:
+        return float(parts[0]), float(parts[1])
+    if sum(1 for s in parts if s in 'nesw') != 2:
+        return None
+    lat = []
+    lon = []
+    current = lat
+    for s in parts:
+        if current is lat and s in 'ns':
+            while len(lat) < 3:
+                lat.append(0)
+            lat.append(1 if s == 'n' else -1)
+            current = lon
+        elif current is lon and s in 'ew':
+            while len(lon) < 3:
+                lon.append(0)
+            lon.append(1 if s == 'e' else -1)
+        else:
+            current.append(float(s.replace(',', '.')))
+    return (
+        (lat[0] + lat[1]/60 + lat[2]/3600) * lat[3],
+        (lon[0] + lon[1]/60 + lon[2]/3600) * lon[3],
+    )
+
+def _parse(coord_string):
+    "(lat, lon) or None, and {keyword: value} of one Coord string"
+    parts, kws = _split(coord_string.split('|'))
+    try:
+        return _to_decimal(parts), kws
+    except (ValueError, IndexError):
+        return None, kws
+
+def _keyword_columns(items, rows, in_tail, n, keywords):
+    """
+    {keyword: list of n values or None} from the parts of Coord strings:
+    items, the string each came from (rows) and whether it follows the
+    position (in_tail)
+    """
+    found = []
+    equals = pc.and_(in_tail, pc.match_substring(items, '='))
+    colon = pc.and_(pc.and_(in_tail, pc.invert(equals)), pc.match_substring(items, ':'))
+    for mask, separator in [(equals, '='), (colon, ':')]:
+        # like item.split(separator)[0] and [1]
+        fields = pc.split_pattern(pc.filter(items, mask), separator, max_splits=2)
+        found.append((np.flatnonzero(mask.to_numpy(zero_copy_only=False)),
+                      pc.list_element(fields, 0), pc.list_element(fields, 1)))
+    flat = np.concatenate([indices for indices, _, _ in found])
+    kw_index = pc.index_in(pa.concat_arrays([key for _, key, _ in found]), pa.array(keywords, pa.string()))
+    values = np.concatenate([value.to_numpy(zero_copy_only=False) for _, _, value in found])
+    known = pc.is_valid(kw_index).to_numpy(zero_copy_only=False)
+    flat, values = flat[known], values[known]
+    kw_index = pc.fill_null(kw_index, 0).to_numpy(zero_copy_only=False)[known].astype(np.int64)
+    # a keyword given twice keeps its last value, as in a dict
+    order = np.argsort(flat, kind='stable')[::-1]
+    flat, values, kw_index = flat[order], values[order], kw_index[order]
+    _, last = np.unique(rows[flat] * len(keywords) + kw_index, return_index=True)
+    columns = {}
+    for k, kw in enumerate(keywords):
+        column = np.full(n, None, dtype=object)
+        mine = last[kw_index[last] == k]
+        column[rows[flat[mine]]] = values[mine]
+        columns[kw] = column.tolist()
+    return columns
+
+def parse_coord_strings(coord_strings, keywords=COORD_KEYWORDS):
+    """
+    Parse a sequence of Coord strings at once. Returns lat and lon arrays, a
+    mask of the strings whose position could be read (the others are 0, 0)
+    and {keyword: list of values}, with None where a string lacks the keyword.
+    """
+    n = len(coord_strings)
+    lat = np.zeros(n)
+    lon = np.zeros(n)
+    valid = np.zeros(n, dtype=bool)
+    strings = pa.array(list(coord_strings), pa.string())
+    dms = pc.match_substring_regex(strings, _DMS_COORD).to_numpy(zero_copy_only=False)
+    common = np.flatnonzero(dms | pc.match_substring_regex(strings, _DECIMAL_COORD).to_numpy(zero_copy_only=False))
+    dms = dms[common]
+
+    # the '|'-separated parts of the common strings, one after another
+    lists = pc.split_pattern(strings.take(pa.array(common, pa.int64())), '|')
+    items = pc.list_flatten(lists)
+    starts = np.asarray(lists.offsets)[:-1].astype(np.int64)
+    parent = pc.list_parent_indices(lists).to_numpy(zero_copy_only=False).astype(np.int64)
+    position = np.arange(len(items)) - starts[parent]
+    numbers = pc.cast(pc.if_else(pc.match_substring_regex(items, f'^{_NUMBER}$'), items, '0'), pa.float64())
+    numbers = np.append(numbers.to_numpy(zero_copy_only=False), 0.)
+    last = len(items)
+
+    def flags(values):
+        return pc.is_in(items, pa.array(values)).to_numpy(zero_copy_only=False)
+
+    def first(flagged, after):
+        "Position in each string of its first flagged part past position after"
+        flat = np.flatnonzero(flagged & (position > after[parent]))
+        found = np.zeros(len(common), dtype=np.int64)
+        strings_found, index = np.unique(parent[flat], return_index=True)
+        found[strings_found] = position[flat[index]]
+        return found
+
+    def degrees(start, end):
+        "d|m|s between two positions, with the same arithmetic as _to_decimal"
+        d, m, s = [np.where(start + k < end, numbers[np.minimum(starts + start + k, last)], 0) for k in (1, 2, 3)]
+        negative = flags(['S', 's', 'W', 'w'])[np.minimum(starts + end, last - 1)]
+        return (d + m/60 + s/3600) * np.where(negative, -1, 1)
+
+    # 'Coord|d|m|s|N|d|m|s|E' has one to three numbers before each hemisphere,
+    # 'Coord|lat|lon' keywords from position 3 on
+    if len(common):
+        ns = first(flags(['N', 'S', 'n', 's']), np.zeros(len(common), dtype=np.int64))
+        ew = first(flags(['E', 'W', 'e', 'w']), ns)
+        lat[common] = np.where(dms, degrees(0, ns), numbers[starts + 1])
+        lon[common] = np.where(dms, degrees(ns, ew), numbers[starts + 2])
+        valid[common] = True
+        in_tail = pa.array(position >= np.where(dms, ew + 1, 3)[parent])
+        columns = _keyword_columns(items, common[parent], in_tail, n, keywords)
+    else:
+        columns = {kw: [None] * n for kw in keywords}
+
+    # the other shapes are parsed one by one
+    other = np.ones(n, dtype=bool)
+    other[common] = False
+    for i in np.flatnonzero(other).tolist():
+        position, kws = _parse(coord_strings[i])
+        for kw, value in kws.items():
+            if kw in columns:
+                columns[kw][i] = value
+        if position is not None:
+            lat[i], lon[i] = position
+            valid[i] = True
+    return lat, lon, valid, columns
+
+def parse_coord_string(coord_string):
+    "(lat, lon), or None if the position can't be read, and {keyword: value} of one Coord string"
+    return _parse(coord_string)
+
+def coord_string_to_dict(coord_string, keywords=COORD_KEYWORDS):
+    """
+    A coords row for one Coord string: the string, lat and lon (0, 0 when
+    the position can't be read, as in parse_coord_strings) and the keywords
+    that have a column
+    """
+    position, kws = parse_coord_string(coord_string)
+    row = {'coords': coord_string, 'lat': 0., 'lon': 0.}
+    if position is not None:
+        row['lat'], row['lon'] = position
+    for kw, value in kws.items():
+        if kw in keywords:
+            row[kw] = value
+    return row
+
+def page_coords(text):
+    "[lat, lon] of the Coord template that positions a page, or [None, None]"
+    templates = scan_templates(text or '', ['Coord'])
+    if not templates:
+        return [None, None]
+    position, _ = parse_coord_string(title_coord([template.wikitext() for template in templates]))
+    return list(position) if position is not None else [None, None]
@@ -0,0 +1,51 @@
+"""
+Byte-range access to an uncompressed dump file.
+"""
+import mmap
+
+class FileReader:
+    "Reads byte ranges with seek + read on a single file object"
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+
+    def read(self, start, end=None):
+        "Bytes from start up to end, or up to the end of the file"
+        self.f.seek(start)
+        if end is None:
+            return self.f.read()
+        return self.f.read(end - start)
+
+    def close(self):
+        self.f.close()
+
+class MmapReader:
+    """
+    Memory-maps the whole dump and hands out memoryview slices of it, so a page
+    read is neither a syscall nor a copy. Slices stay valid as long as they are
+    referenced; if any are still alive at close(), the map is only unmapped
+    once the last of them is gone.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        self._mmap = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+    def read(self, start, end=None):
+        "memoryview from start up to end, or up to the end of the file"
+        return self._view[start:end]
+
+    def close(self):
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+        self._mmap = None
+        self.f.close()
+
+def open_reader(path, use_mmap=False):
+    if use_mmap:
+        return MmapReader(path)
+    return FileReader(path)
@@ -0,0 +1,157 @@
+"""
+Templates pulled out of every page into tables keyed by page_num, for any
+number of templates at once.
+
+    schemas = [
+        TemplateSchema('Infobox settlement', {'name': 'TEXT', 'population_total': 'INTEGER',
+                                              'elevation_m': 'REAL'}),
+        TemplateSchema('Location map', {'1': 'TEXT', 'width': 'INTEGER'}),
+    ]
+    indexer.load(templates=schemas)       # along with the rest of the index
+    indexer.extract_templates(schemas)    # or in a pass of its own
+
+    SELECT page_num, population_total FROM tpl_infobox_settlement WHERE population_total > 100000
+
+Every occurrence of a template is one row: page_num, occurrence (0 for the
+first of that template on the page), the template's wikitext and a column
+per parameter of the schema. Parameters are looked up by name, or by
+position for names like '1' (stored as param_1). INTEGER and REAL values are
+read leniently, '12,345 (2011)' -> 12345, and are NULL when there is no number.
+"""
+import json
+import re
+
+from .sqlite_writer import insert_sql, quote_identifier
+from .syntax_parser import normalize_name, scan_templates
+
+COLUMN_TYPES = ('TEXT', 'INTEGER', 'REAL')
+# columns of every template table, ahead of those of the parameters
+KEY_COLUMNS = ['page_num', 'occurrence', 'wikitext']
+
+_number = re.compile(r'[-+]?\d[\d,]*(?:\.\d+)?')
+_identifier = re.compile(r'\W+')
+
+def _identify(name):
+    return _identifier.sub('_', name.lower()).strip('_')
+
+def _to_number(value, kind):
+    match = _number.search(value)
+    if not match:
+        return None
+    number = float(match.group().replace(',', ''))
+    return int(number) if kind == 'INTEGER' else number
+
+class TemplateSchema:
+    "The parameters to keep of one template, with their SQLite types, and the table they go to"
+    def __init__(self, name, columns, table=None):
+        self.name = normalize_name(name)
+        if not isinstance(columns, dict):
+            columns = {param: 'TEXT' for param in columns}
+        self.columns = {}
+        for param, kind in columns.items():
+            kind = kind.upper()
+            if kind not in COLUMN_TYPES:
+                raise ValueError(f"{self.name}: type of {param} must be one of {COLUMN_TYPES}, not {kind!r}")
+            self.columns[str(param).strip()] = kind
+        self.table = table or 'tpl_' + _identify(self.name)
+        self.column_names = [f'param_{param}' if param.isdigit() else _identify(param)
+                             for param in self.columns]
+        # SQLite compares column names without regard to case
+        seen = {column: None for column in KEY_COLUMNS}
+        for param, column in zip(self.columns, self.column_names):
+            if not column:
+                raise ValueError(f"{self.name}: parameter {param!r} has no letters or digits to name a column")
+            if column.lower() in seen:
+                other = seen[column.lower()]
+                clash = f'parameter {other!r}' if other is not None else 'a column of every template table'
+                raise ValueError(f"{self.name}: parameter {param!r} would be column {column}, as is {clash}")
+            seen[column.lower()] = param
+
+    def __repr__(self):
+        return f'TemplateSchema({self.name!r}, {self.columns!r}, {self.table!r})'
+
+    def config(self):
+        "The schema as a JSON-serializable dict, see from_config"
+        return {'name': self.name, 'columns': self.columns, 'table': self.table}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['name'], config['columns'], config.get('table'))
+
+    def create_sql(self, if_not_exists=False):
+        columns = ''.join(f', {quote_identifier(column)} {kind}'
+                          for column, kind in zip(self.column_names, self.columns.values()))
+        create = 'CREATE TABLE IF NOT EXISTS' if if_not_exists else 'CREATE TABLE'
+        return (f'{create} {quote_identifier(self.table)} (page_num INTEGER, occurrence INTEGER, '
+                f'wikitext TEXT{columns}, PRIMARY KEY (page_num, occurrence))')
+
+    def insert_sql(self):
+        return insert_sql(quote_identifier(self.table),
+                          [quote_identifier(column) for column in KEY_COLUMNS + self.column_names])
+
+    def row(self, occurrence, template):
+        "(occurrence, wikitext, values...) of a Template found by scan_templates"
+        positional, named = template.arguments()
+        values = []
+        for param, kind in self.columns.items():
+            if param.isdigit():
+                k = int(param) - 1
+                value = positional[k].strip() if k < len(positional) else named.get(param)
+            else:
+                value = named.get(param)
+            if value is not None and kind != 'TEXT':
+                value = _to_number(value, kind)
+            values.append(value)
+        return (occurrence, template.wikitext()) + tuple(values)
+
+def load_schemas(path):
+    "TemplateSchemas from a JSON file: a list of schema configs, or a config file with a 'templates' list"
+    with open(path) as f:
+        configs = json.load(f)
+    if isinstance(configs, dict):
+        configs = configs.get('templates', [])
+    return [TemplateSchema.from_config(config) for config in configs]
+
+class TemplateExtractor:
+    """
+    Finds the templates of several schemas in a page with one scan of its
+    text. A cheap search of the raw page skips pages that can't hold any.
+    """
+    def __init__(self, schemas):
+        self.schemas = {}
+        for schema in schemas:
+            if schema.name in self.schemas:
+                raise ValueError(f"more than one schema for {schema.name}")
+            self.schemas[schema.name] = schema
+        self.by_table = {schema.table: schema for schema in self.schemas.values()}
+        self._mention = re.compile(rb'\{\{\s*(?:[Tt]emplate:\s*)?(?:'
+                                   + b'|'.join(self._name_pattern(name) for name in self.schemas) + b')')
+
+    @staticmethod
+    def _name_pattern(name):
+        first = f'(?:{re.escape(name[0])}|{re.escape(name[0].lower())})'
+        rest = '[ _]+'.join(re.escape(word) for word in name[1:].split(' '))
+        return (first + rest).encode('utf-8')
+
+    def mentions(self, page):
+        "Whether a raw page (bytes or memoryview) may hold one of the templates"
+        return bool(self.schemas) and self._mention.search(page) is not None
+
+    def extract(self, text):
+        "(table, row) of every template of a schema in text; page_num is left for the caller to prepend"
+        rows = []
+        occurrences = {}
+        for template in scan_templates(text, self.schemas):
+            schema = self.schemas[template.name]
+            occurrence = occurrences.get(schema.table, 0)
+            occurrences[schema.table] = occurrence + 1
+            rows.append((schema.table, schema.row(occurrence, template)))
+        return rows
+
+    def create_tables(self, db, replace=True):
+        "Create the tables, replacing any that exist unless replace is False"
+        for schema in self.schemas.values():
+            if replace:
+                db.execute(f'DROP TABLE IF EXISTS {quote_identifier(schema.table)}')
+            db.execute(schema.create_sql(if_not_exists=not replace))
+        db.commit()
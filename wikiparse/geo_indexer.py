@@ -1,40 +1,278 @@
+from array import array
+import bz2
+from functools import partial
+import html
 import logging
 import os
+import re
 import shelve
 import sqlite3
 import time
 import xml.etree.ElementTree as etree
 
-from . import pipeline_utils as utils
+from . import metrics, spatial
+from .checkpoint import Checkpoint, dump_fingerprint
+from .coord_parser import coord_string_to_dict, coords_table_sql, page_coords, title_coord
+from .dumpfile import open_reader
+from .extraction import TemplateExtractor, TemplateSchema
+from .multistream import MultistreamDump, is_multistream
+from .offsets import OFFSETS_FILENAME, OffsetTable, OffsetTableWriter
+from .pagecache import CACHE_BYTES, PageCache, fetch_pages, lookup_page_nums
+from .pipeline import Pipeline, Step, batched
+from .sqlite_writer import BulkWriter, insert_sql, quote_identifier
+from .syntax_parser import scan_templates
 from .tokenize import remove_metadata
 
 PAGES_ESTIMATE = 21_000_000
 
+# how often Indexer.load checkpoints its progress
+CHECKPOINT_PAGES = 250_000
+
+# pages handed from the reading thread to the parsing thread at a time
+PARSE_BATCH = 1000
+
+# size of the blocks PageScanner reads from the dump
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# cheap test for pages that may hold a Coord template
+coord_tag = re.compile(rb'[Cc]oord')
+COORD_TEMPLATES = ['Coord']
+
+# the page id is the first <id> in a page; the revision's own id comes after it
+_page_id = re.compile(rb'<id>(\d+)</id>')
+_sha1 = re.compile(rb'<sha1>([0-9a-z]+)</sha1>')
+
+INSERT_REVISION = "INSERT OR REPLACE INTO revisions VALUES (?,?,?)"
+
+_title_bytes = re.compile(rb'<title>(.*?)</title>', re.S)
+_text_bytes = re.compile(rb'<text[^>]*?(?:/>|>(.*?)</text>)', re.S)
+_title_str = re.compile(r'<title>(.*?)</title>', re.S)
+_text_str = re.compile(r'<text[^>]*?(?:/>|>(.*?)</text>)', re.S)
+
+# marks a lazily computed Page attribute that may legitimately be None
+_unset = object()
+
+def _first_group(raw, bytes_re, str_re):
+    if isinstance(raw, str):
+        match = str_re.search(raw)
+        value = match and match.group(1)
+    else:
+        match = bytes_re.search(raw)
+        value = match and match.group(1)
+        if value is not None:
+            value = value.decode('utf-8')
+    if not match or value is None:
+        return None
+    return html.unescape(value)
+
+def extract_title(raw):
+    "Title of a raw page (str, bytes or memoryview) without building a DOM"
+    return _first_group(raw, _title_bytes, _title_str)
+
+def extract_text(raw):
+    "Wikitext of a raw page without building a DOM; None for an empty <text/>"
+    return _first_group(raw, _text_bytes, _text_str)
+
+class PageScanner:
+    """
+    Reads the dump once in large chunks and yields (start_idx, end_idx, page)
+    for every <page>...</page> element, where the offsets are bytes into the
+    file and page is a memoryview into the chunk (no copy is made).
+    Only the partial page at the end of a chunk is carried into the next one.
+    """
+    def __init__(self, f, sample=1.0, chunk_size=CHUNK_SIZE, start=0, stop=None, pages=0):
+        self.f = f
+        self.sample = sample
+        self.chunk_size = chunk_size
+        self.start = start
+        self.stop = stop
+        # pages before start, when resuming a pass
+        self.pages = pages
+        self.bytes_read = 0
+        self.seconds = 0
+
+    def __iter__(self):
+        start_ts = time.time()
+        try:
+            yield from self._scan()
+        finally:
+            self.seconds = time.time() - start_ts
+
+    def _scan(self):
+        f = self.f
+        if self.start:
+            f.seek(self.start)
+        # file offset of buf[0]
+        offset = self.start
+        buf = b''
+        view = memoryview(buf)
+        pos = 0
+        while True:
+            page_start = buf.find(b'<page>', pos)
+            if page_start != -1:
+                if self.stop is not None and offset + page_start >= self.stop:
+                    return
+                page_end = buf.find(b'</page>', page_start)
+                if page_end != -1:
+                    page_end += len(b'</page>')
+                    self.pages += 1
+                    yield offset + page_start, offset + page_end, view[page_start:page_end]
+                    pos = page_end
+                    if self.sample < 1.0 and self.pages > PAGES_ESTIMATE * self.sample:
+                        print("reached end of sample, ", self.pages, "pages found, idx at", offset + pos)
+                        return
+                    continue
+                keep = page_start
+            else:
+                # a <page> tag may straddle the chunk boundary
+                keep = max(pos, len(buf) - len(b'<page>') + 1)
+            chunk = f.read(self.chunk_size)
+            if not chunk:
+                return
+            self.bytes_read += len(chunk)
+            offset += keep
+            buf = buf[keep:] + chunk
+            view = memoryview(buf)
+            pos = 0
+
+    def throughput(self):
+        "GB per second read from the dump"
+        if not self.seconds:
+            return 0
+        return self.bytes_read / 1_000_000_000 / self.seconds
+
+    def report(self):
+        print(f'scanned {self.pages} pages, {round(self.bytes_read / 1_000_000_000, 3)} GB '
+              f'in {round(self.seconds, 1)} seconds ({round(self.throughput(), 3)} GB/s)')
+
 def page_generator(f, current_page=0, sample=1.0):
-    start_idx = 0
-    end_idx = 0
-    current_page = 0
-
-    for line in f:
-        if b'<page>' in line and start_idx != end_idx:
-            f.seek(start_idx)
-            current_page += 1
-            yield start_idx, end_idx, f.read(end_idx - start_idx)
-            start_idx = end_idx
-            if sample < 1.0 and current_page > PAGES_ESTIMATE * sample:
-                print("reached end of sample, ", current_page, "pages found, idx at", start_idx)
-                break
-        else:
-            end_idx = end_idx + len(line)
+    "Yield (start_idx, end_idx, raw bytes) for every page in the dump"
+    for start_idx, end_idx, page in PageScanner(f, sample=sample):
+        yield start_idx, end_idx, bytes(page)
+
+def page_aligned_ranges(xml_path, n, start=0, stop=None):
+    """
+    Split the dump (from start to stop) into at most n (start, stop) byte
+    ranges, each beginning at a <page> tag so no page is cut in two
+    """
+    size = os.path.getsize(xml_path)
+    if stop is None or stop > size:
+        stop = size
+    boundaries = [start]
+    with open(xml_path, 'rb') as f:
+        for k in range(1, n):
+            f.seek(start + (stop - start) * k // n)
+            idx = f.tell()
+            tail = b''
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    idx = stop
+                    break
+                found = (tail + chunk).find(b'<page>')
+                if found != -1:
+                    idx += found - len(tail)
+                    break
+                tail = chunk[-len(b'<page>')+1:]
+                idx += len(chunk)
+            if idx > boundaries[-1] and idx < stop:
+                boundaries.append(idx)
+    boundaries.append(stop)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def page_revision(page):
+    "(page id, revision sha1) of a raw page; either is None if the page lacks it"
+    match = _page_id.search(page)
+    page_id = int(match.group(1)) if match else None
+    match = _sha1.search(page)
+    sha1 = match.group(1).decode('ascii') if match else None
+    return page_id, sha1
+
+def extract_page(page_num, start_idx, end_idx, page):
+    """
+    Pull the title and Coord data out of a page that mentions a Coord template.
+    Returns the indices row and coords row, or None if no coordinates were found
+    """
+    text = extract_text(page)
+    if text is None:
+        return None
+    templates = scan_templates(text, COORD_TEMPLATES)
+    if not templates:
+        return None
+    coord_string = title_coord([template.wikitext() for template in templates])
+    title = extract_title(page)
+    coords_dict = coord_string_to_dict(coord_string)
+    coords_dict['title'] = title
+    coords_dict['page_num'] = page_num
+    indices_row = (title, coord_string, int(page_num), int(start_idx), int(end_idx))
+    return indices_row, coords_dict
+
+def template_rows(extractor, page):
+    "(table, row) of each template of the extractor's schemas in a raw page"
+    if not extractor.mentions(page):
+        return []
+    text = extract_text(page)
+    if text is None:
+        return []
+    return extractor.extract(text)
+
+def _parse_batch(batch, extractor):
+    "(page_num, start_idx, end_idx, revision, Coord hit, extract, template rows) of each page in a batch"
+    rows = []
+    for page_num, (start_idx, end_idx, page) in batch:
+        hit = coord_tag.search(page) is not None
+        extract = extract_page(page_num, start_idx, end_idx, page) if hit else None
+        rows.append((page_num, start_idx, end_idx, page_revision(page), hit, extract,
+                     template_rows(extractor, page)))
+    return rows
+
+def _extract_batch(batch, extractor):
+    "(page_num, end_idx, template rows) of each page in a batch"
+    return [(page_num, end_idx, template_rows(extractor, page)) for page_num, (_, end_idx, page) in batch]
+
+def _load_shard(args):
+    "Worker for Indexer.load: page numbers are relative to the start of the range"
+    xml_path, start, stop, extractor = args
+    extracts = []
+    revisions = []
+    templates = []
+    offsets = array('q')
+    hits = 0
+    failures = 0
+    with open(xml_path, 'rb') as f:
+        scanner = PageScanner(f, start=start, stop=stop)
+        for i, (start_idx, end_idx, page) in enumerate(scanner):
+            offsets.extend((start_idx, end_idx))
+            revisions.append((i,) + page_revision(page))
+            if coord_tag.search(page):
+                hits += 1
+                extract = extract_page(i, start_idx, end_idx, page)
+                if extract:
+                    extracts.append(extract)
+                else:
+                    failures += 1
+            for table, row in template_rows(extractor, page):
+                templates.append((i, table, row))
+    return scanner.pages, hits, extracts, failures, offsets, revisions, templates
 
 class Indexer:
     logger = logging.getLogger('wikidump.model.Dump')
 
-    def __init__(self, xml_path=None, scratch_folder='./py3'):
+    def __init__(self, xml_path=None, scratch_folder='./py3', use_mmap=False, cache_bytes=CACHE_BYTES):
         self.xml_path = os.path.abspath(xml_path)
-        self.xml_file = open(self.xml_path, 'rb')
-        # May want to hash the file instead for portability
+        if is_multistream(self.xml_path):
+            # read pages straight out of the compressed dump
+            self.multistream = MultistreamDump(self.xml_path)
+            self.reader = None
+        else:
+            self.multistream = None
+            # with use_mmap, pages are memoryviews into the mapped dump
+            self.reader = open_reader(self.xml_path, use_mmap)
+        self.use_mmap = use_mmap
+        # the cache is checked against a fingerprint of the dump, see _validate_cache
         self.cache_path = scratch_folder
+        # parsed pages, for callers that fetch the same pages repeatedly
+        self.page_cache = PageCache(cache_bytes)
 
         self.logger.info("============================================")
         self.logger.info("Loading data for %s", self.xml_path)
@@ -45,11 +283,22 @@ class Indexer:
 
         self.metadata = self._open_shelf('metadata')
 
+        # Mapping from page number to position in file, without going through sqlite
+        self.offsets = None
+        if not self.multistream:
+            self.offsets = OffsetTable.open(self.cache_path)
+
         # Mapping from page index to position in file
         self.db = self._open_db()
         self.cursor = self.db.cursor()
 
         # self.page_offsets = self._open_shelf('page_offsets')
+        self._create_tables()
+        self._validate_cache()
+
+        print("Ready. Metadata:", [(key,self.metadata[key]) for key in self.metadata.keys()])
+
+    def _create_tables(self):
         try:
             self.cursor.execute('''SELECT Count(*) from indices''').fetchone()[0]
             self.cursor.execute('''SELECT Count(*) from coords''').fetchone()[0]
@@ -57,34 +306,90 @@ class Indexer:
             print("creating a new table")
             self.cursor.execute('''CREATE TABLE indices
                     (title TEXT, coords TEXT, page_num INTEGER PRIMARY KEY, start_idx INTEGER, end_idx INTEGER)''')
-            self.cursor.execute(utils.get_coords_db_create_string())
+            self.cursor.execute(coords_table_sql())
+        # page id and revision hash of every page in the dump, for Indexer.update
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS revisions
+                (page_num INTEGER PRIMARY KEY, page_id INTEGER, sha1 TEXT)''')
 
-        print("Ready. Metadata:", [(key,self.metadata[key]) for key in self.metadata.keys()])
+    def _validate_cache(self):
+        "Make sure the scratch folder was built from this dump, and empty it if not"
+        stored = self.metadata.get('fingerprint')
+        fingerprint = dump_fingerprint(self.xml_path, known=stored)
+        if stored is not None and stored['digest'] != fingerprint['digest']:
+            print(f"{self.cache_path} was built from a different dump, discarding it")
+            self.logger.warning("stale cache in %s, resetting", self.cache_path)
+            for table in ['indices', 'coords', 'titles', 'revisions', spatial.RTREE_TABLE] + self._template_tables():
+                self.cursor.execute(f'DROP TABLE IF EXISTS {quote_identifier(table)}')
+            self.db.commit()
+            if self.offsets is not None:
+                self.offsets.close()
+                self.offsets = None
+            if os.path.exists(self._offsets_path()):
+                os.remove(self._offsets_path())
+            self.metadata.clear()
+            self._create_tables()
+        elif stored is None and self.metadata.get('size'):
+            print("no fingerprint stored for this cache; assuming it belongs to", self.xml_path)
+        self.metadata['fingerprint'] = fingerprint
+        self.metadata.sync()
 
     def _open_db(self):
         path = os.path.join(self.cache_path, 'index.db')
         print('opening', path)
         return sqlite3.connect(path)
 
+    def _offsets_path(self):
+        return os.path.join(self.cache_path, OFFSETS_FILENAME)
+
     def _open_shelf(self, name):
         "Open a shelf-file in a pre-determined location by name"
         path = os.path.join(self.cache_path, name)
         return shelve.open(path)
 
+    def _open_dump(self):
+        "Open the dump for a sequential pass, decompressing it on the fly if needed"
+        if self.multistream:
+            return bz2.open(self.xml_path, 'rb')
+        return open(self.xml_path, 'rb')
+
+    def get_raw_bytes(self, page_num):
+        "Get raw xml for a page as bytes, or as a memoryview when the dump is memory-mapped"
+        if self.multistream:
+            return self.multistream.get_raw_bytes(page_num)
+        start_idx,end_idx = self.get_offsets(page_num)
+        return self.reader.read(start_idx, end_idx)
+
     def get_raw(self, page_num):
         "Get raw xml dump data for a given page number"
-        f = self.xml_file
-        start_idx,end_idx = self.get_offsets(page_num)
-        f.seek(start_idx)
-        return f.read(end_idx - start_idx).decode('utf-8')
+        return str(self.get_raw_bytes(page_num), 'utf-8')
 
     def get_page_by_num(self, page_num):
         "Get the full text of a page by page_num"
-        return Page(self.get_raw(page_num))
+        return self.get_pages_by_num([page_num])[0]
+
+    def get_pages_by_num(self, page_nums):
+        "Pages for a list of page numbers, read in file order and cached"
+        return fetch_pages(self.page_cache, page_nums, self.get_raw_bytes, Page)
+
+    def get_pages(self, titles):
+        "Pages for a list of titles, with None for titles that aren't in the titles table"
+        page_nums = lookup_page_nums(self.db, titles)
+        found = [page_nums[title] for title in titles if title in page_nums]
+        pages = dict(zip(found, self.get_pages_by_num(found)))
+        return [pages[page_nums[title]] if title in page_nums else None for title in titles]
+
+    def get_page(self, title):
+        "Return a Page object for the page of the given title, or None"
+        return self.get_pages([title])[0]
 
     def get_offsets(self, page_num):
+        if self.offsets is not None:
+            try:
+                return self.offsets.get(page_num)
+            except KeyError:
+                raise Exception("cannot get idx for page", page_num)
         result = self.cursor\
-            .execute(f'SELECT start_idx,end_idx FROM indices WHERE page_num={page_num}')\
+            .execute('SELECT start_idx,end_idx FROM indices WHERE page_num=?', (page_num,))\
             .fetchone()
         if result is None:
             raise Exception("cannot get idx for page", page_num)
@@ -94,49 +399,413 @@ class Indexer:
         page_nums = self.cursor.execute('''SELECT page_num FROM coords WHERE display="inline,title"''').fetchall()
         return [int(page_num[0]) for page_num in page_nums]
 
-    def load(self, sample=1.):
+    def pages_in_bbox(self, south, west, north, east):
+        "(page_num, lat, lon) of the geotagged pages in a bounding box; west > east crosses the antimeridian"
+        return spatial.pages_in_bbox(self.db, south, west, north, east)
+
+    def pages_near(self, lat, lon, radius_km, limit=10):
+        "(page_num, lat, lon, distance_km) of up to limit pages within radius_km, nearest first"
+        return spatial.pages_near(self.db, lat, lon, radius_km, limit)
+
+    def _insert_extract(self, indices_row, coords_dict):
+        # _start_load has emptied the tables from the first page loaded on
+        self.writer.insert("INSERT INTO indices VALUES (?,?,?,?,?)", indices_row)
+        self.writer.insert_dict('coords', coords_dict)
+
+    @property
+    def template_schemas(self):
+        "TemplateSchemas of the template tables in this index"
+        return [TemplateSchema.from_config(config) for config in self.metadata.get('templates', [])]
+
+    def _template_tables(self):
+        return [schema.table for schema in self.template_schemas]
+
+    def _register_templates(self, schemas):
+        "Record schemas in the metadata, replacing earlier schemas of the same templates"
+        configs = {config['name']: config for config in self.metadata.get('templates', [])}
+        for schema in schemas:
+            configs[schema.name] = schema.config()
+        self.metadata['templates'] = list(configs.values())
+        self.metadata.sync()
+
+    def _insert_templates(self, writer, extractor, page_num, rows):
+        for table, row in rows:
+            writer.insert(extractor.by_table[table].insert_sql(), (page_num,) + row)
+
+    def load(self, sample=1., workers=1, resume=False, templates=None):
+        """
+        Scan the dump and store every page with coordinates in the indices and
+        coords tables. With workers > 1 the dump is split into page-aligned
+        byte ranges that are processed in parallel. Progress is checkpointed,
+        and resume=True picks an interrupted load up from the last checkpoint.
+        Templates described by a list of extraction.TemplateSchema are stored
+        in their own tables in the same pass; without templates, those of an
+        earlier load or extract_templates are extracted again.
+        """
         start = time.time()
-        pg = page_generator(open(self.xml_path, 'rb'), sample=sample)
-        coords_count = 0
-        successes = 0
-        failures = 0
-        for i,page in enumerate(pg):
-            start_idx, end_idx, page = page
-            if utils.tag_finder(page, ['Coord', 'coord']):
-                coords_count += 1
-                page_text = page.decode('utf-8')
-                data_extract = utils.page_to_geographic_db(page_text)
-                if data_extract['coords']:
-                    try:
-                        self.cursor.execute(f"INSERT INTO indices VALUES (?,?,?,?,?)",
-                            (data_extract['title'], data_extract['coords'], int(i),
-                             int(start_idx), int(end_idx))
-                        )
-                    except sqlite3.IntegrityError: # has already been inserted
-                        pass
-                    coords_dict = utils.coord_string_to_dict(data_extract['coords'])
-                    coords_dict['title'] = data_extract['title']
-                    coords_dict['page_num'] = i
-                    qstring = f'''INSERT INTO coords
-                        ({",".join(coords_dict.keys())}) VALUES
-                        ({",".join(["?" for item in coords_dict.values()])})'''
-                    try:
-                        self.cursor.execute(qstring, list(coords_dict.values()))
-                    except sqlite3.IntegrityError: # has already been inserted
-                        pass
-                    successes += 1
-                else:
-                    failures += 1
-                    # print(data_extract['title'], 'coord tag not found')
-            if coords_count % 1_000 == 0:
-                self.db.commit()
-            print(f'index {utils.readable_int(i)}, successes {utils.readable_int(coords_count)}, failures {utils.readable_int(failures)}   ', end='\r')
+        if workers > 1 and self.multistream:
+            print("can't split a compressed dump into byte ranges, loading on one core")
+            workers = 1
+        checkpoint = self._start_load(resume)
+        if templates is not None:
+            self._register_templates(templates)
+        # every registered template table is refilled, not only those passed in
+        self.extractor = TemplateExtractor(self.template_schemas)
+        # a resumed load keeps the rows written before its checkpoint
+        self.extractor.create_tables(self.db, replace=checkpoint.page_num == 0)
+        progress = metrics.stage('Indexer.load', total_bytes=int(os.path.getsize(self.xml_path) * sample))
+        progress.advance(0, checkpoint.byte_offset)
+        self.writer = BulkWriter(self.db, progress=progress)
+        self.writer.defer_index('coords_display', 'coords', ['display'])
+        self.writer.defer_index('revisions_page_id', 'revisions', ['page_id'])
+        if self.offsets is not None:
+            self.offsets.close()
+        # a compressed dump is read through its own index, not by offset
+        self.offsets_writer = None
+        if not self.multistream:
+            self.offsets_writer = OffsetTableWriter(self._offsets_path(), start_page=checkpoint.page_num)
+        if workers > 1:
+            pages, coords_count, failures = self._load_parallel(sample, workers, checkpoint, progress)
+        else:
+            pages, coords_count, failures = self._load_serial(sample, checkpoint, progress)
+        self.writer.finish()
+        progress.finish()
+        spatial.create_spatial_index(self.db)
+        if self.offsets_writer:
+            self.offsets_writer.close()
+            self.offsets = OffsetTable.open(self.cache_path)
+        checkpoint.complete = True
+        checkpoint.save(self.metadata)
         print(f"iterating {round(sample*100,2)}% of pages took {round((time.time()-start)/60,2)} minutes")
-        print(round(100*coords_count/i,2), '% contained coordinates tag')
+        print(round(100*coords_count/max(pages, 1),2), '% contained coordinates tag')
         self.metadata['size'] = coords_count
         self.db.commit()
         self.create_title_db()
 
+    def _start_load(self, resume):
+        "Checkpoint to start loading from, with the tables rolled back to it"
+        checkpoint = Checkpoint.read(self.metadata)
+        fresh = not resume or checkpoint is None or checkpoint.complete
+        if fresh:
+            if resume:
+                print("no unfinished load to resume, starting from the beginning")
+            Checkpoint.clear(self.metadata)
+            checkpoint = Checkpoint()
+        else:
+            print("resuming load from", checkpoint)
+        # rows from the checkpoint on will be written again; a fresh load
+        # empties the tables, whatever numbering an earlier load used
+        for table in ['indices', 'coords', 'revisions'] + self._template_tables():
+            table = quote_identifier(table)
+            if fresh:
+                self.cursor.execute(f'DELETE FROM {table}')
+            else:
+                self.cursor.execute(f'DELETE FROM {table} WHERE page_num >= ?', (checkpoint.page_num,))
+        self.db.commit()
+        if fresh:
+            return checkpoint
+        rows = (self._count_rows('indices'), self._count_rows('coords'))
+        if rows != (checkpoint.indices_rows, checkpoint.coords_rows):
+            print("warning: tables hold", rows, "rows, the checkpoint expected",
+                  (checkpoint.indices_rows, checkpoint.coords_rows))
+        return checkpoint
+
+    def _count_rows(self, table):
+        return self.cursor.execute(f'SELECT Count(*) FROM {table}').fetchone()[0]
+
+    def _save_checkpoint(self, checkpoint, byte_offset, page_num, coords_count, failures):
+        "Write everything up to page_num to disk, then record it"
+        self.writer.flush()
+        # copy the WAL into index.db, syncing both
+        self.db.execute('PRAGMA wal_checkpoint(FULL)')
+        if self.offsets_writer:
+            self.offsets_writer.sync()
+        checkpoint.byte_offset = byte_offset
+        checkpoint.page_num = page_num
+        checkpoint.coords_count = coords_count
+        checkpoint.failures = failures
+        checkpoint.indices_rows = self._count_rows('indices')
+        checkpoint.coords_rows = self._count_rows('coords')
+        checkpoint.save(self.metadata)
+
+    def _load_serial(self, sample, checkpoint, progress):
+        """
+        The dump is read in one thread and pages are parsed in another, while
+        this one writes the results, so reading, parsing and writing overlap
+        """
+        with self._open_dump() as f:
+            scanner = PageScanner(f, sample=sample,
+                                  start=checkpoint.byte_offset, pages=checkpoint.page_num)
+            pages = batched(enumerate(scanner, start=checkpoint.page_num), PARSE_BATCH)
+            coords_count = checkpoint.coords_count
+            failures = checkpoint.failures
+            # batches hold memoryviews into the scanner's chunks, so few are queued
+            parse = partial(_parse_batch, extractor=self.extractor)
+            with Pipeline(pages, [Step('parse', parse)], queue_size=4, ordered=True,
+                          progress=progress) as pipeline:
+                for rows in pipeline:
+                    for i, start_idx, end_idx, revision, hit, extract, templates in rows:
+                        if self.offsets_writer:
+                            self.offsets_writer.write(i, start_idx, end_idx)
+                        self.writer.insert(INSERT_REVISION, (i,) + revision)
+                        if hit:
+                            coords_count += 1
+                            if extract:
+                                self._insert_extract(*extract)
+                            else:
+                                failures += 1
+                        self._insert_templates(self.writer, self.extractor, i, templates)
+                        if (i + 1) % CHECKPOINT_PAGES == 0:
+                            with progress.timer('checkpoint'):
+                                self._save_checkpoint(checkpoint, end_idx, i + 1, coords_count, failures)
+                    progress.advance(len(rows), rows[-1][2] - rows[0][1])
+                    progress.gauge('coords', coords_count)
+                    progress.gauge('failures', failures)
+        scanner.report()
+        return scanner.pages, coords_count, failures
+
+    def _load_parallel(self, sample, workers, checkpoint, progress):
+        stop = None
+        if sample < 1.0:
+            stop = int(os.path.getsize(self.xml_path) * sample)
+        ranges = page_aligned_ranges(self.xml_path, workers * 4, start=checkpoint.byte_offset, stop=stop)
+        print(f'loading {len(ranges)} byte ranges with {workers} processes')
+        pages = checkpoint.page_num
+        coords_count = checkpoint.coords_count
+        failures = checkpoint.failures
+        # at most two finished shards wait to be written per worker
+        with Pipeline([(self.xml_path, a, b, self.extractor) for a,b in ranges],
+                      [Step('load', _load_shard, workers=workers, kind='process')],
+                      queue_size=workers * 2, ordered=True, progress=progress) as shards:
+            # shards come back in file order, so page numbers are offset by the
+            # number of pages in all earlier shards
+            for (range_start, range_stop), shard in zip(ranges, shards):
+                shard_pages, shard_hits, extracts, shard_failures, offsets, revisions, templates = shard
+                self.offsets_writer.extend(offsets)
+                for i, page_id, sha1 in revisions:
+                    self.writer.insert(INSERT_REVISION, (i + pages, page_id, sha1))
+                for indices_row, coords_dict in extracts:
+                    page_num = indices_row[2] + pages
+                    indices_row = indices_row[:2] + (page_num,) + indices_row[3:]
+                    coords_dict['page_num'] = page_num
+                    self._insert_extract(indices_row, coords_dict)
+                for i, table, row in templates:
+                    self._insert_templates(self.writer, self.extractor, i + pages, [(table, row)])
+                pages += shard_pages
+                coords_count += shard_hits
+                failures += shard_failures
+                with progress.timer('checkpoint'):
+                    self._save_checkpoint(checkpoint, range_stop, pages, coords_count, failures)
+                progress.advance(shard_pages, range_stop - range_start)
+                progress.gauge('coords', coords_count)
+                progress.gauge('failures', failures)
+        return pages, coords_count, failures
+
+    def update(self, new_xml_path):
+        """
+        Bring the index up to date with a newer dump of the same wiki in one
+        streaming pass. Pages are matched by page id: rows of pages whose
+        revision sha1 hasn't changed are kept and renumbered, and only added
+        and changed pages are re-extracted. Returns an IndexUpdate, which
+        update_doc_freq in tokenize uses to patch the document frequencies.
+        The old dump has to stay around until then.
+        """
+        start = time.time()
+        new_xml_path = os.path.abspath(new_xml_path)
+        if not self._count_rows('revisions'):
+            raise Exception("no revisions recorded for this index, it has to be rebuilt with load()")
+        if not self.multistream and self.offsets is None:
+            self.build_offset_table()
+        new_multistream = is_multistream(new_xml_path)
+        new_offsets_path = self._offsets_path() + '.new'
+
+        print("scanning", new_xml_path)
+        self.cursor.execute('DROP TABLE IF EXISTS new_revisions')
+        self.cursor.execute('''CREATE TABLE new_revisions
+                (page_num INTEGER PRIMARY KEY, page_id INTEGER, sha1 TEXT, start_idx INTEGER, end_idx INTEGER)''')
+        writer = BulkWriter(self.db)
+        writer.defer_index('new_revisions_page_id', 'new_revisions', ['page_id'])
+        writer.defer_index('revisions_page_id', 'revisions', ['page_id'])
+        offsets_writer = None if new_multistream else OffsetTableWriter(new_offsets_path)
+        f = bz2.open(new_xml_path, 'rb') if new_multistream else open(new_xml_path, 'rb')
+        with f:
+            scanner = PageScanner(f)
+            for i, (start_idx, end_idx, page) in enumerate(scanner):
+                if offsets_writer:
+                    offsets_writer.write(i, start_idx, end_idx)
+                writer.insert("INSERT INTO new_revisions VALUES (?,?,?,?,?)",
+                              (i,) + page_revision(page) + (start_idx, end_idx))
+        writer.finish()
+        if offsets_writer:
+            offsets_writer.close()
+        scanner.report()
+
+        # unchanged pages, from their old page number to their new one
+        self.cursor.execute('DROP TABLE IF EXISTS temp.page_map')
+        self.cursor.execute('''CREATE TEMP TABLE page_map
+                (old INTEGER PRIMARY KEY, new INTEGER UNIQUE, start_idx INTEGER, end_idx INTEGER)''')
+        self.cursor.execute('''INSERT INTO page_map
+                SELECT r.page_num, n.page_num, n.start_idx, n.end_idx
+                FROM revisions r JOIN new_revisions n ON r.page_id = n.page_id
+                WHERE r.sha1 = n.sha1''')
+        update = IndexUpdate(self.xml_path, new_xml_path, os.path.join(self.cache_path, 'previous'))
+        update.unchanged = self._count_rows('page_map')
+        update.changed = self.cursor.execute('''SELECT Count(*) FROM revisions r JOIN new_revisions n
+                ON r.page_id = n.page_id WHERE r.page_num NOT IN (SELECT old FROM page_map)''').fetchone()[0]
+        update.deleted = self._count_rows('revisions') - update.unchanged - update.changed
+        update.added = self._count_rows('new_revisions') - update.unchanged - update.changed
+        update.removed_geo = [page_num for page_num, in self.cursor.execute(
+            '''SELECT page_num FROM coords WHERE display="inline,title"
+               AND page_num NOT IN (SELECT old FROM page_map) ORDER BY page_num''')]
+        print(f'{update.unchanged} pages unchanged, {update.changed} changed, '
+              f'{update.added} added, {update.deleted} deleted')
+
+        # re-extract added and changed pages from the new dump
+        extracts = []
+        templates = []
+        extractor = TemplateExtractor(self.template_schemas)
+        hits = 0
+        source = MultistreamDump(new_xml_path) if new_multistream else open_reader(new_xml_path)
+        reparse = self.cursor.execute('''SELECT page_num, start_idx, end_idx FROM new_revisions
+                WHERE page_num NOT IN (SELECT new FROM page_map) ORDER BY page_num''').fetchall()
+        for page_num, start_idx, end_idx in reparse:
+            if new_multistream:
+                page = source.get_raw_bytes(page_num)
+            else:
+                page = source.read(start_idx, end_idx)
+            if coord_tag.search(page):
+                hits += 1
+                extract = extract_page(page_num, start_idx, end_idx, page)
+                if extract:
+                    title = extract_title(page)
+                    extracts.append(extract + ((title, start_idx, end_idx, page_num),))
+            rows = template_rows(extractor, page)
+            if rows:
+                templates.append((page_num, rows))
+        source.close()
+        print(f'reparsed {len(reparse)} pages, {hits} contained coordinates tag')
+
+        has_titles = self.cursor.execute(
+            "SELECT Count(*) FROM sqlite_master WHERE type='table' AND name='titles'").fetchone()[0]
+        # tables whose rows hold page offsets, and those that only hold page numbers
+        offset_tables = ['indices'] + (['titles'] if has_titles else [])
+        tables = offset_tables + ['coords'] + list(extractor.by_table)
+        with self.db:
+            for table in tables:
+                self.db.execute(f'DELETE FROM {quote_identifier(table)} WHERE page_num NOT IN (SELECT old FROM page_map)')
+            # renumber through negative page numbers, so that no two rows ever share one
+            for table in tables:
+                quoted = quote_identifier(table)
+                if table not in offset_tables:
+                    self.db.execute(f'''UPDATE {quoted} SET page_num =
+                            (SELECT -1 - new FROM page_map WHERE old = {quoted}.page_num)''')
+                else:
+                    self.db.execute(f'''UPDATE {quoted} SET (page_num, start_idx, end_idx) =
+                            (SELECT -1 - new, start_idx, end_idx FROM page_map WHERE old = {quoted}.page_num)''')
+                self.db.execute(f'UPDATE {quoted} SET page_num = -1 - page_num')
+            for indices_row, coords_dict, titles_row in extracts:
+                # reparsed pages have new page numbers that no kept row has
+                self.db.execute("INSERT INTO indices VALUES (?,?,?,?,?)", indices_row)
+                self.db.execute(insert_sql('coords', list(coords_dict.keys())), list(coords_dict.values()))
+                if has_titles and coords_dict.get('display') == 'inline,title':
+                    self.db.execute("INSERT INTO titles VALUES (?,?,?,?)", titles_row)
+            for page_num, rows in templates:
+                for table, row in rows:
+                    self.db.execute(extractor.by_table[table].insert_sql(), (page_num,) + row)
+            self.db.execute('DELETE FROM revisions')
+            self.db.execute('INSERT INTO revisions SELECT page_num, page_id, sha1 FROM new_revisions')
+            self.db.execute('DROP TABLE new_revisions')
+            self.db.execute('DROP TABLE temp.page_map')
+        spatial.create_spatial_index(self.db)
+        update.added_geo = [indices_row[2] for indices_row, coords_dict, titles_row in extracts
+                            if coords_dict.get('display') == 'inline,title']
+
+        # page numbers now refer to the new dump
+        self.page_cache.clear()
+        # keep the old offsets for reading the old versions of pages
+        if self.offsets is not None:
+            self.offsets.close()
+            self.offsets = None
+        if not self.multistream:
+            os.makedirs(update.previous_folder, exist_ok=True)
+            os.replace(self._offsets_path(), os.path.join(update.previous_folder, OFFSETS_FILENAME))
+        if self.reader is not None:
+            self.reader.close()
+        if self.multistream is not None:
+            self.multistream.close()
+        self.xml_path = new_xml_path
+        if new_multistream:
+            self.multistream = MultistreamDump(self.xml_path)
+            self.reader = None
+        else:
+            os.replace(new_offsets_path, self._offsets_path())
+            self.multistream = None
+            self.reader = open_reader(self.xml_path, self.use_mmap)
+            self.offsets = OffsetTable.open(self.cache_path)
+
+        pages = self._count_rows('revisions')
+        coords_count = self._count_rows('coords')
+        Checkpoint(page_num=pages, coords_count=coords_count, complete=True).save(self.metadata)
+        self.metadata['size'] = coords_count
+        self.metadata['fingerprint'] = dump_fingerprint(self.xml_path)
+        self.metadata.sync()
+        print(f"updating the index took {round((time.time()-start)/60,2)} minutes")
+        return update
+
+    def extract_templates(self, templates, sample=1.):
+        """
+        Fill the tables of a list of extraction.TemplateSchema in one pass
+        over the dump, for an index that is already loaded. Page numbers are
+        those of load(). The schemas are kept, so that a later load() or
+        update() keeps their tables up to date.
+        """
+        start = time.time()
+        extractor = TemplateExtractor(templates)
+        extractor.create_tables(self.db)
+        self._register_templates(templates)
+        progress = metrics.stage('Indexer.extract_templates', total_bytes=int(os.path.getsize(self.xml_path) * sample))
+        writer = BulkWriter(self.db, progress=progress)
+        rows_written = 0
+        scanner = PageScanner(self._open_dump(), sample=sample)
+        pages = batched(enumerate(scanner), PARSE_BATCH)
+        extract = partial(_extract_batch, extractor=extractor)
+        bytes_done = 0
+        with Pipeline(pages, [Step('extract', extract)], queue_size=4, ordered=True,
+                      progress=progress) as pipeline:
+            for batch in pipeline:
+                for page_num, end_idx, rows in batch:
+                    self._insert_templates(writer, extractor, page_num, rows)
+                    rows_written += len(rows)
+                progress.advance(len(batch), end_idx - bytes_done)
+                bytes_done = end_idx
+                progress.gauge('rows', rows_written)
+        scanner.f.close()
+        writer.finish()
+        progress.finish()
+        scanner.report()
+        print(f"extracted {rows_written} templates ({', '.join(extractor.schemas)}) "
+              f"in {round((time.time()-start)/60,2)} minutes")
+
+    def build_offset_table(self):
+        "Write the offset table from the indices table, for an index built before it existed"
+        if self.offsets is not None:
+            self.offsets.close()
+        rows = self.db.execute('SELECT page_num, start_idx, end_idx FROM indices ORDER BY page_num')
+        with OffsetTableWriter(self._offsets_path()) as offsets:
+            for page_num, start_idx, end_idx in rows:
+                offsets.write(page_num, start_idx, end_idx)
+        self.offsets = OffsetTable.open(self.cache_path)
+
+    def ensure_offset_table(self):
+        """
+        Build the offset table if there isn't one, before pages are read on
+        another thread: without it get_offsets goes through this thread's
+        sqlite connection
+        """
+        if not self.multistream and self.offsets is None:
+            print("building the offset table from the indices table")
+            self.build_offset_table()
+
     def create_title_db(self):
         print("Creating title dictionary")
         try:
@@ -144,56 +813,159 @@ class Indexer:
         except sqlite3.OperationalError:
             pass
         self.cursor.execute('CREATE TABLE titles\
-                            (title TEXT PRIMARY KEY, start_idx INTEGER, end_idx INTEGER, page_num INTEGER)')
-        total_time = 0
-        start_ts = time.time()
+                            (title TEXT, start_idx INTEGER, end_idx INTEGER, page_num INTEGER)')
         page_numbers = self.get_page_numbers()
-        for i,page_num in enumerate(page_numbers):
+        progress = metrics.stage('Indexer.create_title_db', total=len(page_numbers))
+        writer = BulkWriter(self.db, progress=progress)
+        writer.defer_index('titles_title', 'titles', ['title'])
+        insert = "INSERT INTO titles VALUES (?,?,?,?)"
+        for page_num in page_numbers:
+            progress.advance()
             try:
-                title = Page(self.get_raw(page_num)).title
+                title = extract_title(self.get_raw_bytes(page_num))
             except Exception as e:
                 print(f'{page_num} caused an error:', str(e))
-            start_idx,end_idx = self.cursor.execute(f'SELECT start_idx,end_idx FROM indices WHERE page_num={page_num}').fetchone()
-            try:
-                self.cursor.execute(
-                    f"INSERT INTO titles VALUES (?,?,?,?)",
-                    (title, start_idx, end_idx, page_num)
-                )
-            except sqlite3.OperationalError as e:
-                print(e, title)
-                return
-            except sqlite3.IntegrityError as e:
-                print(e, title)
-            if i % 1000 == 0:
-                total_time = time.time() - start_ts
-                self.db.commit()
-                print(f' {round((100*i/len(page_numbers)), 3):10}%\t{round(1000*total_time/(i+1), 2)}ms / page  ', end='\r')
-        self.db.commit()
+                continue
+            start_idx,end_idx = self.get_offsets(page_num)
+            writer.insert(insert, (title, start_idx, end_idx, page_num))
+        writer.finish()
+        progress.finish()
+
+class PageReader:
+    """
+    Read-only page access over an existing scratch folder, for worker processes:
+    unlike Indexer it doesn't open the metadata shelf or write to index.db
+    """
+    def __init__(self, xml_path, scratch_folder='./py3', use_mmap=True):
+        self.xml_path = os.path.abspath(xml_path)
+        self.cache_path = scratch_folder
+        self.multistream = None
+        self.offsets = None
+        self.db = None
+        if is_multistream(self.xml_path):
+            self.multistream = MultistreamDump(self.xml_path)
+            return
+        self.reader = open_reader(self.xml_path, use_mmap)
+        self.offsets = OffsetTable.open(self.cache_path)
+        if self.offsets is None:
+            path = os.path.abspath(os.path.join(self.cache_path, 'index.db'))
+            # callers that read from several threads serialize access themselves, see PageServer.read_lock
+            self.db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+
+    def get_raw_bytes(self, page_num):
+        if self.multistream:
+            return self.multistream.get_raw_bytes(page_num)
+        if self.offsets is not None:
+            start_idx, end_idx = self.offsets.get(page_num)
+        else:
+            start_idx, end_idx = self.db.execute(
+                'SELECT start_idx,end_idx FROM indices WHERE page_num=?', (page_num,)
+            ).fetchone()
+        return self.reader.read(start_idx, end_idx)
+
+    def get_page_by_num(self, page_num):
+        return Page(self.get_raw_bytes(page_num))
+
+class IndexUpdate:
+    """
+    What Indexer.update changed: counts of unchanged, changed, added and
+    deleted pages, the geo pages whose old version went away (removed_geo,
+    old page numbers) and the geo pages that were extracted anew (added_geo,
+    new page numbers)
+    """
+    def __init__(self, old_xml_path, xml_path, previous_folder):
+        self.old_xml_path = old_xml_path
+        self.xml_path = xml_path
+        # holds the offsets of the old dump
+        self.previous_folder = previous_folder
+        self.unchanged = 0
+        self.changed = 0
+        self.added = 0
+        self.deleted = 0
+        self.removed_geo = []
+        self.added_geo = []
+
+    def old_reader(self):
+        "Page access to the old dump, by old page number"
+        return PageReader(self.old_xml_path, self.previous_folder)
+
+    def __str__(self):
+        return (f'{self.unchanged} unchanged, {self.changed} changed, {self.added} added, '
+                f'{self.deleted} deleted; {len(self.removed_geo)} geo pages removed, '
+                f'{len(self.added_geo)} added')
 
 class Page:
+    """
+    A page of the dump, parsed on demand: title, text, cleaned text, coords
+    and the DOM are each computed the first time they are used.
+    """
     def __init__(self, string):
-        self.xml = string
-        self.dom = etree.fromstring(string)
-        self._full_text = self.dom.find('revision').find('text').text
-        self.text = remove_metadata(self._full_text)
-        self.title = self.dom.find('title').text
+        # str or bytes, only decoded if .xml is used; a memoryview into the
+        # mapped dump is copied, so cached pages don't keep the map open
+        if isinstance(string, memoryview):
+            string = bytes(string)
+        self._xml = string
+        self._dom = None
+        self._title = _unset
+        self._wikitext = _unset
+        self._text = None
+        self._coords = None
+
+    @property
+    def xml(self):
+        if not isinstance(self._xml, str):
+            self._xml = str(self._xml, 'utf-8')
+        return self._xml
+
+    @property
+    def dom(self):
+        if self._dom is None:
+            parser = etree.XMLParser()
+            parser.feed(self._xml)
+            self._dom = parser.close()
+        return self._dom
+
+    @property
+    def title(self):
+        if self._title is _unset:
+            self._title = extract_title(self._xml)
+        return self._title
+
+    @property
+    def full_text(self):
+        "The wikitext of the page"
+        if self._wikitext is _unset:
+            self._wikitext = extract_text(self._xml)
+        return self._wikitext
+
+    # older name, still used from notebooks
+    _full_text = full_text
+
+    @property
+    def text(self):
+        "The wikitext with templates, tags and markup removed"
+        if self._text is None:
+            self._text = remove_metadata(self.full_text)
+        return self._text
 
     def coords(self):
-        try:
-            return utils.get_page_coords(self.xml)
-        except Exception as e:
-            print(e)
-            return [None, None]
-        
+        if self._coords is None:
+            try:
+                self._coords = page_coords(self.full_text)
+            except Exception as e:
+                print(e)
+                self._coords = [None, None]
+        return self._coords
+
     def __str__(self):
         return 'Page: ' + self.title
+
 def run_test():
     indexer = Indexer("C:/Users/rowan/Documents/geowiki/enwiki-20200101-pages-articles-multistream.xml",
                 scratch_folder='C:/Users/rowan/Documents/geowiki/scratch')
     indexer.load(1.0)
 
 if __name__ == "__main__":
-    # import cProfile
-    # cProfile.run('run_test()')
-
+    metrics.add_sink(metrics.StderrSink())
+    # metrics.profile('Indexer.load') writes a cProfile of the load to Indexer.load.prof
     run_test()
@@ -1,5 +1,4 @@
 import codecs
-from collections import defaultdict
 import hashlib
 import logging
 import os
@@ -10,100 +9,87 @@ import subprocess
 import time
 import xml.etree.ElementTree as etree
 
+from . import links, metrics, spatial
+from .checkpoint import dump_fingerprint
+from .coord_parser import COORD_KEYWORDS, coords_table_sql, parse_coord_strings, title_coord
+from .dumpfile import open_reader
+# prefixes and category_identifier moved to links and are still importable from here
+from .links import LinkTables, category_identifier, page_links, prefixes
+from .multistream import MultistreamDump, is_multistream
+from .offsets import MISSING, OFFSETS_FILENAME, OffsetTable, OffsetTableWriter
+from .pagecache import CACHE_BYTES, PageCache, fetch_pages, lookup_page_nums
+from .sqlite_writer import BulkWriter, insert_sql
+from .syntax_parser import get_tags
+
 logger = logging.getLogger('wikidump.config')
 
 xml_dumps = 'C:/Users/rowan/Documents/geowiki'
 
-# -*- coding: utf-8 -*-
-# Static constants for dealing with different langauge wikis
-
-# List of wikipedia prefixes - not exhaustive
-prefixes = ['ru', 'nap', 'ja', 'ta', 'tl', 'az', 'ht', 'et', 'ca', 'wa', 'pms',
-'de', 'nl', 'su', 'bpy', 'fa', 'tr', 'en', 'eu', 'io', 'jv', 'nds', 'pt', 'zh',
-'bn', 'lt', 'la', 'nn', 'no', 'he', 'sh', 'lb', 'ro', 'hr', 'scn', 'da', 'it',
-'te', 'br', 'an', 'fr', 'cs', 'is', 'new', 'lv', 'ast', 'uk', 'mk', 'oc', 'ku',
-'sl', 'sk', 'af', 'ka', 'pl', 'ceb', 'th', 'sv', 'id', 'bs', 'hi', 'el', 'cy',
-'gl', 'vi', 'sq', 'fi', 'mr', 'hu', 'ar', 'bg', 'ms', 'ko', 'be']
-
-# Keyword for identifying category labels in different languages
-# TODO: Complete this list
-category_identifier =\
-  { 'en' : 'Category'
-  , 'fr' : 'Catégorie'
-  , 'de' : 'Kategorie'
-  , 'ja' : 'Category'
-  , 'it' : 'Categoria'
-  , 'ru' : 'Категория'
-  , 'pl' : 'Kategoria'
-  , 'nl' : 'Categorie'
-  , 'sv' : 'Kategori'
-  , 'zh' : 'Category'
-  }
-
-
 # Match the name of a dumpfile
 dumpfile_name = re.compile(r'(?P<prefix>.*?)wiki-(?P<date>\d{8})-pages-articles-multistream.xml')
 
-lang_prefixes = '|'.join(prefixes)
-lang_link = re.compile(r"\[\[(?P<prefix>"+lang_prefixes+"):(?P<title>.+?)\]\]")
-
-category_keywords = '|'.join(category_identifier.values())
-category_link = re.compile(r"\[\[(?P<title>("+category_keywords+"):(?P<category>.+?))\|(.+?)\]\]")
-
-def _get_starting_indices(string, tag):
-    return [m.start() for m in re.finditer(tag, string)]
-
-def get_tags(string, tag):
-    tags = []
-    if tag[-1] != '\|':
-        tag = tag+'\|'
-    starting_indices = _get_starting_indices(string, tag)
-    for idx in starting_indices:
-        ending_idx = string[idx:].find('}}')
-        tags.append(string[idx:idx+ending_idx])
-    return tags
 
-
-def getSizeAndMakeOffsets(f, db, current_page=0, sample=1.0):
+def getSizeAndMakeOffsets(f, db, current_page=0, sample=1.0, offsets_path=None, index_links=False):
+    """
+    Number the pages of the dump and store where each one starts. With
+    index_links, the categories and langlinks tables are filled in the same
+    pass, which makes it about three times slower.
+    """
     print('=== making offsets ===')
-
-    # these exist to track progress
-    start_ts = ts = time.time()
-    total_time = 0
-    mbytes_processed = 0
-    cursor = db.cursor()
+    start = time.time()
+    try:
+        size = os.fstat(f.fileno()).st_size
+    except (AttributeError, OSError):
+        size = None
+    progress = metrics.stage('getSizeAndMakeOffsets', total_bytes=size)
+    writer = BulkWriter(db, progress=progress)
+    if index_links:
+        links.create_tables(db, writer)
 
     # index is in bytes, not characters
     try:
         # idx = offsets[str(current_page)]
         idx = db.execute(
-                f'SELECT idx FROM indices WHERE page_num={current_page}'
+                'SELECT idx FROM indices WHERE page_num=?', (current_page,)
             ).fetchone()[0]
+        # we'll find this page again, so start counting just before it
+        current_page -= 1
     except (    KeyError, TypeError):
         idx = 0
     f.seek(idx)
+    reported = idx
+
+    # the offset table is only written on a fresh pass; after a resume it is
+    # rebuilt from the indices table instead
+    offsets = None
+    if offsets_path and current_page == 0:
+        offsets = OffsetTableWriter(offsets_path)
+    last_page = last_idx = None
 
+    insert = "INSERT OR REPLACE INTO indices VALUES ('', '', ?, ?)"
     for line in f:
-        if b'<page>' is line:
+        if b'<page>' in line:
             current_page += 1
-            cursor.execute(f"INSERT INTO indices VALUES ('', '', {current_page}, {idx})")
-        elif b'  <page>\n' is line:
-            current_page += 2
-            cursor.execute(f"INSERT INTO indices VALUES ('', '', {current_page}, {idx + 2})")
-        elif b'<page>' in line:
-            current_page += 1
-            cursor.execute(f"INSERT INTO indices VALUES ('', '', {current_page}, {idx + line.index(b'<page>')})")
+            page_idx = idx + line.index(b'<page>')
+            writer.insert(insert, (current_page, page_idx))
+            if offsets and last_page is not None:
+                offsets.write(last_page, last_idx, page_idx)
+            last_page, last_idx = current_page, page_idx
+            progress.advance(1, idx - reported)
+            reported = idx
+        elif index_links and b'[[' in line:
+            categories, langs = links.line_links(line)
+            if categories or langs:
+                links.insert_links(writer, current_page, categories, langs)
         idx += len(line)
-        if idx % 100_000 == 0:
-            mbytes_processed += 100
-            db.commit()
-            total_time += time.time() - ts
-            print(f' {round(idx / 1000000000, 3):10} GB processed \
-                     {round(1000 * (time.time() - ts) / 10, 2):10}ms / mb \
-                     {round(1000 * total_time/mbytes_processed, 2):10}ms / mb avg',
-                     end='\r')
-            ts = time.time()
-    print('\npages:', current_page, round(total_time, 1), 'seconds')
+    writer.finish()
+    progress.advance(0, idx - reported)
+    progress.finish()
+    if offsets:
+        if last_page is not None:
+            offsets.write(last_page, last_idx, MISSING)
+        offsets.close()
+    print('pages:', current_page, round(time.time() - start, 1), 'seconds')
     return current_page
 
 """
@@ -119,16 +105,45 @@ class Dump:
         print('opening', path)
         return sqlite3.connect(path)
 
+    def _validate_cache(self):
+        "Make sure the scratch folder was built from this dump, and empty it if not"
+        stored = self.metadata.get('fingerprint')
+        fingerprint = dump_fingerprint(self.xml_path, known=stored)
+        if stored is not None and stored['digest'] != fingerprint['digest']:
+            print(f"{self.cache_path} was built from a different dump, discarding it")
+            self.logger.warning("stale cache in %s, resetting", self.cache_path)
+            for table in ['indices', 'coords', 'titles', 'categories', 'langlinks', spatial.RTREE_TABLE]:
+                self.cursor.execute(f'DROP TABLE IF EXISTS {table}')
+            self.db.commit()
+            if os.path.exists(self._offsets_path()):
+                os.remove(self._offsets_path())
+            self.metadata.clear()
+        self.metadata['fingerprint'] = fingerprint
+        self.metadata.sync()
+
+    def _offsets_path(self):
+        return os.path.join(self.cache_path, OFFSETS_FILENAME)
+
     def _open_shelf(self, name):
         "Open a shelf-file in a pre-determined location by name"
         path = os.path.join(self.cache_path, name)
         return shelve.open(path)
 
-    def __init__(self, xml_path, build_index=False, scratch_folder='./py3', sample=1.0):
+    def __init__(self, xml_path, build_index=False, scratch_folder='./py3', sample=1.0, use_mmap=False,
+                 cache_bytes=CACHE_BYTES, index_links=False):
         self.xml_path = os.path.abspath(xml_path)
-        self.xml_file = open(self.xml_path, 'rb')
-        # May want to hash the file instead for portability
+        if is_multistream(self.xml_path):
+            # read pages straight out of the compressed dump
+            self.multistream = MultistreamDump(self.xml_path)
+            self.reader = None
+        else:
+            self.multistream = None
+            # with use_mmap, pages are memoryviews into the mapped dump
+            self.reader = open_reader(self.xml_path, use_mmap)
+        # the cache is checked against a fingerprint of the dump, see _validate_cache
         self.cache_path = scratch_folder
+        # parsed pages, for callers that fetch the same pages repeatedly
+        self.page_cache = PageCache(cache_bytes)
 
         self.logger.info("============================================")
         self.logger.info("Loading data for %s", self.xml_path)
@@ -143,6 +158,7 @@ class Dump:
         # Mapping from page index to position in file
         self.db = self._open_db()
         self.cursor = self.db.cursor()
+        self._validate_cache()
         # self.page_offsets = self._open_shelf('page_offsets')
         try:
             rows_in_db = self.cursor.execute(
@@ -166,23 +182,41 @@ class Dump:
             # we'll only set this after all indices have been stored in the db
             size = self.metadata['size']
         except KeyError:
-            start_at_page = 0
-            if rows_in_db > 0:
-                # start_at_page = int(list(self.page_offsets.keys())[-1])
-                start_at_page = self.cursor.execute(
-                        '''SELECT MAX(page_num) FROM indices'''
-                    ).fetchone()[0]
-            self.metadata['size'] = getSizeAndMakeOffsets(
-                open(self.xml_path, 'rb'),
-                self.db,
-                current_page=start_at_page,
-                sample=sample)
+            if self.multistream:
+                # the multistream index already lists every page and its title;
+                # pages are read through it, so indices holds no offsets
+                writer = BulkWriter(self.db)
+                for page_num, page_id, title in self.multistream.iter_titles():
+                    writer.insert("INSERT OR REPLACE INTO indices VALUES (?, '', ?, NULL)", (title, page_num + 1))
+                writer.finish()
+                self.metadata['size'] = self.multistream.size
+            else:
+                start_at_page = 0
+                if rows_in_db > 0:
+                    # start_at_page = int(list(self.page_offsets.keys())[-1])
+                    start_at_page = self.cursor.execute(
+                            '''SELECT MAX(page_num) FROM indices'''
+                        ).fetchone()[0]
+                self.metadata['size'] = getSizeAndMakeOffsets(
+                    open(self.xml_path, 'rb'),
+                    self.db,
+                    current_page=start_at_page,
+                    sample=sample,
+                    offsets_path=self._offsets_path(),
+                    index_links=index_links)
             size = self.metadata['size']
             self.logger.info("Processed %d pages", size)
             print(f'Processed {round(size/1000)}k pages')
 
         self.logger.debug("Size: %d pages", size)
 
+        # Mapping from page number to offsets, without going through sqlite
+        self.offsets = None
+        if not self.multistream:
+            self.offsets = OffsetTable.open(self.cache_path)
+            if self.offsets is None or len(self.offsets) <= size:
+                self.build_offset_table()
+
         # Mapping from page title to page index
         num_page_titles = self.cursor.execute(
             '''SELECT Count(*) FROM indices WHERE title != ""'''
@@ -190,15 +224,15 @@ class Dump:
         #self.logger.debug("Currently know of %d page titles", len(self.page_titles))
         # find the rest of the pages
         if build_index and num_page_titles < size*sample:
-            total_time = 0
-            start_ts = time.time()
             print("inserting titles into index dictionary")
+            progress = metrics.stage('Dump.index_titles', total=int(size*sample) - num_page_titles)
             for i in range(num_page_titles, int(size*sample)):
+                progress.advance()
                 try:
-                    tree = etree.fromstring(self.get_raw(i))
+                    tree = etree.fromstring(self.get_raw(i+1))
                 except Exception as e:
                     try:
-                        print(f'{i} caused an error:' + self.get_raw(i)[:50], '...', self.get_raw(i)[-50:])
+                        print(f'{i} caused an error:' + self.get_raw(i+1)[:50], '...', self.get_raw(i+1)[-50:])
                         continue
                     except:
                         # print(f'{i} cannot get raw')
@@ -211,16 +245,67 @@ class Dump:
                     (title, i+1)
                 )
                 if i % 1000 == 0:
-                    total_time = time.time()-start_ts
-                    self.db.commit()
-                    print(f' {round((100*i/size), 3):10}%\t{round(1000*total_time/(i+1), 2)}ms / page', end='\r')
+                    with progress.timer('commit'):
+                        self.db.commit()
+            progress.finish()
         else:
             self.logger.debug("Not building page title index")
 
         self.page_lengths = self._open_shelf('page_lengths')
+        # page_num <-> category and page_num <-> (lang, title), see link_tables
+        self.links = None
+        if links.has_tables(self.db):
+            self.links = LinkTables(self.db)
         # self.db.close()
         self.db.commit()
-        print("\n__init__ complete")
+        print("__init__ complete")
+
+    def link_tables(self):
+        "The categories and langlinks tables; index_links or Dump(..., index_links=True) fills them"
+        if self.links is None:
+            raise Exception("no categories or langlinks tables, fill them with index_links() first")
+        return self.links
+
+    def index_links(self):
+        """
+        Fill the categories and langlinks tables in a pass over every page,
+        unless getSizeAndMakeOffsets already did with index_links
+        """
+        size = self.metadata['size']
+        for table in ['categories', 'langlinks']:
+            self.cursor.execute(f'DROP TABLE IF EXISTS {table}')
+        progress = metrics.stage('Dump.index_links', total=size)
+        writer = BulkWriter(self.db, progress=progress)
+        links.create_tables(self.db, writer)
+        for page_num in range(1, size + 1):
+            progress.advance()
+            try:
+                raw = self.get_raw_bytes(page_num)
+            except Exception as e:
+                print(f'{page_num} caused an error:', str(e))
+                continue
+            categories, langs = page_links(raw)
+            links.insert_links(writer, page_num, categories, langs)
+        writer.finish()
+        progress.finish()
+        self.links = LinkTables(self.db)
+        self.page_cache.clear()
+
+    def build_offset_table(self):
+        "Write the offset table from the indices table"
+        print('writing offset table')
+        if self.offsets is not None:
+            self.offsets.close()
+        rows = self.db.execute('SELECT page_num, idx FROM indices ORDER BY page_num')
+        with OffsetTableWriter(self._offsets_path()) as offsets:
+            last_page = last_idx = None
+            for page_num, idx in rows:
+                if last_page is not None:
+                    offsets.write(last_page, last_idx, idx)
+                last_page, last_idx = page_num, idx
+            if last_page is not None:
+                offsets.write(last_page, last_idx, MISSING)
+        self.offsets = OffsetTable.open(self.cache_path)
 
     def create_title_db(self):
         size = self.metadata['size']
@@ -229,36 +314,30 @@ class Dump:
         except sqlite3.OperationalError:
             pass
         self.cursor.execute('CREATE TABLE titles\
-                            (title TEXT PRIMARY KEY, idx INTEGER, page_num INTEGER)')
+                            (title TEXT, idx INTEGER, page_num INTEGER)')
         print(f'=== making page title dictionary for {size} pages ===')
-        total_time = 0
-        start_ts = time.time()
-        for i in range(0, size):
+        progress = metrics.stage('Dump.create_title_db', total=size)
+        writer = BulkWriter(self.db, progress=progress)
+        writer.defer_index('titles_title', 'titles', ['title'])
+        insert = "INSERT INTO titles VALUES (?,?,?)"
+        for page_num in range(1, size + 1):
+            progress.advance()
             try:
-                tree = etree.fromstring(self.get_raw(i))
+                tree = etree.fromstring(self.get_raw(page_num))
             except Exception as e:
                 try:
-                    print(f'{i} caused an error:' + self.get_raw(i)[:50], '...', self.get_raw(i)[-50:])
+                    print(f'{page_num} caused an error:' + self.get_raw(page_num)[:50], '...', self.get_raw(page_num)[-50:])
                     continue
                 except:
-                    # print(f'{i} cannot get raw')
+                    # print(f'{page_num} cannot get raw')
                     continue
             # Need to encode as etree will return both str and unicode
 #                 title = tree.find('title').text.encode('utf8')
             title = tree.find('title').text
-            idx = self.cursor.execute(f'SELECT idx FROM indices WHERE page_num={i+1}').fetchone()[0]
-            try:
-                self.cursor.execute(
-                    f"INSERT INTO titles VALUES (?,?,?)",
-                    (title, idx, i+1)
-                )
-            except sqlite3.OperationalError as e:
-                print(e, title)
-                return
-            if i % 1000 == 0:
-                total_time = time.time() - start_ts
-                self.db.commit()
-                print(f' {round((100*i/size), 3):10}%\t{round(1000*total_time/(i+1), 2)}ms / page', end='\r')
+            idx = None if self.multistream else self.get_offset(page_num)
+            writer.insert(insert, (title, idx, page_num))
+        writer.finish()
+        progress.finish()
 
     def extract_lat_lon(self, coord_string):
         split = coord_string.split('|')
@@ -340,14 +419,16 @@ class Dump:
         print("extracting Coord template from pages")
         ts = time.time()
         print(start, '-', int(self.metadata['size']))
+        progress = metrics.stage('Dump.extract_coord_strings', total=int(self.metadata['size']) - start)
         for i in range(start, int(self.metadata['size'])):
+            progress.advance()
             try:
-                page = self.get_page_by_index(i)
+                page = self.get_page_by_num(i+1)
             except:
                 break
             if page.text is None:
                 continue
-            tags = sp.get_tags(page.text, 'Coord')
+            tags = get_tags(page.text, 'Coord')
             title = page.title
             if tags:
                 tagstring = '||'.join(tags)
@@ -356,9 +437,9 @@ class Dump:
                     (tagstring, i+1)
                 )
             if i % 100 == 0:
-                self.db.commit()
-            if i % 1000 == 0:
-                print(round(100*i/(self.metadata['size']), 2), '%', f'({i})', end='\r')
+                with progress.timer('commit'):
+                    self.db.commit()
+        progress.finish()
         total_time = time.time() - ts
         print('total time:', round(total_time / 60 / 60, 2), 'hours')
 
@@ -371,126 +452,134 @@ class Dump:
         idx_to_title = {item[0]:item[2] for item in result}
         for page_num in coord_strings:
             if '||' in coord_strings[page_num]:
-                page_coord_strings = coord_strings[page_num].split('||')
-                coord_strings[page_num] = page_coord_strings[0]
-                for s in page_coord_strings:
-                    if "display=title" in s:
-                        coord_strings[page_num] = s
-
-        keywords = defaultdict(int)
-        for coord_string in coord_strings.values():
-            for kw in self.get_keywords(coord_string).keys():
-                keywords[kw.strip()] += 1
+                coord_strings[page_num] = title_coord(coord_strings[page_num].split('||'))
+
         try:
             self.cursor.execute('''DROP TABLE coords''')
         except sqlite3.OperationalError:
             pass
-        self.cursor.execute('''CREATE TABLE coords
-            (coords TEXT, lat REAL DEFAULT 0, lon REAL DEFAULT 0,
-            page_num INTEGER PRIMARY KEY, accessdate TEXT DEFAULT '',
-            date TEXT DEFAULT '', dim TEXT DEFAULT '',
-            display TEXT DEFAULT '', elevation TEXT DEFAULT '',
-            format TEXT DEFAULT '', globe TEXT DEFAULT '',
-            id TEXT DEFAULT '', name TEXT DEFAULT '',
-            nosave TEXT DEFAULT '', notes TEXT DEFAULT '',
-            publisher TEXT DEFAULT '', reason TEXT DEFAULT '',
-            region TEXT DEFAULT '', scale TEXT DEFAULT '',
-            source TEXT DEFAULT '', title TEXT DEFAULT '',
-            type TEXT DEFAULT '', upright TEXT DEFAULT '',
-            url TEXT DEFAULT '', work TEXT DEFAULT '')
-        ''')
-        entries_list = [ 'accessdate', 'date', 'dim', 'display',
-            'elevation', 'format', 'globe','id',
-            'name', 'nosave', 'notes', 'publisher',
-            'reason', 'region', 'scale', 'source',
-            'title', 'type', 'upright', 'url', 'work']
-        def insert_keyword_dict(page_num, coords, kws, debug=False):
-            allowed_keys = [kw for kw in kws.keys() if kw in entries_list]
-            allowed_vals = [kws[kw] for kw in allowed_keys]
-
-            try:
-                lat,lon = self.convert_to_decimal(self.extract_lat_lon(coords))
-            except:
-                lat = lon = 0
-            keys = ['coords', 'lat', 'lon', 'page_num'] + allowed_keys
-            vals = [coords, lat, lon, page_num] + allowed_vals
-
-            qstring = f'INSERT INTO coords (\
-                {",".join(keys)}) VALUES (\
-                {",".join(["?" for item in vals])})'
-
-            if debug:
-                print(qstring, vals)
-            self.cursor.execute(qstring, vals)
-
-        count = 0
-        for page_idx,coord_string in coord_strings.items():
-            keywords = self.get_keywords(coord_string)
-            keywords['title'] = idx_to_title[page_idx]
-            insert_keyword_dict(page_idx, coord_string, keywords)
-            if count > 100:
-                self.db.commit()
-                print(round(100*count/len(coord_strings), 2), '%', end='\r')
-            count += 1
+        self.cursor.execute(coords_table_sql())
+        page_nums = list(coord_strings.keys())
+        strings = [coord_strings[page_num] for page_num in page_nums]
+        start = time.time()
+        lat, lon, valid, columns = parse_coord_strings(strings)
+        print(f'parsed {len(strings)} Coord strings in {round(time.time() - start, 2)} seconds, '
+              f'{int((~valid).sum())} without a readable position')
+        # the page title replaces the Coord template's own title argument
+        columns['title'] = [idx_to_title[page_num] for page_num in page_nums]
+        keys = ['coords', 'lat', 'lon', 'page_num'] + COORD_KEYWORDS
+        # keywords a string doesn't have get the column default
+        values = [['' if value is None else value for value in columns[kw]] for kw in COORD_KEYWORDS]
+        rows = zip(strings, lat.tolist(), lon.tolist(), page_nums, *values)
+        with self.db:
+            self.db.executemany(insert_sql('coords', keys), rows)
+        spatial.create_spatial_index(self.db)
+
+    def pages_in_bbox(self, south, west, north, east):
+        "(page_num, lat, lon) of the geotagged pages in a bounding box; west > east crosses the antimeridian"
+        return spatial.pages_in_bbox(self.db, south, west, north, east)
+
+    def pages_near(self, lat, lon, radius_km, limit=10):
+        "(page_num, lat, lon, distance_km) of up to limit pages within radius_km, nearest first"
+        return spatial.pages_near(self.db, lat, lon, radius_km, limit)
 
     @property
     def size(self):
         return self.metadata['size']
 
+    def get_raw_bytes(self, page_num):
+        "Get raw xml for a page as bytes, or as a memoryview when the dump is memory-mapped"
+        if self.multistream:
+            # page numbers in the indices table start at 1
+            return self.multistream.get_raw_bytes(page_num - 1)
+        start_offset, end_offset = self.get_offsets(page_num)
+        if end_offset != MISSING:
+            return self.reader.read(start_offset, end_offset)
+        # Handle the corner case which is the very last entry
+        raw = self.reader.read(start_offset)
+        match = re.search(rb'.*</page>', raw)
+        return raw[:match.end()]
+
     def get_raw(self, page_num):
         "Get raw xml dump data for a given page number"
-        f = self.xml_file
-        # start_offset = self.page_offsets[str(index+1)]
+        return str(self.get_raw_bytes(page_num), 'utf-8')
+
+    def get_offsets(self, page_num):
+        "Byte offsets of a page and of the page after it (MISSING for the last page)"
+        if self.offsets is not None:
+            try:
+                return self.offsets.get(page_num)
+            except KeyError:
+                raise Exception("cannot get idx for page", page_num)
         start_offset = self.get_offset(page_num)
-        f.seek(start_offset)
         try:
-            # end_offset = self.page_offsets[str(index+2)]
             end_offset = self.get_offset(page_num+1)
-            return f.read(end_offset - start_offset).decode('utf-8')
-        except KeyError:
-            # Handle the corner case which is the very last entry
-            raw = f.read().decode('utf-8')
-            match = re.search(r'.*</page>', raw)
-            return raw[:match.end()]
+        except Exception:
+            end_offset = MISSING
+        return start_offset, end_offset
 
     def get_offset(self, page_num):
+        if self.offsets is not None:
+            return self.get_offsets(page_num)[0]
         result = self.cursor\
-            .execute(f'SELECT idx FROM indices WHERE page_num={page_num}')\
+            .execute('SELECT idx FROM indices WHERE page_num=?', (page_num,))\
             .fetchone()
         if result is None:
             raise Exception("cannot get idx for page", page_num)
         return result[0]
 
     def get_page_index(self, title):
-        "Look up the index of a page based on its title"
-        # return self.page_titles[title]
-        result = self.cursor.execute(f"SELECT idx FROM titles WHERE title == '{title}'").fetchone()
+        "Look up the page number of a page based on its title, or -1"
+        result = self.cursor.execute("SELECT page_num FROM titles WHERE title = ?", (title,)).fetchone()
         if result:
             return result[0]
         return -1
 
     def get_page_by_num(self, page_num):
         "Get the full text of a page by page_num"
-        return Page(self.get_raw(page_num))
+        return self.get_pages_by_num([page_num])[0]
+
+    def get_pages_by_num(self, page_nums):
+        "Pages for a list of page numbers, read in file order and cached"
+        pages = fetch_pages(self.page_cache, page_nums, self.get_raw_bytes, Page)
+        # categories and langlinks are looked up instead of parsed once the tables exist
+        for page_num, page in zip(page_nums, pages):
+            page.page_num = page_num
+            page.link_tables = self.links
+        return pages
+
+    def categories(self, page_num):
+        "The set of categories of a page"
+        return self.get_page_by_num(page_num).categories()
+
+    def lang_equiv(self, page_num, prefix):
+        "Title of the page in the language with the given prefix, or None"
+        return self.get_page_by_num(page_num).lang_equiv(prefix)
+
+    def get_pages(self, titles):
+        "Pages for a list of titles, with None for titles that aren't in the titles table"
+        page_nums = lookup_page_nums(self.db, titles)
+        found = [page_nums[title] for title in titles if title in page_nums]
+        pages = dict(zip(found, self.get_pages_by_num(found)))
+        return [pages[page_nums[title]] if title in page_nums else None for title in titles]
 
     def get_page_length(self, index):
         "Look up the length of a page given an index"
         try:
             return self.page_lengths[str(index)]
         except KeyError:
-            length = len(self.get_page_contents(index))
+            length = len(self.get_raw(index))
             self.page_lengths[str(index)] = length
             return length
 
     def get_page_contents_by_title(self, title):
         "Get the contents of a page with a given title"
         index = self.get_page_index(title)
-        return self.get_page_contents(index)
+        return self.get_raw(index)
 
     def get_page(self, title):
         "Return a Page object for the page of the given title"
-        index = self.get_page_index(title)
-        return Page(self.get_raw(index))
+        return self.get_pages([title])[0]
 
     def get_dumpfile_prefix(self):
         "Return the prefix code associated with the filename"
@@ -502,43 +591,53 @@ class Page:
     Represents a single page in a wikidump
     """
     logger = logging.getLogger('wikidump.model.Page')
+    # set by Dump.get_pages_by_num, link_tables is Dump.links if the tables exist
+    page_num = None
+    link_tables = None
 
     def __init__(self, string):
         """
         @param string: A string containin the raw xml version of the page
         """
-        self.xml = string
-        self.dom = etree.fromstring(string)
+        # str, bytes or a memoryview into the dump; only decoded if .xml is used
+        self._xml = string
+        self._links = None
+        parser = etree.XMLParser()
+        parser.feed(string)
+        self.dom = parser.close()
         self.text = self.dom.find('revision').find('text').text
         self.title = self.dom.find('title').text
 
+    @property
+    def xml(self):
+        if not isinstance(self._xml, str):
+            self._xml = str(self._xml, 'utf-8')
+        return self._xml
+
+    def _page_links(self):
+        "(categories, {lang: title}) parsed from the page, when there are no link tables to look them up in"
+        if self._links is None:
+            self._links = page_links(self._xml)
+        return self._links
+
     def lang_equiv(self, prefix):
         """ Returns the page title for the equivalent page in the given language prefix
         """
-        lang_links = dict(lang_link.findall(self.text))
-        try:
-            return lang_links[prefix]
-        except KeyError:
-            return None
+        if self.link_tables is not None:
+            return self.link_tables.lang_equiv(self.page_num, prefix)
+        return self._page_links()[1].get(prefix)
 
     def categories(self):
         """ Returns the set of categories this page is member of.
         changed from 0.1 : was previously a list. Do not want duplicates.
         """
-        print(self.text)
-        try:
-            return set(category_link.findall(self.text.decode())[0])
-        except IndexError: #No categories
-            return []
+        if self.link_tables is not None:
+            return self.link_tables.categories(self.page_num)
+        return set(self._page_links()[0])
 
 def category_map(dump):
-    "Compute the category mapping of a particular dump"
-    cat_count = defaultdict(list)
-    for i in range(dump.metadata['size']):
-        p = dump.get_page_by_index(i)
-        for c in p.categories():
-            cat_count[c].append(i)
-    return cat_count
+    "Compute the category mapping of a particular dump: {category: [page_num, ...]}. Needs dump.index_links()"
+    return dump.link_tables().category_map()
 
 def load_dumps(dump_path, langs=None, build_index=False, scratch_folder='py3', sample=1.0):
     d = Dump(dump_path, build_index=build_index, scratch_folder=scratch_folder, sample=sample)
@@ -0,0 +1,158 @@
+"""
+Category and interlanguage links of pages, stored in two tables so that
+category membership and translations are queries rather than a reparse of
+every page:
+
+    categories (page_num, category)     looked up by page and by category
+    langlinks (page_num, lang, title)   looked up by page and by (lang, title)
+
+Links are read straight from the raw page bytes: [[Category:Name|sort key]]
+and [[fr:Titre]] in the page text (edit summaries are skipped). Category
+names are normalized the way MediaWiki does: underscores are spaces and the
+first letter is upper case.
+"""
+from collections import defaultdict
+import html
+import re
+
+# -*- coding: utf-8 -*-
+# Static constants for dealing with different langauge wikis
+
+# List of wikipedia prefixes - not exhaustive
+prefixes = ['ru', 'nap', 'ja', 'ta', 'tl', 'az', 'ht', 'et', 'ca', 'wa', 'pms',
+'de', 'nl', 'su', 'bpy', 'fa', 'tr', 'en', 'eu', 'io', 'jv', 'nds', 'pt', 'zh',
+'bn', 'lt', 'la', 'nn', 'no', 'he', 'sh', 'lb', 'ro', 'hr', 'scn', 'da', 'it',
+'te', 'br', 'an', 'fr', 'cs', 'is', 'new', 'lv', 'ast', 'uk', 'mk', 'oc', 'ku',
+'sl', 'sk', 'af', 'ka', 'pl', 'ceb', 'th', 'sv', 'id', 'bs', 'hi', 'el', 'cy',
+'gl', 'vi', 'sq', 'fi', 'mr', 'hu', 'ar', 'bg', 'ms', 'ko', 'be']
+
+# Keyword for identifying category labels in different languages
+# TODO: Complete this list
+category_identifier =\
+  { 'en' : 'Category'
+  , 'fr' : 'Catégorie'
+  , 'de' : 'Kategorie'
+  , 'ja' : 'Category'
+  , 'it' : 'Categoria'
+  , 'ru' : 'Категория'
+  , 'pl' : 'Kategoria'
+  , 'nl' : 'Categorie'
+  , 'sv' : 'Kategori'
+  , 'zh' : 'Category'
+  }
+
+lang_prefixes = '|'.join(prefixes)
+category_keywords = '|'.join(sorted(set(category_identifier.values())))
+
+_lang_pattern = r'\[\[(' + lang_prefixes + r'):([^\[\]|\n]+)\]\]'
+_category_pattern = r'\[\[\s*(?:' + category_keywords + r')\s*:\s*([^\[\]|\n]+?)\s*(?:\|[^\[\]\n]*)?\]\]'
+lang_link = re.compile(_lang_pattern)
+category_link = re.compile(_category_pattern, re.I)
+_lang_bytes = re.compile(_lang_pattern.encode('utf-8'))
+_category_bytes = re.compile(_category_pattern.encode('utf-8'), re.I)
+_text_start = re.compile(rb'<text')
+# categories and langlinks both look like [[prefix:...]], most other links don't
+_prefixed_link = re.compile(rb'\[\[\s*[^\W\d_][^\[\]|:\n]{0,15}:')
+_comment = re.compile(rb'\s*<comment>')
+
+INSERT_CATEGORY = "INSERT OR IGNORE INTO categories VALUES (?,?)"
+INSERT_LANGLINK = "INSERT OR IGNORE INTO langlinks VALUES (?,?,?)"
+
+def _decode(value):
+    if not isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    return html.unescape(value)
+
+def category_name(name):
+    "A category as MediaWiki names it, e.g. 'populated_places' -> 'Populated places'"
+    name = ' '.join(name.replace('_', ' ').split())
+    return name[:1].upper() + name[1:]
+
+def page_links(raw):
+    """
+    (categories, {lang: title}) of a raw page, or part of one, as bytes, a
+    memoryview or str. Wikitext without XML around it works too. The first
+    link to a language wins, as on the wiki.
+    """
+    if isinstance(raw, str):
+        raw = raw.encode('utf-8')
+    match = _text_start.search(raw)
+    start = match.start() if match else 0
+    categories = {}
+    for match in _category_bytes.finditer(raw, start):
+        categories[category_name(_decode(match.group(1)))] = None
+    langs = {}
+    for match in _lang_bytes.finditer(raw, start):
+        langs.setdefault(match.group(1).decode('ascii'), _decode(match.group(2)).strip())
+    return list(categories), langs
+
+def line_links(line):
+    "Like page_links, for one line of a dump; an edit summary line has none"
+    if b'[[' not in line or not _prefixed_link.search(line) or _comment.match(line):
+        return [], {}
+    return page_links(line)
+
+def create_tables(db, writer=None):
+    """
+    Create the categories and langlinks tables if they don't exist. Their
+    lookup indexes are built by the writer's finish(), or right away without one.
+    """
+    db.execute('''CREATE TABLE IF NOT EXISTS categories
+            (page_num INTEGER, category TEXT, PRIMARY KEY (page_num, category)) WITHOUT ROWID''')
+    db.execute('''CREATE TABLE IF NOT EXISTS langlinks
+            (page_num INTEGER, lang TEXT, title TEXT, PRIMARY KEY (page_num, lang)) WITHOUT ROWID''')
+    if writer is not None:
+        writer.defer_index('categories_category', 'categories', ['category'])
+        writer.defer_index('langlinks_lang_title', 'langlinks', ['lang', 'title'])
+    else:
+        db.execute('CREATE INDEX IF NOT EXISTS categories_category ON categories (category)')
+        db.execute('CREATE INDEX IF NOT EXISTS langlinks_lang_title ON langlinks (lang, title)')
+    db.commit()
+
+def insert_links(writer, page_num, categories, langs):
+    for category in categories:
+        writer.insert(INSERT_CATEGORY, (page_num, category))
+    for lang, title in langs.items():
+        writer.insert(INSERT_LANGLINK, (page_num, lang, title))
+
+def has_tables(db):
+    return db.execute('''SELECT Count(*) FROM sqlite_master
+            WHERE type='table' AND name IN ('categories', 'langlinks')''').fetchone()[0] == 2
+
+class LinkTables:
+    "Category and interlanguage lookups over the tables of an index"
+    def __init__(self, db):
+        self.db = db
+
+    def categories(self, page_num):
+        "The set of categories a page is in"
+        rows = self.db.execute('SELECT category FROM categories WHERE page_num=?', (page_num,))
+        return {category for category, in rows}
+
+    def pages_in_category(self, category):
+        "Page numbers of the pages in a category"
+        rows = self.db.execute('SELECT page_num FROM categories WHERE category=? ORDER BY page_num',
+                               (category_name(category),))
+        return [page_num for page_num, in rows]
+
+    def lang_equiv(self, page_num, prefix):
+        "Title of the page in the language with the given prefix, or None"
+        row = self.db.execute('SELECT title FROM langlinks WHERE page_num=? AND lang=?',
+                              (page_num, prefix)).fetchone()
+        return row[0] if row else None
+
+    def lang_links(self, page_num):
+        "{lang: title} of a page"
+        return dict(self.db.execute('SELECT lang, title FROM langlinks WHERE page_num=?', (page_num,)))
+
+    def pages_linking_to(self, prefix, title):
+        "Page numbers of the pages whose equivalent in the prefix language is title"
+        rows = self.db.execute('SELECT page_num FROM langlinks WHERE lang=? AND title=?', (prefix, title))
+        return [page_num for page_num, in rows]
+
+    def category_map(self):
+        "{category: [page_num, ...]} for every category"
+        cat_count = defaultdict(list)
+        for category, page_num in self.db.execute('SELECT category, page_num FROM categories ORDER BY page_num'):
+            cat_count[category].append(page_num)
+        return cat_count
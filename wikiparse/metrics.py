@@ -0,0 +1,323 @@
+"""
+Progress and per-stage metrics for the long passes over a dump.
+
+A pass opens a stage and reports to it as it goes:
+
+    with metrics.stage('Indexer.load', total_bytes=size) as progress:
+        for page in pages:
+            progress.advance(1, len(page))
+            progress.gauge('queue_depth', q.qsize())
+            with progress.timer('extract'):
+                ...
+
+and whatever is attached with add_sink sees the events: a StderrSink keeps a
+progress line on stderr, a JSONLogSink appends one JSON object per event to a
+file and a CallbackSink hands each event dict to a function. Progress events
+are throttled to one per sink interval; a stage's final event is always sent.
+
+With no sinks attached and no profiling, stage() hands out a stage whose
+methods do nothing, so instrumented loops cost one no-op call per page.
+
+    metrics.profile('Indexer.load')
+
+runs the named stages (or every stage, with no names) under cProfile and
+writes <stage>.prof files that pstats or snakeviz can read.
+"""
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger('wikidump.model.metrics')
+
+_sinks = []
+_profiled = None
+_profile_folder = '.'
+
+def _rate(amount, seconds):
+    return amount / seconds if seconds > 0 else 0.
+
+def _readable_seconds(seconds):
+    if seconds < 60:
+        return f'{round(seconds, 1)}s'
+    if seconds < 60 * 60:
+        return f'{round(seconds / 60, 1)}m'
+    return f'{round(seconds / 60 / 60, 2)}h'
+
+class Sink:
+    "Receives stage events, at most one progress event per stage every interval seconds"
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def emit(self, event):
+        now = time.monotonic()
+        with self._lock:
+            if event['event'] == 'progress':
+                last = self._last.get(event['stage'])
+                if last is not None and now - last < self.interval:
+                    return
+            self._last[event['stage']] = now
+            self.handle(event)
+
+    def handle(self, event):
+        "Called with each event that gets through the throttle; the base sink drops it"
+
+class CallbackSink(Sink):
+    "Calls fn(event) with each event dict"
+    def __init__(self, fn, interval=1.0):
+        super().__init__(interval)
+        self.fn = fn
+
+    def handle(self, event):
+        self.fn(event)
+
+class JSONLogSink(Sink):
+    "Appends each event to a file as one line of JSON"
+    def __init__(self, path, interval=10.0):
+        super().__init__(interval)
+        self.path = path
+        self._file = open(path, 'a')
+
+    def handle(self, event):
+        self._file.write(json.dumps(event) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class StderrSink(Sink):
+    "A progress line per stage, rewritten in place"
+    def __init__(self, interval=1.0, stream=None):
+        super().__init__(interval)
+        self.stream = stream or sys.stderr
+
+    def handle(self, event):
+        parts = [f'{event["stage"]}:']
+        if event['fraction'] is not None:
+            parts.append(f'{round(100 * event["fraction"], 2)}%')
+        parts.append(f'{event["pages"]:,} pages, {round(event["pages_per_second"]):,} pages / s')
+        if event['bytes']:
+            parts.append(f'{round(event["bytes_per_second"] / 1e6, 1)} MB / s')
+        for name, value in event['gauges'].items():
+            parts.append(f'{name} {value:,}' if isinstance(value, int) else f'{name} {value}')
+        for name, timer in event['timers'].items():
+            parts.append(f'{name} {round(timer["mean_ms"], 2)}ms')
+        if event['event'] == 'progress':
+            if event['eta_seconds'] is not None:
+                parts.append(f'~{_readable_seconds(event["eta_seconds"])} left')
+            self.stream.write('\r' + '  '.join(parts) + '   ')
+        else:
+            parts.append(f'took {_readable_seconds(event["elapsed"])}')
+            self.stream.write('\r' + '  '.join(parts) + '   \n')
+        self.stream.flush()
+
+class _Timer:
+    def __init__(self, stage, name):
+        self.stage = stage
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stage.record(self.name, time.perf_counter() - self.start)
+
+class Stage:
+    """
+    Counts pages and bytes for one pass, keeps gauges (last value wins) and
+    timers (count, total and max seconds of e.g. each commit), and reports
+    them to the attached sinks. Safe to report to from several threads.
+    """
+    def __init__(self, name, total=None, total_bytes=None, sinks=(), profile=False):
+        self.name = name
+        self.total = total
+        self.total_bytes = total_bytes
+        self.sinks = list(sinks)
+        self.pages = 0
+        self.bytes = 0
+        self.gauges = {}
+        self.timers = {}
+        self._lock = threading.Lock()
+        self.profile_path = None
+        self._profiler = cProfile.Profile() if profile else None
+        self._interval = min([sink.interval for sink in self.sinks], default=1.0)
+        self.start = time.perf_counter()
+        self._next_emit = self.start + self._interval
+        self._finished = False
+        if self._profiler:
+            try:
+                self._profiler.enable()
+            except ValueError:
+                # only one profiler can be active, e.g. while a profiled stage runs a nested one
+                logger.warning("not profiling %s: another profiler is active", self.name)
+                self._profiler = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish()
+
+    def advance(self, pages=1, nbytes=0):
+        "Count pages (and bytes) as done"
+        now = time.perf_counter()
+        with self._lock:
+            self.pages += pages
+            self.bytes += nbytes
+            if now < self._next_emit:
+                return
+            self._next_emit = now + self._interval
+        self._emit('progress', now)
+
+    def gauge(self, name, value):
+        "Set a value that is reported as is, such as a queue depth or a running count"
+        with self._lock:
+            self.gauges[name] = value
+
+    def record(self, name, seconds):
+        "Add one timing, such as the latency of one commit"
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = [0, 0., 0.]
+            timer[0] += 1
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+
+    def timer(self, name):
+        "Context manager that records how long its block took under name"
+        return _Timer(self, name)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def event(self, kind='progress', now=None):
+        "The stage's metrics as a JSON-serializable dict"
+        elapsed = (now or time.perf_counter()) - self.start
+        with self._lock:
+            pages, nbytes = self.pages, self.bytes
+            gauges = dict(self.gauges)
+            timers = {name: tuple(timer) for name, timer in self.timers.items()}
+        fraction = eta = None
+        if self.total_bytes:
+            fraction = nbytes / self.total_bytes
+        elif self.total:
+            fraction = pages / self.total
+        if fraction:
+            eta = elapsed / fraction - elapsed
+        return {
+            'stage': self.name,
+            'event': kind,
+            'time': time.time(),
+            'elapsed': elapsed,
+            'pages': pages,
+            'bytes': nbytes,
+            'total': self.total,
+            'total_bytes': self.total_bytes,
+            'fraction': fraction,
+            'eta_seconds': eta,
+            'pages_per_second': _rate(pages, elapsed),
+            'bytes_per_second': _rate(nbytes, elapsed),
+            'gauges': gauges,
+            'timers': {name: {'count': count, 'seconds': seconds, 'mean_ms': 1000 * seconds / count,
+                              'max_ms': 1000 * longest}
+                       for name, (count, seconds, longest) in timers.items()},
+            'profile': self.profile_path,
+        }
+
+    def _emit(self, kind, now=None):
+        event = self.event(kind, now)
+        for sink in self.sinks:
+            try:
+                sink.emit(event)
+            except Exception:
+                logger.exception("metrics sink %r failed", sink)
+
+    def finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        if self._profiler:
+            self._profiler.disable()
+            self.profile_path = os.path.join(_profile_folder, f'{self.name}.prof')
+            self._profiler.dump_stats(self.profile_path)
+            logger.info("wrote profile of %s to %s", self.name, self.profile_path)
+        self._emit('finish')
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+class _NullStage:
+    "What stage() returns when nothing is listening: every method is a no-op"
+    name = None
+    pages = 0
+    bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    def advance(self, pages=1, nbytes=0):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+    def record(self, name, seconds):
+        pass
+
+    def timer(self, name):
+        return _NULL_TIMER
+
+    def elapsed(self):
+        return 0.
+
+    def finish(self):
+        pass
+
+_NULL_TIMER = _NullTimer()
+NULL_STAGE = _NullStage()
+
+def add_sink(sink):
+    "Send the events of stages started from now on to sink"
+    _sinks.append(sink)
+    return sink
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+def clear_sinks():
+    del _sinks[:]
+
+def profile(*names, folder='.'):
+    "Run the named stages, or all stages if none are named, under cProfile"
+    global _profiled, _profile_folder
+    _profiled = set(names) if names else True
+    _profile_folder = folder
+
+def stop_profiling():
+    global _profiled
+    _profiled = None
+
+def stage(name, total=None, total_bytes=None):
+    """
+    Start a stage that counts towards total pages or total_bytes. Use it as a
+    context manager, or call finish() when the pass is done.
+    """
+    profiled = _profiled is True or (_profiled is not None and name in _profiled)
+    if not _sinks and not profiled:
+        return NULL_STAGE
+    return Stage(name, total, total_bytes, _sinks, profiled)
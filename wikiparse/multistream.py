@@ -0,0 +1,122 @@
+"""
+Random access into a compressed *-pages-articles-multistream.xml.bz2 dump.
+
+The multistream dump is a concatenation of independent bz2 streams, each
+holding ~100 pages. The companion *-index.txt.bz2 has one line per page,
+`offset:page_id:title`, where offset is the byte position of the stream
+holding that page in the compressed file.
+"""
+from array import array
+from bisect import bisect_right
+import bz2
+from collections import OrderedDict
+import logging
+import os
+import re
+import time
+
+# Match the name of a multistream index file belonging to a dump
+indexfile_name = re.compile(r'(?P<prefix>.*?)wiki-(?P<date>\d{8})-pages-articles-multistream-index.txt.bz2')
+
+def index_path_for(xml_path):
+    "Guess the path of the index file that accompanies a multistream dump"
+    if xml_path.endswith('.xml.bz2'):
+        return xml_path[:-len('.xml.bz2')] + '-index.txt.bz2'
+    raise ValueError(f"not a multistream dump: {xml_path}")
+
+def is_multistream(xml_path):
+    return str(xml_path).endswith('.bz2')
+
+class MultistreamDump:
+    """
+    Reads single pages out of the compressed dump, decompressing only the
+    stream that holds the page. Recently used streams are kept decompressed
+    in an LRU cache.
+    """
+    logger = logging.getLogger('wikidump.model.MultistreamDump')
+
+    def __init__(self, xml_path, index_path=None, cache_blocks=16):
+        self.xml_path = os.path.abspath(xml_path)
+        self.index_path = os.path.abspath(index_path or index_path_for(self.xml_path))
+        self.xml_file = open(self.xml_path, 'rb')
+        self.file_size = os.path.getsize(self.xml_path)
+        self.cache_blocks = cache_blocks
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        # byte offset of every stream, and the number of the first page in it
+        self.block_offsets = array('q')
+        self.block_first_page = array('q')
+        self.size = 0
+        self._load_index()
+
+    def _load_index(self):
+        print('reading multistream index', self.index_path)
+        start = time.time()
+        last_offset = -1
+        with bz2.open(self.index_path, 'rb') as f:
+            for line in f:
+                offset = int(line[:line.index(b':')])
+                if offset != last_offset:
+                    self.block_offsets.append(offset)
+                    self.block_first_page.append(self.size)
+                    last_offset = offset
+                self.size += 1
+        self.logger.info("%d pages in %d streams", self.size, len(self.block_offsets))
+        print(f'{self.size} pages in {len(self.block_offsets)} streams, took {round(time.time()-start, 1)} seconds')
+
+    def iter_titles(self):
+        "Yield (page_num, page_id, title) for every page listed in the index"
+        with bz2.open(self.index_path, 'rb') as f:
+            for page_num, line in enumerate(f):
+                _, page_id, title = line.rstrip(b'\n').split(b':', 2)
+                yield page_num, int(page_id), title.decode('utf-8')
+
+    def _read_block(self, block):
+        "Decompress a stream and return (data, page spans) for it"
+        try:
+            cached = self._cache.pop(block)
+            self._cache[block] = cached
+            self.hits += 1
+            return cached
+        except KeyError:
+            self.misses += 1
+
+        start = self.block_offsets[block]
+        if block + 1 < len(self.block_offsets):
+            end = self.block_offsets[block + 1]
+        else:
+            end = self.file_size
+        self.xml_file.seek(start)
+        data = bz2.decompress(self.xml_file.read(end - start))
+
+        # the first stream also holds <siteinfo>, the last one </mediawiki>
+        spans = []
+        idx = data.find(b'<page>')
+        while idx != -1:
+            end_idx = data.index(b'</page>', idx) + len(b'</page>')
+            spans.append((idx, end_idx))
+            idx = data.find(b'<page>', end_idx)
+
+        self._cache[block] = (data, spans)
+        if len(self._cache) > self.cache_blocks:
+            self._cache.popitem(last=False)
+        return data, spans
+
+    def get_raw_bytes(self, page_num):
+        "Get raw xml bytes for the page_num'th page (0-based) of the dump"
+        if page_num < 0 or page_num >= self.size:
+            raise IndexError(f"page {page_num} is not in the dump")
+        block = bisect_right(self.block_first_page, page_num) - 1
+        data, spans = self._read_block(block)
+        start, end = spans[page_num - self.block_first_page[block]]
+        return data[start:end]
+
+    def get_raw(self, page_num):
+        "Get raw xml dump data for the page_num'th page (0-based) of the dump"
+        return self.get_raw_bytes(page_num).decode('utf-8')
+
+    def close(self):
+        self.xml_file.close()
+        self._cache.clear()
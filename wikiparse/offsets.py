@@ -0,0 +1,103 @@
+"""
+Fixed-width binary table of page offsets, stored next to index.db.
+
+Record n holds the (start_idx, end_idx) byte offsets of page n as two native
+int64s, so 21M pages take 336 MB. The file is memory-mapped, so opening it
+costs nothing and a lookup is a single array access. Pages that aren't in the
+table are stored as (-1, -1); an end_idx of -1 means "up to the end of the dump".
+"""
+from array import array
+import mmap
+import os
+
+OFFSETS_FILENAME = 'offsets.bin'
+RECORD_SIZE = 2 * array('q').itemsize
+
+MISSING = -1
+
+class OffsetTableWriter:
+    "Writes page offsets in page order, starting from start_page"
+    def __init__(self, path, start_page=0, buffer_pages=1_000_000):
+        self.path = path
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        self.f = open(path, mode)
+        self.f.truncate(start_page * RECORD_SIZE)
+        self.f.seek(start_page * RECORD_SIZE)
+        self.next_page = start_page
+        self.buffer_pages = buffer_pages
+        self._buffer = array('q')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, page_num, start_idx, end_idx):
+        if page_num < self.next_page:
+            raise ValueError(f"page {page_num} written out of order, expected {self.next_page}")
+        while self.next_page < page_num:
+            self._buffer.extend((MISSING, MISSING))
+            self.next_page += 1
+        self._buffer.extend((start_idx, end_idx))
+        self.next_page += 1
+        if len(self._buffer) >= 2 * self.buffer_pages:
+            self.flush()
+
+    def extend(self, offsets):
+        "Append an array of flattened (start_idx, end_idx) pairs for the next pages"
+        self.flush()
+        offsets.tofile(self.f)
+        self.next_page += len(offsets) // 2
+
+    def flush(self):
+        self._buffer.tofile(self.f)
+        self._buffer = array('q')
+        self.f.flush()
+
+    def sync(self):
+        "Flush and wait until the offsets are on disk"
+        self.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+class OffsetTable:
+    "Read-only, memory-mapped view of an offsets file"
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'rb')
+        if os.path.getsize(path) > 0:
+            self._mmap = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._offsets = memoryview(self._mmap).cast('q')
+        else:
+            self._mmap = None
+            self._offsets = array('q')
+
+    @classmethod
+    def open(cls, folder):
+        "Open the table in a scratch folder, or return None if there isn't one"
+        path = os.path.join(folder, OFFSETS_FILENAME)
+        if os.path.exists(path):
+            return cls(path)
+        return None
+
+    def __len__(self):
+        return len(self._offsets) // 2
+
+    def get(self, page_num):
+        "(start_idx, end_idx) of a page; KeyError if the page isn't in the table"
+        if page_num < 0 or page_num >= len(self):
+            raise KeyError(page_num)
+        start_idx = self._offsets[2 * page_num]
+        if start_idx == MISSING:
+            raise KeyError(page_num)
+        return start_idx, self._offsets[2 * page_num + 1]
+
+    def close(self):
+        if self._mmap is not None:
+            self._offsets.release()
+            self._mmap.close()
+        self._f.close()
@@ -0,0 +1,99 @@
+"""
+Batched page lookups and an LRU cache of parsed pages.
+"""
+from collections import OrderedDict
+import logging
+
+# default byte budget of a PageCache
+CACHE_BYTES = 64 * 1024 * 1024
+
+# titles per SELECT ... IN query, well under SQLite's limit on bound parameters
+LOOKUP_CHUNK = 500
+
+class PageCache:
+    """
+    Least-recently-used cache of Page objects keyed by page number. Its size
+    is measured in bytes of raw xml, so a cache full of long articles holds
+    fewer pages than one full of stubs.
+    """
+    logger = logging.getLogger('wikidump.model.PageCache')
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()
+
+    def __len__(self):
+        return len(self._pages)
+
+    def get(self, page_num):
+        "The cached page, or None"
+        try:
+            page, size = self._pages[page_num]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._pages.move_to_end(page_num)
+        self.hits += 1
+        return page
+
+    def put(self, page_num, page, size):
+        if size > self.max_bytes:
+            return
+        if page_num in self._pages:
+            self.bytes -= self._pages.pop(page_num)[1]
+        self._pages[page_num] = (page, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            evicted, (_, evicted_size) = self._pages.popitem(last=False)
+            self.bytes -= evicted_size
+
+    def clear(self):
+        "Drop every page, for when page numbers no longer mean the same thing"
+        self._pages.clear()
+        self.bytes = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def __str__(self):
+        return (f'{len(self)} pages, {round(self.bytes / 1024 / 1024, 1)} MB; '
+                f'{self.hits} hits, {self.misses} misses ({round(100 * self.hit_rate(), 1)}% hit rate)')
+
+def fetch_pages(cache, page_nums, read_raw, make_page):
+    """
+    Pages for page_nums, in the same order. Pages missing from the cache are
+    read with read_raw in page number order, which is also their order in the
+    dump, parsed with make_page and cached.
+    """
+    pages = {}
+    missing = set()
+    for page_num in page_nums:
+        if page_num in pages or page_num in missing:
+            continue
+        page = cache.get(page_num)
+        if page is None:
+            missing.add(page_num)
+        else:
+            pages[page_num] = page
+    for page_num in sorted(missing):
+        raw = read_raw(page_num)
+        page = make_page(raw)
+        cache.put(page_num, page, len(raw))
+        pages[page_num] = page
+    return [pages[page_num] for page_num in page_nums]
+
+def lookup_page_nums(db, titles, table='titles'):
+    "{title: page_num} for the titles found in a titles table, with one query per chunk"
+    found = {}
+    titles = list(dict.fromkeys(titles))
+    for i in range(0, len(titles), LOOKUP_CHUNK):
+        chunk = titles[i:i+LOOKUP_CHUNK]
+        rows = db.execute(
+            f'SELECT title, page_num FROM {table} WHERE title IN ({",".join("?" for t in chunk)})', chunk)
+        for title, page_num in rows:
+            found.setdefault(title, page_num)
+    return found
@@ -0,0 +1,304 @@
+"""
+Staged pipelines with bounded queues between the stages.
+
+    with Pipeline(page_numbers, [
+        Step('read', indexer.get_pages_by_num, batch_size=100),
+        Step('tokenize', count_tokens, workers=4),
+    ]) as pipeline:
+        for pages, counts in pipeline:
+            ...
+
+Every queue holds at most queue_size items (a batch counts as one), so a slow
+step makes the steps before it wait instead of letting items pile up in
+memory. Thread steps suit I/O and code that releases the GIL; process steps
+run fn in a multiprocessing pool, so their items and results are pickled.
+
+A step with batch_size gets lists of up to that many items; a source can be
+batched before it enters the pipeline with batched(). A step whose fn
+returns None drops the item. With ordered=True results come out in the order
+of the source, otherwise in the order they are done.
+
+If a step raises, every step stops and the exception is raised from the loop
+over the results. Leaving the with block, or calling close(), stops every
+step too.
+"""
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+
+from . import metrics
+
+# items (or batches) waiting between two steps
+QUEUE_SIZE = 64
+
+# how often blocked steps check whether the pipeline was stopped
+_POLL_SECONDS = 0.1
+
+# end of a queue
+_DONE = object()
+
+def batched(items, size):
+    "Lists of up to size consecutive items"
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class Step:
+    "One stage of a Pipeline: fn applied to each item, or each batch, by workers threads or processes"
+    def __init__(self, name, fn, workers=1, kind='thread', batch_size=None, initializer=None, initargs=()):
+        if kind not in ('thread', 'process'):
+            raise ValueError(f"kind must be 'thread' or 'process', not {kind!r}")
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.kind = kind
+        self.batch_size = batch_size
+        self.initializer = initializer
+        self.initargs = initargs
+
+    def consumers(self):
+        "Threads reading the step's input queue"
+        if self.batch_size or self.kind == 'process':
+            return 1
+        return self.workers
+
+class _Emitter:
+    "Puts a step's results on its output queue, in input order if ordered"
+    def __init__(self, pipeline, out, ordered):
+        self.pipeline = pipeline
+        self.out = out
+        self.ordered = ordered
+        self.next_in = 0
+        self.next_out = 0
+        self.cond = threading.Condition()
+
+    def emit(self, seq, result):
+        with self.cond:
+            if self.ordered:
+                while self.next_in != seq:
+                    if self.pipeline._stopped.is_set():
+                        return
+                    self.cond.wait(_POLL_SECONDS)
+                self.next_in += 1
+            if result is not None:
+                self.pipeline._put(self.out, (self.next_out, result))
+                self.next_out += 1
+            self.cond.notify_all()
+
+class Pipeline:
+    logger = logging.getLogger('wikidump.model.Pipeline')
+
+    def __init__(self, source, steps, queue_size=QUEUE_SIZE, ordered=False, progress=metrics.NULL_STAGE):
+        self.source = source
+        self.steps = steps
+        self.queue_size = queue_size
+        self.ordered = ordered
+        self.progress = progress
+        self.error = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pools = []
+        self._queues = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __iter__(self):
+        return self.run()
+
+    def run(self):
+        "Start every step and yield the results of the last one"
+        # queue k is the input of step k; the last queue holds the results
+        self._queues = [queue.Queue(self.queue_size) for _ in range(len(self.steps) + 1)]
+        consumers = [step.consumers() for step in self.steps] + [1]
+        out = self._queues[-1]
+        try:
+            # a pool forks its workers, which is only safe before any of the
+            # pipeline's threads are running
+            pools = {}
+            for k, step in enumerate(self.steps):
+                if step.kind == 'process':
+                    pools[k] = multiprocessing.Pool(step.workers, step.initializer, step.initargs)
+                    self._pools.append(pools[k])
+            self._start(self._feed, consumers[0])
+            for k, step in enumerate(self.steps):
+                self._start_step(k, step, consumers[k+1], pools.get(k))
+            results = 0
+            while True:
+                item = self._get(out)
+                if item is _DONE:
+                    break
+                results += 1
+                if results % 100 == 0:
+                    self._report_queues()
+                yield item[1]
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.close()
+
+    def close(self):
+        "Stop every step and wait for them"
+        self._stopped.set()
+        for pool in self._pools:
+            pool.terminate()
+            pool.join()
+        for thread in self._threads:
+            thread.join()
+        self._pools = []
+        self._threads = []
+
+    def _report_queues(self):
+        for step, q in zip(self.steps, self._queues):
+            self.progress.gauge(f'{step.name}_queue', q.qsize())
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _fail(self, step_name, e):
+        with self._lock:
+            if self.error is None:
+                self.logger.error("pipeline step %s failed: %r", step_name, e)
+                self.error = e
+        self._stopped.set()
+
+    def _get(self, q):
+        "Next item of a queue, or _DONE once the queue has ended or the pipeline was stopped"
+        while True:
+            try:
+                return q.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                if self._stopped.is_set():
+                    return _DONE
+
+    def _put(self, q, item):
+        "Put an item on a queue, waiting for room; False if the pipeline was stopped"
+        while True:
+            try:
+                q.put(item, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                if self._stopped.is_set():
+                    return False
+
+    def _end(self, q, consumers):
+        for _ in range(consumers):
+            if not self._put(q, _DONE):
+                return
+
+    def _feed(self, consumers):
+        q = self._queues[0]
+        try:
+            for seq, item in enumerate(self.source):
+                if not self._put(q, (seq, item)):
+                    return
+        except BaseException as e:
+            self._fail('source', e)
+            return
+        self._end(q, consumers)
+
+    def _start_step(self, k, step, out_consumers, pool=None):
+        source = self._queues[k]
+        if step.batch_size:
+            batches = queue.Queue(self.queue_size)
+            self._start(self._batch, step, source, batches)
+            source = batches
+        emitter = _Emitter(self, self._queues[k+1], self.ordered)
+        done = [step.workers if step.kind == 'thread' else 1]
+
+        def finished():
+            with self._lock:
+                done[0] -= 1
+                last = done[0] == 0
+            if last:
+                self._end(self._queues[k+1], out_consumers)
+
+        if step.kind == 'process':
+            self._start(self._drive_pool, step, pool, source, emitter, finished)
+        else:
+            for _ in range(step.workers):
+                self._start(self._work, step, source, emitter, finished)
+
+    def _batch(self, step, source, batches):
+        consumers = step.workers if step.kind == 'thread' else 1
+        batch = []
+        seq = 0
+        while True:
+            item = self._get(source)
+            if item is _DONE:
+                break
+            batch.append(item[1])
+            if len(batch) >= step.batch_size:
+                if not self._put(batches, (seq, batch)):
+                    return
+                seq += 1
+                batch = []
+        if batch and not self._stopped.is_set():
+            if not self._put(batches, (seq, batch)):
+                return
+        self._end(batches, consumers)
+
+    def _work(self, step, source, emitter, finished):
+        while True:
+            item = self._get(source)
+            if item is _DONE:
+                break
+            seq, value = item
+            start = time.perf_counter()
+            try:
+                result = step.fn(value)
+            except BaseException as e:
+                self._fail(step.name, e)
+                break
+            self.progress.record(step.name, time.perf_counter() - start)
+            emitter.emit(seq, result)
+        finished()
+
+    def _drive_pool(self, step, pool, source, emitter, finished):
+        # the pool's task thread reads items as fast as it can, so the number
+        # of items handed to the pool and not yet back is bounded here
+        in_flight = threading.Semaphore(self.queue_size)
+
+        def items():
+            while True:
+                item = self._get(source)
+                if item is _DONE:
+                    return
+                while not in_flight.acquire(timeout=_POLL_SECONDS):
+                    if self._stopped.is_set():
+                        return
+                yield item[1]
+
+        try:
+            imap = pool.imap if self.ordered else pool.imap_unordered
+            results = imap(step.fn, items())
+            seq = 0
+            while True:
+                try:
+                    result = results.next(timeout=_POLL_SECONDS)
+                except multiprocessing.TimeoutError:
+                    if self._stopped.is_set():
+                        break
+                    continue
+                except StopIteration:
+                    pool.close()
+                    break
+                in_flight.release()
+                emitter.emit(seq, result)
+                seq += 1
+        except BaseException as e:
+            self._fail(step.name, e)
+        finished()
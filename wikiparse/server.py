@@ -0,0 +1,288 @@
+"""
+Local HTTP service over an existing scratch folder, for the map front-end
+and labeling tools.
+
+    python -m wikiparse.server wiki.xml ./py3 --port 8080
+
+    GET /page/<page_num>                page as JSON: page_num, title, text
+    GET /page?title=<title>
+    GET /coords/<page_num>              the page's row of the coords table
+    GET /bbox?south=&west=&north=&east=[&limit=]
+    GET /near?lat=&lon=&radius_km=[&limit=]
+
+SQLite lookups run on a pool of read-only connections and page reads and
+parsing run in a thread pool, so the event loop only moves bytes. Responses
+are streamed with chunked transfer encoding.
+"""
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import sqlite3
+import threading
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from . import spatial
+from .geo_indexer import PageReader, extract_text, extract_title
+
+# size of the chunks a page is streamed in
+CHUNK_BYTES = 64 * 1024
+# rows per chunk of a bbox / near response
+ROWS_PER_CHUNK = 1000
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+          500: 'Internal Server Error'}
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class ConnectionPool:
+    "Read-only SQLite connections handed out to one executor thread at a time"
+    def __init__(self, path, size):
+        path = os.path.abspath(path)
+        self._idle = asyncio.Queue()
+        for _ in range(size):
+            db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+            self._idle.put_nowait(db)
+
+    async def run(self, executor, fn, *args):
+        "Call fn(db, *args) in the executor with a connection from the pool"
+        db = await self._idle.get()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, fn, db, *args)
+        finally:
+            self._idle.put_nowait(db)
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+
+class Response:
+    "A response being written to the client, chunked on HTTP/1.1"
+    def __init__(self, writer, keep_alive, chunked):
+        self.writer = writer
+        self.keep_alive = keep_alive
+        self.chunked = chunked
+
+    def start(self, status=200, content_type='application/json'):
+        headers = [f'HTTP/1.1 {status} {STATUS[status]}', f'Content-Type: {content_type}']
+        if self.chunked:
+            headers.append('Transfer-Encoding: chunked')
+        headers.append('Connection: ' + ('keep-alive' if self.keep_alive else 'close'))
+        self.writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1'))
+
+    async def send(self, data):
+        if not data:
+            return
+        if self.chunked:
+            self.writer.write(b'%x\r\n' % len(data) + data + b'\r\n')
+        else:
+            self.writer.write(data)
+        await self.writer.drain()
+
+    async def end(self):
+        if self.chunked:
+            self.writer.write(b'0\r\n\r\n')
+        await self.writer.drain()
+
+def _page_json(reader, lock, page_num):
+    "A page as JSON bytes, read and parsed off the event loop"
+    if lock:
+        with lock:
+            raw = bytes(reader.get_raw_bytes(page_num))
+    else:
+        raw = reader.get_raw_bytes(page_num)
+    return json.dumps({
+        'page_num': page_num,
+        'title': extract_title(raw),
+        'text': extract_text(raw),
+    }).encode('utf-8')
+
+def _title_to_page_num(db, title):
+    row = db.execute('SELECT page_num FROM titles WHERE title = ?', (title,)).fetchone()
+    return row and row[0]
+
+def _coords_row(db, page_num):
+    cursor = db.execute('SELECT * FROM coords WHERE page_num = ?', (page_num,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip([column[0] for column in cursor.description], row))
+
+def _bbox(db, south, west, north, east, limit):
+    return spatial.pages_in_bbox(db, south, west, north, east, limit=limit)
+
+def _near(db, lat, lon, radius_km, limit):
+    return spatial.pages_near(db, lat, lon, radius_km, limit)
+
+def _number(query, name, kind=float, default=None):
+    try:
+        return kind(query[name][0])
+    except KeyError:
+        if default is None:
+            raise HTTPError(400, f'missing parameter {name}')
+        return default
+    except ValueError:
+        raise HTTPError(400, f'bad value for {name}')
+
+class PageServer:
+    logger = logging.getLogger('wikidump.model.PageServer')
+
+    def __init__(self, xml_path, scratch_folder='./py3', connections=8, threads=8):
+        self.xml_path = os.path.abspath(xml_path)
+        self.scratch_folder = scratch_folder
+        self.connections = connections
+        self.executor = ThreadPoolExecutor(threads)
+        self.reader = PageReader(self.xml_path, scratch_folder)
+        # block caches and sqlite fallbacks of the reader aren't thread safe
+        self.read_lock = None
+        if self.reader.multistream or self.reader.db is not None:
+            self.read_lock = threading.Lock()
+        self.pool = None
+        self.requests = 0
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        self.pool = ConnectionPool(os.path.join(self.scratch_folder, 'index.db'), self.connections)
+        server = await asyncio.start_server(self._handle, host, port, backlog=1024)
+        print(f'serving {self.xml_path} on http://{host}:{port}')
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    method, target, version = None, '', 'HTTP/1.0'
+                http11 = version == 'HTTP/1.1'
+                keep_alive = http11 and headers.get('connection', '').lower() != 'close'
+                response = Response(writer, keep_alive, chunked=http11)
+                await self._respond(method, target, response)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _respond(self, method, target, response):
+        self.requests += 1
+        try:
+            if method is None:
+                raise HTTPError(400, 'malformed request line')
+            if method != 'GET':
+                raise HTTPError(405, f'{method} not supported')
+            await self._route(target, response)
+        except HTTPError as e:
+            await self._error(response, e.status, str(e))
+        except Exception as e:
+            self.logger.exception("error serving %s", target)
+            await self._error(response, 500, str(e))
+
+    async def _error(self, response, status, message):
+        response.start(status)
+        await response.send(json.dumps({'error': message}).encode('utf-8'))
+        await response.end()
+
+    async def _route(self, target, response):
+        url = urlsplit(target)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        query = parse_qs(url.query)
+        if parts[0] == 'page' and len(parts) == 2:
+            await self._page(response, self._page_num(parts[1]))
+        elif parts == ['page'] and 'title' in query:
+            page_num = await self.pool.run(self.executor, _title_to_page_num, query['title'][0])
+            if page_num is None:
+                raise HTTPError(404, 'no page with that title')
+            await self._page(response, page_num)
+        elif parts[0] == 'coords' and len(parts) == 2:
+            row = await self.pool.run(self.executor, _coords_row, self._page_num(parts[1]))
+            if row is None:
+                raise HTTPError(404, 'no coordinates for that page')
+            response.start()
+            await response.send(json.dumps(row).encode('utf-8'))
+            await response.end()
+        elif parts == ['bbox']:
+            limit = _number(query, 'limit', int, 10_000)
+            if limit < 0:
+                raise HTTPError(400, 'bad value for limit')
+            rows = await self.pool.run(self.executor, _bbox, _number(query, 'south'), _number(query, 'west'),
+                                       _number(query, 'north'), _number(query, 'east'), limit)
+            await self._rows(response, ['page_num', 'lat', 'lon'], rows)
+        elif parts == ['near']:
+            rows = await self.pool.run(self.executor, _near, _number(query, 'lat'), _number(query, 'lon'),
+                                       _number(query, 'radius_km'), _number(query, 'limit', int, 10))
+            await self._rows(response, ['page_num', 'lat', 'lon', 'distance_km'], rows)
+        else:
+            raise HTTPError(404, f'unknown path {url.path}')
+
+    def _page_num(self, value):
+        try:
+            return int(value)
+        except ValueError:
+            raise HTTPError(400, f'bad page number {value}')
+
+    async def _page(self, response, page_num):
+        loop = asyncio.get_running_loop()
+        try:
+            body = await loop.run_in_executor(self.executor, _page_json, self.reader, self.read_lock, page_num)
+        except (KeyError, TypeError, IndexError):
+            raise HTTPError(404, f'no page {page_num}')
+        response.start()
+        for i in range(0, len(body), CHUNK_BYTES):
+            await response.send(body[i:i+CHUNK_BYTES])
+        await response.end()
+
+    async def _rows(self, response, columns, rows):
+        "Stream rows as a JSON list of objects"
+        response.start()
+        await response.send(b'[')
+        for i in range(0, len(rows), ROWS_PER_CHUNK):
+            chunk = ','.join(json.dumps(dict(zip(columns, row))) for row in rows[i:i+ROWS_PER_CHUNK])
+            await response.send((',' if i else '').encode() + chunk.encode('utf-8'))
+        await response.send(b']')
+        await response.end()
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+        self.executor.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve pages and coordinates from a scratch folder")
+    parser.add_argument('xml_path')
+    parser.add_argument('scratch_folder', nargs='?', default='./py3')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--connections', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+    server = PageServer(args.xml_path, args.scratch_folder, args.connections, args.threads)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Spatial index over the coords table, for bounding box and radius queries.
+
+The index is an SQLite R*Tree virtual table holding one point-sized box per
+page. SQLite builds without the rtree module fall back to a plain index on
+(lat, lon), which answers the same queries with a range scan on lat.
+"""
+import logging
+import math
+import sqlite3
+
+RTREE_TABLE = 'coords_rtree'
+LAT_LON_INDEX = 'coords_lat_lon'
+
+# mean radius of the earth, in km
+EARTH_RADIUS = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+logger = logging.getLogger('wikidump.model.spatial')
+
+def create_spatial_index(db, table='coords'):
+    """
+    (Re)build the spatial index from the lat / lon columns of a coords table.
+    Rows at exactly (0, 0) are left out: that's what a failed parse stores.
+    Returns True if an R*Tree was built, False for the fallback index.
+    """
+    db.execute(f'DROP TABLE IF EXISTS {RTREE_TABLE}')
+    db.execute(f'DROP INDEX IF EXISTS {LAT_LON_INDEX}')
+    try:
+        db.execute(f'CREATE VIRTUAL TABLE {RTREE_TABLE} USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+    except sqlite3.OperationalError:
+        logger.warning("no rtree module in this SQLite, indexing %s on (lat, lon)", table)
+        with db:
+            db.execute(f'CREATE INDEX {LAT_LON_INDEX} ON {table} (lat, lon)')
+        return False
+    with db:
+        db.execute(f'''INSERT INTO {RTREE_TABLE}
+                SELECT page_num, lat, lat, lon, lon FROM {table}
+                WHERE lat BETWEEN -90 AND 90 AND lon BETWEEN -180 AND 180
+                AND NOT (lat = 0 AND lon = 0)''')
+    return True
+
+def has_rtree(db):
+    return db.execute("SELECT Count(*) FROM sqlite_master WHERE name=?", (RTREE_TABLE,)).fetchone()[0] > 0
+
+def _box_query(db, south, west, north, east, table, limit=None):
+    "(page_num, lat, lon) of the pages, at most limit, in a box that doesn't cross the antimeridian"
+    # SQLite reads a negative LIMIT as no limit
+    limit = -1 if limit is None else limit
+    if has_rtree(db):
+        # the R*Tree stores 32-bit floats, so its boxes are only a first cut
+        return db.execute(f'''SELECT c.page_num, c.lat, c.lon FROM {RTREE_TABLE} r
+                JOIN {table} c ON c.page_num = r.id
+                WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?
+                AND c.lat BETWEEN ? AND ? AND c.lon BETWEEN ? AND ? LIMIT ?''',
+                (south, north, west, east, south, north, west, east, limit)).fetchall()
+    return db.execute(f'''SELECT page_num, lat, lon FROM {table}
+            WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?
+            AND NOT (lat = 0 AND lon = 0) LIMIT ?''', (south, north, west, east, limit)).fetchall()
+
+def pages_in_bbox(db, south, west, north, east, table='coords', limit=None):
+    """
+    (page_num, lat, lon) of the pages inside a bounding box, at most limit
+    of them if it is given. A box with west > east wraps around the antimeridian.
+    """
+    if west <= east:
+        return _box_query(db, south, west, north, east, table, limit)
+    hits = _box_query(db, south, west, north, 180, table, limit)
+    if limit is not None:
+        limit -= len(hits)
+        if limit <= 0:
+            return hits
+    return hits + _box_query(db, south, -180, north, east, table, limit)
+
+def haversine(lat1, lon1, lat2, lon2):
+    "Great-circle distance in km"
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+def pages_near(db, lat, lon, radius_km, limit=10, table='coords'):
+    """
+    (page_num, lat, lon, distance_km) of the closest pages within radius_km,
+    nearest first. Candidates come from the bounding box of the circle.
+    """
+    dlat = radius_km / KM_PER_DEGREE
+    south, north = lat - dlat, lat + dlat
+    if south <= -90 or north >= 90:
+        # the circle covers a pole, so every longitude is in range
+        south, north = max(south, -90), min(north, 90)
+        west, east = -180, 180
+    else:
+        # widest longitude span of the circle, which is reached north or south of lat
+        ratio = math.sin(math.radians(dlat)) / math.cos(math.radians(lat))
+        dlon = math.degrees(math.asin(ratio)) if ratio < 1 else 180
+        if dlon >= 180:
+            west, east = -180, 180
+        else:
+            west = (lon - dlon + 180) % 360 - 180
+            east = (lon + dlon + 180) % 360 - 180
+    hits = []
+    for page_num, page_lat, page_lon in pages_in_bbox(db, south, west, north, east, table):
+        distance = haversine(lat, lon, page_lat, page_lon)
+        if distance <= radius_km:
+            hits.append((page_num, page_lat, page_lon, distance))
+    hits.sort(key=lambda hit: hit[3])
+    return hits[:limit]
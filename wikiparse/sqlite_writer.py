@@ -0,0 +1,108 @@
+"""
+Batched writes for the SQLite tables built from a dump.
+"""
+from collections import defaultdict
+import logging
+import time
+
+from . import metrics
+
+# Settings for filling a fresh index. With WAL, synchronous=NORMAL only syncs
+# when the log is checkpointed into the database: a crash can lose the last
+# commits but can't corrupt the file, and Indexer.load syncs at its checkpoints.
+BULK_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-262144',
+]
+
+def tune_for_bulk_load(db):
+    "Apply settings that favour large batched inserts over durability"
+    # the journal mode can't change inside an open transaction
+    db.commit()
+    for pragma in BULK_PRAGMAS:
+        db.execute(pragma)
+
+def quote_identifier(name):
+    "A table or column name quoted for SQL, e.g. 'my \"table\"' -> '\"my \"\"table\"\"\"'"
+    return '"' + name.replace('"', '""') + '"'
+
+def insert_sql(table, columns, or_ignore=False):
+    "Parameterized INSERT statement for the given columns"
+    verb = 'INSERT OR IGNORE' if or_ignore else 'INSERT'
+    return f'{verb} INTO {table} ({",".join(columns)}) VALUES ({",".join("?" for c in columns)})'
+
+class BulkWriter:
+    """
+    Buffers rows per statement and writes them with executemany, one
+    transaction per batch. Indexes registered with defer_index are dropped
+    while loading and built once in finish(). The latency of each commit is
+    recorded as the 'commit' timer of the progress stage, if one is given.
+    """
+    logger = logging.getLogger('wikidump.model.BulkWriter')
+
+    def __init__(self, db, batch_size=10_000, tune=True, progress=metrics.NULL_STAGE):
+        self.db = db
+        self.batch_size = batch_size
+        self.progress = progress
+        self._batches = defaultdict(list)
+        self._pending = 0
+        self._indexes = []
+        self.rows_written = 0
+        self.commits = 0
+        self.commit_seconds = 0
+        if tune:
+            tune_for_bulk_load(db)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.flush()
+
+    def insert(self, sql, row):
+        "Queue a row for the given parameterized statement"
+        self._batches[sql].append(row)
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    def insert_dict(self, table, row, or_ignore=False):
+        "Queue a {column: value} row; rows with the same columns are batched together"
+        self.insert(insert_sql(table, list(row.keys()), or_ignore), list(row.values()))
+
+    def flush(self):
+        "Write all queued rows in a single transaction"
+        if not self._pending:
+            return
+        start = time.time()
+        with self.db:
+            for sql, rows in self._batches.items():
+                self.db.executemany(sql, rows)
+        seconds = time.time() - start
+        self.commit_seconds += seconds
+        self.progress.record('commit', seconds)
+        self.commits += 1
+        self.rows_written += self._pending
+        self._batches = defaultdict(list)
+        self._pending = 0
+
+    def defer_index(self, name, table, columns, unique=False):
+        "Drop an index now and build it in finish(), after the rows are in"
+        self.db.execute(f'DROP INDEX IF EXISTS {name}')
+        self._indexes.append((name, table, columns, unique))
+
+    def finish(self):
+        "Flush remaining rows and build the deferred indexes"
+        self.flush()
+        for name, table, columns, unique in self._indexes:
+            self.logger.info("creating index %s", name)
+            kind = 'UNIQUE INDEX' if unique else 'INDEX'
+            with self.db:
+                self.db.execute(f'CREATE {kind} IF NOT EXISTS {name} ON {table} ({",".join(columns)})')
+        self._indexes = []
+        self.db.execute('PRAGMA synchronous=NORMAL')
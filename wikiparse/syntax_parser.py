@@ -1,15 +1,145 @@
+"""
+Templates found in wikitext with a single pass over it.
+
+    for template in scan_templates(text, ['Coord', 'Infobox settlement']):
+        template.name, template.start, template.end, template.params
+
+Nesting is tracked, so a template ends at its own closing braces rather than
+at the first }} of a template inside it, and parameters are split only at
+pipes that belong to the template itself (not those of inner templates or
+[[target|label]] links). Runs of braces are paired the way MediaWiki pairs
+them, so {{{1}}} is a template parameter rather than a template, and neither
+parameters, parser functions ({{#if:...}}, {{lc:...}}) nor magic words
+({{!}}, {{PAGENAME}}) are reported. Names are compared the way MediaWiki does:
+surrounding whitespace and a Template: prefix are ignored, underscores are
+spaces and the first letter is case-insensitive.
+"""
 import re
-import time
 
-def _get_starting_indices(string, tag):
-    return [m.start() for m in re.finditer(tag, string)]
+# the only markup the scanner needs to see
+_token = re.compile(r'\{\{+|\}\}+|\[\[|\]\]|\|')
+
+# variables, which can also take an argument after a colon, as in {{PAGENAME:x}}
+MAGIC_WORDS = {
+    '!', '=', 'CURRENTYEAR', 'CURRENTMONTH', 'CURRENTMONTHNAME', 'CURRENTDAY', 'CURRENTDAYNAME',
+    'CURRENTTIME', 'CURRENTTIMESTAMP', 'LOCALYEAR', 'LOCALMONTH', 'LOCALDAY', 'LOCALTIME',
+    'NUMBEROFARTICLES', 'NUMBEROFPAGES', 'NUMBEROFFILES', 'NUMBEROFUSERS', 'SITENAME', 'SERVER',
+    'SERVERNAME', 'SCRIPTPATH', 'PAGENAME', 'PAGENAMEE', 'FULLPAGENAME', 'FULLPAGENAMEE',
+    'BASEPAGENAME', 'SUBPAGENAME', 'ROOTPAGENAME', 'TALKPAGENAME', 'ARTICLEPAGENAME',
+    'NAMESPACE', 'NAMESPACEE', 'TALKSPACE', 'SUBJECTSPACE', 'PAGEID', 'REVISIONID',
+    'REVISIONDAY', 'REVISIONMONTH', 'REVISIONYEAR', 'REVISIONTIMESTAMP', 'REVISIONUSER',
+    'DISPLAYTITLE', 'DEFAULTSORT', 'DEFAULTSORTKEY', 'PAGESINCATEGORY', 'PAGESIZE',
+}
+# parser functions without a #, matched case-insensitively before the colon
+PARSER_FUNCTIONS = {
+    'lc', 'uc', 'lcfirst', 'ucfirst', 'urlencode', 'anchorencode', 'fullurl', 'localurl',
+    'canonicalurl', 'filepath', 'formatnum', 'padleft', 'padright', 'plural', 'grammar',
+    'gender', 'int', 'ns', 'nse', 'msg', 'msgnw', 'raw', 'subst', 'safesubst', 'tag',
+}
+
+def is_magic(name):
+    "Whether the text before the first pipe of {{...}} names a parser function or magic word, not a template"
+    name = name.strip()
+    if name.startswith('#'):
+        return True
+    prefix, colon, _ = name.partition(':')
+    prefix = prefix.strip()
+    return prefix in MAGIC_WORDS or bool(colon) and prefix.lower() in PARSER_FUNCTIONS
+
+def normalize_name(name):
+    "A template name as MediaWiki resolves it, e.g. ' coord_' -> 'Coord'"
+    name = ' '.join(name.replace('_', ' ').split())
+    if name[:9].lower() == 'template:':
+        name = name[9:].lstrip()
+    return name[:1].upper() + name[1:]
+
+class Template:
+    "One template in a text: its normalized name, its span (braces included) and its raw parameters"
+    __slots__ = ('name', 'start', 'end', 'params')
+
+    def __init__(self, name, start, end, params):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.params = params
+
+    def __repr__(self):
+        return f'Template({self.name!r}, {self.start}, {self.end}, {self.params!r})'
+
+    def wikitext(self):
+        "The template without its braces and with its normalized name, e.g. 'Coord|51|30|N|0|7|W'"
+        return '|'.join([self.name] + self.params)
+
+    def arguments(self):
+        "Positional parameters and {name: value} of the named ones, named ones stripped of whitespace"
+        positional = []
+        named = {}
+        for param in self.params:
+            key, eq, value = param.partition('=')
+            if eq:
+                named[key.strip()] = value.strip()
+            else:
+                positional.append(param)
+        return positional, named
+
+def scan_templates(text, names=None):
+    """
+    Every template in text named in names (or every template, if names is
+    None), in order of where they start. Templates left unclosed at the end
+    of the text are not returned.
+    """
+    wanted = None if names is None else {normalize_name(name) for name in names}
+    found = []
+    # [start, brace count, pipe positions] of each open run of braces, None for an open link
+    stack = []
+    for match in _token.finditer(text):
+        token = match.group()
+        if token == '|':
+            if stack and stack[-1] is not None:
+                stack[-1][2].append(match.start())
+        elif token[0] == '{':
+            stack.append([match.start(), len(token), []])
+        elif token == '[[':
+            stack.append(None)
+        elif token == ']]':
+            if stack and stack[-1] is None:
+                stack.pop()
+        else:
+            # closing braces pair with the innermost open ones, three at a
+            # time (a parameter) if both runs have that many, else two
+            end = match.start()
+            closing = len(token)
+            while closing >= 2:
+                # a link left open inside the template ends with it
+                while stack and stack[-1] is None:
+                    stack.pop()
+                if not stack:
+                    break
+                opened = stack[-1]
+                pair = 3 if min(closing, opened[1]) >= 3 else 2
+                opened[1] -= pair
+                closing -= pair
+                end += pair
+                start = opened[0] + opened[1]
+                pipes = opened[2]
+                if opened[1] >= 2:
+                    opened[2] = []
+                else:
+                    stack.pop()
+                if pair == 3:
+                    continue
+                raw_name = text[start+2:pipes[0] if pipes else end-2]
+                if is_magic(raw_name):
+                    continue
+                name = normalize_name(raw_name)
+                if wanted is None or name in wanted:
+                    bounds = pipes + [end - 2]
+                    params = [text[a+1:b] for a, b in zip(bounds, bounds[1:])]
+                    found.append(Template(name, start, end, params))
+    # inner templates close, and so are found, before the ones around them
+    found.sort(key=lambda template: template.start)
+    return found
 
 def get_tags(string, tag):
-    tags = []
-    if tag[-1] != '\|':
-        tag = tag+'\|'
-    starting_indices = _get_starting_indices(string, tag)
-    for idx in starting_indices:
-        ending_idx = string[idx:].find('}}')
-        tags.append(string[idx:idx+ending_idx])
-    return tags
+    "Each tag template in string as 'Tag|param|...', nested templates included"
+    return [template.wikitext() for template in scan_templates(string, [tag])]
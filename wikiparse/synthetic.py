@@ -0,0 +1,174 @@
+"""
+Synthetic MediaWiki XML dumps for benchmarks and tests.
+
+Pages look like those of pages-articles dumps: escaped wikitext with
+infoboxes holding nested templates, Coord templates in their usual shapes,
+<ref> tags with citation templates, tables, categories, interlanguage links
+and redirects, plus a revision sha1 for every page.
+
+    python -m wikiparse.synthetic wiki_synthetic.xml 10000
+"""
+import bz2
+import hashlib
+from html import escape, unescape
+import random
+import re
+import sys
+
+HEADER = '''<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10" xml:lang="en">
+  <siteinfo>
+    <sitename>Wikipedia</sitename>
+    <dbname>enwiki</dbname>
+    <base>https://en.wikipedia.org/wiki/Main_Page</base>
+    <generator>wikiparse.synthetic</generator>
+    <case>first-letter</case>
+  </siteinfo>
+'''
+FOOTER = '</mediawiki>\n'
+
+_WORDS = ('the of and in to was is for on as by with he at from that his it an were are which this be '
+          'town river city village district population church school station railway county north south '
+          'east west century built located area region mountain lake island border valley bridge road '
+          'census market parish harbour castle museum university municipality province coast').split()
+_CATEGORIES = ['Populated places', 'Towns', 'Villages', 'Rivers', 'Mountains', 'Railway stations',
+               'Buildings and structures', 'Landforms', 'Coastal towns', 'Historic sites']
+_LANGUAGES = ['de', 'fr', 'es', 'it', 'nl', 'pl', 'ja', 'ru', 'pt', 'sv']
+
+def _sentence(rng, titles):
+    words = [rng.choice(_WORDS) for _ in range(rng.randint(6, 20))]
+    if titles and rng.random() < 0.6:
+        target = rng.choice(titles)
+        words.insert(rng.randrange(len(words)), f'[[{target}|{target.lower()}]]')
+    if rng.random() < 0.2:
+        words.insert(rng.randrange(len(words)), f"'''{rng.choice(_WORDS)}'''")
+    text = ' '.join(words)
+    text = text[0].upper() + text[1:] + '.'
+    if rng.random() < 0.3:
+        text += (f'<ref>{{{{cite web|url=http://example.org/{rng.randrange(10**6)}'
+                 f'|title={rng.choice(_WORDS).capitalize()} {rng.choice(_WORDS)}|accessdate=2020-01-01}}}}</ref>')
+    return text
+
+def _dms(rng, value, positive, negative):
+    direction = positive if value >= 0 else negative
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = round(((value - degrees) * 60 - minutes) * 60)
+    return f'{degrees}|{minutes}|{seconds}|{direction}'
+
+def coord_template(rng, display='inline,title'):
+    "A Coord template in one of the shapes common in enwiki"
+    lat = rng.uniform(-70, 75)
+    lon = rng.uniform(-180, 180)
+    shape = rng.random()
+    if shape < 0.5:
+        position = f'{_dms(rng, lat, "N", "S")}|{_dms(rng, lon, "E", "W")}'
+    elif shape < 0.8:
+        position = f'{round(lat, 4)}|{round(lon, 4)}'
+    else:
+        position = f'{abs(round(lat, 3))}|{"N" if lat >= 0 else "S"}|{abs(round(lon, 3))}|{"E" if lon >= 0 else "W"}'
+    return f'{{{{Coord|{position}|region:{rng.choice(["GB", "US-NY", "FR", "DE", "JP"])}_type:city|display={display}}}}}'
+
+def _infobox(rng, title, coord):
+    rows = [f'| name = {title}', f'| population_total = {rng.randint(100, 10**6):,}',
+            f'| established_date = {{{{Start date|{rng.randint(1100, 1990)}}}}}',
+            '| image_map = {{Location map|Europe|width=220|float=center}}']
+    if coord:
+        rows.append(f'| coordinates = {coord}')
+    return '{{Infobox settlement\n' + '\n'.join(rows) + '\n}}'
+
+def article_text(rng, title, titles, coord_fraction=0.3):
+    "Wikitext of an article, with a Coord template in coord_fraction of them"
+    coord = coord_template(rng) if rng.random() < coord_fraction else None
+    parts = []
+    if rng.random() < 0.5:
+        parts.append(_infobox(rng, title, coord))
+        coord = None
+    parts.append(f"'''{title}''' " + ' '.join(_sentence(rng, titles) for _ in range(rng.randint(1, 4))))
+    for _ in range(int(rng.expovariate(1 / 3)) + 1):
+        parts.append(f'== {rng.choice(_WORDS).capitalize()} ==')
+        parts.append(' '.join(_sentence(rng, titles) for _ in range(rng.randint(2, 12))))
+        if rng.random() < 0.15:
+            rows = '\n'.join(f'|-\n| {rng.choice(_WORDS)} || {rng.randint(1, 10**5)}<br />'
+                             for _ in range(rng.randint(3, 30)))
+            parts.append('{| class="wikitable"\n' + rows + '\n|}')
+    if coord:
+        parts.append(coord)
+    parts.append('== See also ==\n* [[' + (rng.choice(titles) if titles else title) + ']]')
+    parts.append('== References ==\n{{Reflist}}')
+    parts.extend(f'[[Category:{category}]]' for category in rng.sample(_CATEGORIES, rng.randint(1, 3)))
+    parts.extend(f'[[{lang}:{title}]]' for lang in rng.sample(_LANGUAGES, rng.randint(0, 4)))
+    return '\n\n'.join(parts)
+
+def page_xml(page_id, title, text, redirect=None):
+    "A <page> element as it appears in a pages-articles dump"
+    sha1 = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    redirect_tag = f'    <redirect title="{escape(redirect)}" />\n' if redirect else ''
+    return (f'  <page>\n    <title>{escape(title, quote=False)}</title>\n    <ns>0</ns>\n'
+            f'    <id>{page_id}</id>\n{redirect_tag}    <revision>\n      <id>{page_id * 10 + 7}</id>\n'
+            f'      <timestamp>2020-01-01T00:00:00Z</timestamp>\n'
+            f'      <contributor>\n        <username>Bot</username>\n        <id>1</id>\n      </contributor>\n'
+            f'      <model>wikitext</model>\n      <format>text/x-wiki</format>\n'
+            f'      <text bytes="{len(text.encode("utf-8"))}" xml:space="preserve">{escape(text, quote=False)}</text>\n'
+            f'      <sha1>{sha1}</sha1>\n    </revision>\n  </page>\n')
+
+def write_dump(path, pages=10_000, seed=0, coord_fraction=0.3, redirect_fraction=0.1):
+    """
+    Write a dump of the given number of pages. Returns the number of pages
+    and how many have a Coord template or are redirects.
+    """
+    rng = random.Random(seed)
+    titles = []
+    stats = {'pages': 0, 'coords': 0, 'redirects': 0}
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(HEADER)
+        for page_id in range(1, pages + 1):
+            if titles and rng.random() < redirect_fraction:
+                target = rng.choice(titles)
+                title = f'{target} ({rng.choice(_WORDS)})'
+                text = f'#REDIRECT [[{target}]]\n\n{{{{R from alternative name}}}}'
+                f.write(page_xml(page_id, title, text, redirect=target))
+                stats['redirects'] += 1
+            else:
+                title = f'{rng.choice(_WORDS).capitalize()} {rng.choice(_WORDS)} {page_id}'
+                text = article_text(rng, title, titles[-200:], coord_fraction)
+                f.write(page_xml(page_id, title, text))
+                titles.append(title)
+                stats['coords'] += 'Coord|' in text
+            stats['pages'] += 1
+        f.write(FOOTER)
+    return stats
+
+_page = re.compile(rb'  <page>.*?</page>\n', re.S)
+_page_id = re.compile(rb'<id>(\d+)</id>')
+_page_title = re.compile(rb'<title>(.*?)</title>')
+
+def write_multistream(xml_path, path, pages_per_stream=100):
+    """
+    Recompress a dump as a pages-articles-multistream dump at path, which
+    ends in .xml.bz2, with its -index.txt.bz2 beside it: the header, every
+    pages_per_stream pages and the footer are bz2 streams of their own
+    """
+    with open(xml_path, 'rb') as f:
+        data = f.read()
+    pages = list(_page.finditer(data))
+    index = []
+    with open(path, 'wb') as out:
+        out.write(bz2.compress(data[:pages[0].start()] if pages else data))
+        for i in range(0, len(pages), pages_per_stream):
+            offset = out.tell()
+            stream = pages[i:i+pages_per_stream]
+            for match in stream:
+                page_id = int(_page_id.search(match.group()).group(1))
+                title = unescape(_page_title.search(match.group()).group(1).decode('utf-8'))
+                index.append(f'{offset}:{page_id}:{title}\n')
+            out.write(bz2.compress(b''.join(match.group() for match in stream)))
+        if pages:
+            out.write(bz2.compress(data[pages[-1].end():]))
+    with bz2.open(path[:-len('.xml.bz2')] + '-index.txt.bz2', 'wt', encoding='utf-8') as f:
+        f.writelines(index)
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else 'wiki_synthetic.xml'
+    pages = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+    print(write_dump(path, pages))
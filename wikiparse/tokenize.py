@@ -1,15 +1,22 @@
-from collections import defaultdict
-from nltk.tokenize import sent_tokenize, word_tokenize
-import os
-from pandas import concat, DataFrame, read_csv
+from array import array
+from collections import Counter, defaultdict
+import numpy as np
+from pandas import concat, DataFrame
 from pathlib import Path
 import pickle
-import queue
 import random
 import re
+from scipy.sparse import csr_matrix
+import sys
 import threading
 import time
 
+from . import metrics
+from .pipeline import Pipeline, Step, batched
+from .columnar import ParquetAppender, TFIDF_FILENAME, TFIDF_SCHEMA, read_tfidf, tfidf_frame
+from .vocabulary import (DOC_FREQ_BYTES, PRUNE_THRESHOLD, VOCABULARY_FILENAME, MappedVocabulary,
+                         SpillingCounter, apply_delta)
+
 class Storage:
     def __init__(self, total=627344, folder="."):
         self.start = time.time()
@@ -48,24 +55,33 @@ class DictStorage(Storage):
             self.count += 1
 
 class DataFrameStorage(Storage):
+    "Collects TF-IDF rows and appends them to a Parquet file, a row group per 10k pages"
     def __init__(self, total=627344, folder="."):
         super().__init__(total, folder)
         self.dfs = []
         self.dfs_count = 0
+        self._unwritten = 0
+        self.path = self.folder/TFIDF_FILENAME
+        self._appender = None
 
-    def update(self, df):
+    def update(self, df, pages=1):
+        "Store the rows for one page, or for a batch of pages"
         with self._lock:
             self.dfs.append(df)
-            self.count += 1
-            if self.count % 10_000 == 0:
+            self.count += pages
+            self._unwritten += pages
+            if self._unwritten >= 10_000:
                 self._write_out()
 
     def _write_out(self):
-        fname = self.folder/f'tfidf_{self.dfs_count}.csv'
-        concat(self.dfs).to_csv(fname)
-        print("wrote to CSV", fname)
-        self.dfs_count += 1
+        if self._appender is None:
+            self._appender = ParquetAppender(self.path, TFIDF_SCHEMA)
+        if self.dfs:
+            self._appender.append(tfidf_frame(concat(self.dfs)))
+            print("wrote row group", self.dfs_count, "to", self.path)
+            self.dfs_count += 1
         self.dfs = []
+        self._unwritten = 0
 
     def done_count(self):
         with self._lock:
@@ -74,71 +90,121 @@ class DataFrameStorage(Storage):
     def finish(self):
         try:
             self._write_out()
+            self._appender.close()
         except Exception as e:
             print(e)
         print("storage finished")
 
-def lookup(word, wikipedia, threshold=10):
-    if word in wikipedia and wikipedia[word] > threshold:
-        return wikipedia[word]
+def lookup(word, wikipedia, threshold=PRUNE_THRESHOLD):
+    count = wikipedia.get(word, 0)
+    if count > threshold:
+        return count
 
     return -1
 
+# markup characters that are dropped from visible text; '|' becomes a space
+_markup = str.maketrans('|', ' ', "[]()'")
+# the only characters that open or close templates and html tags
+_nesting = re.compile(r'[{}<>]')
+
 def remove_metadata(text):
-    stack = []
-    result = ''
-    metachars = set('{}[]()\'<>|')
+    """
+    Strip templates, html tags and markup characters from wikitext.
+    Jumps between {, }, < and > with a compiled regex, keeping the stretches
+    that are outside any template or tag, and cleans those up in one pass.
+    """
+    pieces = []
+    # depth of nested {{ }} templates and < > tags
+    depth = 0
     html_on = False
-    
-    for i in range(len(text)):
-        if not stack and not html_on:
-            if text[i] not in metachars:
-                result += text[i]
-            elif text[i] == '|':
-                result += ' '
-        if text[i:i+2] == '{{':
-            stack.append(i)
-        elif text[i:i+2] == '}}':
-            try:
-                stack.pop()
-            except:
-                pass
-        elif text[i] == '<':
-            stack.append(i)
-            if text[i:i+2] == '</':
-                html_on = False
-            else:
-                html_on = True
-        elif text[i] == '>':
-            if i > 0 and text[i-1:i+1] == '/>':
+    pos = 0
+
+    for match in _nesting.finditer(text):
+        i = match.start()
+        if not depth and not html_on:
+            pieces.append(text[pos:i])
+        c = text[i]
+        if c == '{':
+            if text.startswith('{', i+1):
+                depth += 1
+        elif c == '}':
+            if text.startswith('}', i+1) and depth:
+                depth -= 1
+        elif c == '<':
+            depth += 1
+            html_on = not text.startswith('/', i+1)
+        elif depth or html_on:
+            # c == '>'
+            if text[i-1] == '/':
                 html_on = False
-            try:
-                stack.pop()
-            except:
-                pass
+            if depth:
+                depth -= 1
+        pos = i + 1
+    if not depth and not html_on:
+        pieces.append(text[pos:])
+
+    result = ''.join(pieces).translate(_markup)
     result = result.split('==See also==')[0]
     return result.replace('=', ' ')
 
-def tokenize_page(page):
-    text = page.text
-    text = remove_metadata(page.text)
-    text = text.lower()
-    # make all whitespace a single space character
-    text = re.sub(r'\W',' ',text)
-    text = re.sub(r'\s+',' ',text)
+_word = re.compile(r'\w+')
+
+class RegexTokenizer:
+    """
+    Lowercased runs of word characters, found in one compiled pass. Tokens
+    are interned, so a token repeated across pages is stored once.
+    """
+    name = 'regex'
+
+    def tokenize(self, text):
+        return list(map(sys.intern, _word.findall(text.lower())))
+
+    def ids(self, text, vocab):
+        "Integer ids of the tokens, adding unseen tokens to vocab ({token: id})"
+        return [vocab.setdefault(token, len(vocab)) for token in _word.findall(text.lower())]
 
-    tokens = word_tokenize(text)
-    return tokens
+class NltkTokenizer(RegexTokenizer):
+    """
+    The original tokenizer: non-word characters become spaces and nltk's
+    word_tokenize splits the rest. It differs from RegexTokenizer only on a
+    few contractions like 'cannot', which it splits in two.
+    """
+    name = 'nltk'
+
+    def __init__(self):
+        # nltk is slow to import and only needed here
+        from nltk.tokenize import word_tokenize
+        self._word_tokenize = word_tokenize
+
+    def tokenize(self, text):
+        text = text.lower()
+        # make all whitespace a single space character
+        text = re.sub(r'\W',' ',text)
+        text = re.sub(r'\s+',' ',text)
+        return self._word_tokenize(text)
+
+    def ids(self, text, vocab):
+        return [vocab.setdefault(token, len(vocab)) for token in self.tokenize(text)]
+
+TOKENIZERS = {'regex': RegexTokenizer, 'nltk': NltkTokenizer}
+
+_tokenizer = RegexTokenizer()
+
+def set_tokenizer(tokenizer):
+    "Tokenizer used by tokenize_page from now on: 'regex', 'nltk' or a tokenizer object"
+    global _tokenizer
+    if isinstance(tokenizer, str):
+        tokenizer = TOKENIZERS[tokenizer]()
+    _tokenizer = tokenizer
+
+def get_tokenizer():
+    return _tokenizer
+
+def tokenize_page(page, tokenizer=None):
+    return (tokenizer or _tokenizer).tokenize(remove_metadata(page.text))
 
 def get_token_counts(page):
-    wordfreq = {}
-    tokens = tokenize_page(page)
-    for token in tokens:
-        if token not in wordfreq.keys():
-            wordfreq[token] = 1
-        else:
-            wordfreq[token] += 1
-    return wordfreq
+    return Counter(tokenize_page(page))
 
 def make_tfidf_df(page, wikipedia, top_n=50):
     wordfreq = get_token_counts(page)
@@ -149,67 +215,208 @@ def make_tfidf_df(page, wikipedia, top_n=50):
     df['tf_idf'] = df.tf / df.df
     return df.sort_values(by='tf_idf', ascending=False).iloc[:top_n]
 
-def create_doc_freq(indexer, folder='.'):
+class SparseTfidf:
+    """
+    Vectorized TF-IDF over batches of pages. Tokens get integer ids, each batch
+    becomes a CSR term-count matrix, and the document frequency of every token
+    is looked up once, when it first enters the vocabulary.
+    Produces the same rows as make_tfidf_df.
+    """
+    def __init__(self, wikipedia, top_n=50):
+        self.wikipedia = wikipedia
+        self.top_n = top_n
+        self.vocab = {}
+        self.words = []
+        self._df = array('q')
+
+    def _matrix(self, pages):
+        "CSR term-count matrix with one row per page"
+        indptr = array('q', [0])
+        indices = array('q')
+        data = array('q')
+        for page in pages:
+            for word, count in get_token_counts(page).items():
+                word_id = self.vocab.get(word)
+                if word_id is None:
+                    word_id = self.vocab[word] = len(self.words)
+                    self.words.append(word)
+                    self._df.append(lookup(word, self.wikipedia))
+                indices.append(word_id)
+                data.append(count)
+            indptr.append(len(indices))
+        return csr_matrix((np.frombuffer(data, dtype=np.int64),
+                           np.frombuffer(indices, dtype=np.int64),
+                           np.frombuffer(indptr, dtype=np.int64)),
+                          shape=(len(pages), len(self.words)))
+
+    def transform(self, pages):
+        "Top top_n (word, tf, article, df, tf_idf) rows of every page, as one DataFrame"
+        counts = self._matrix(pages)
+        df = np.frombuffer(self._df, dtype=np.int64)
+        tf = counts.data
+        row_df = df[counts.indices]
+        tf_idf = tf / row_df
+
+        # per page, keep the top_n scores, highest first
+        keep = []
+        articles = []
+        for row, page in enumerate(pages):
+            start, end = counts.indptr[row], counts.indptr[row+1]
+            scores = tf_idf[start:end]
+            if end - start > self.top_n:
+                top = np.argpartition(-scores, self.top_n - 1)[:self.top_n]
+                top = top[np.argsort(-scores[top], kind='stable')]
+            else:
+                top = np.argsort(-scores, kind='stable')
+            keep.append(top + start)
+            articles.extend([page.title] * len(top))
+        keep = np.concatenate(keep) if keep else np.array([], dtype=np.int64)
+
+        words = np.array(self.words, dtype=object)[counts.indices[keep]]
+        return DataFrame({
+            'tf': tf[keep],
+            'article': articles,
+            'df': row_df[keep],
+            'tf_idf': tf_idf[keep],
+        }, index=words)
+
+# page reader of a create_doc_freq worker process
+_worker_reader = None
+
+# pages read at a time by create_doc_freq
+READ_BATCH = 100
+
+def _open_worker_reader(xml_path, scratch_folder, tokenizer='regex'):
+    global _worker_reader
+    # imported here: geo_indexer itself imports this module
+    from .geo_indexer import PageReader
+    _worker_reader = PageReader(xml_path, scratch_folder)
+    set_tokenizer(tokenizer)
+
+def _doc_freq_shard(page_numbers):
+    "Number of pages and their document frequencies over one shard, read by the worker itself"
+    counts = Counter()
+    for page_num in page_numbers:
+        # for this, we only care about whether a term is in a document, not how many times it appears there
+        counts.update(set(tokenize_page(_worker_reader.get_page_by_num(page_num))))
+    return len(page_numbers), counts
+
+def _doc_freq_batch(pages):
+    "Number of pages and their document frequencies over a batch of pages"
+    counts = Counter()
+    for page in pages:
+        # for this, we only care about whether a term is in a document, not how many times it appears there
+        counts.update(set(tokenize_page(page)))
+    return len(pages), counts
+
+def create_doc_freq(indexer, folder='.', processes=None, max_bytes=DOC_FREQ_BYTES, threshold=PRUNE_THRESHOLD,
+                    threads=2, batch_size=READ_BATCH):
+    """
+    Count the number of geo pages each token appears in. Pages are read in
+    file order by one thread and tokenized by threads; with processes set,
+    each worker process reads and tokenizes its own shard of pages instead.
+    Counts are kept within about max_bytes of memory, spilling to disk past
+    that, and the tokens in more than threshold pages are written to
+    doc_freq.vocab in folder. Returns that file as a MappedVocabulary.
+    """
     folder = Path(folder)
-    page_numbers = indexer.get_page_numbers()
-    num_worker_threads = 10
-    storage = DictStorage(total=len(page_numbers))
-
-    def worker():
-        while True:
-            page = q.get()
-            if page is None:
-                break
-            # for this, we only care about whether a term is in a document, not how many times it appears there
-            tokens = set(tokenize_page(page))
-            storage.update(tokens)
-            if random.randint(0, 10000) == 42:
-                print('time left:', round(storage.time_left() / 60 / 60, 2), 'hours\t\t')
-
-            q.task_done()
-    print('creating queue with', num_worker_threads, 'threads')
-    q = queue.Queue()
-    threads = []
-    for i in range(num_worker_threads):
-        t = threading.Thread(target=worker)
-        t.start()
-        threads.append(t)
-    print('done starting threads; queueing')
-    for i in range(len(page_numbers)):
-        page_num = page_numbers[i]
-        q.put(indexer.get_page_by_num(page_num))
-        if i % 100 == 0:
-            print(round(100*(i/len(page_numbers)),3),'% done with queueing', end='\r')
-    print('done queueing pages           ')
-    q.join()
-    print('telling threads to stop')
-    for i in range(num_worker_threads):
-        q.put(None)
-    print('waiting')
-    for t in threads:
-        t.join()
-    return storage.dict
-
-def create_tfidf(indexer, folder='.'):
+    # in file order, so reads move forward through the dump
+    page_numbers = sorted(indexer.get_page_numbers())
+    counter = SpillingCounter(folder, max_bytes)
+    if processes:
+        # contiguous shards of page numbers keep each worker's reads local in the dump
+        num_shards = processes * 8
+        shard_size = max(1, -(-len(page_numbers) // num_shards))
+        source = [page_numbers[i:i+shard_size] for i in range(0, len(page_numbers), shard_size)]
+        steps = [Step('tokenize', _doc_freq_shard, workers=processes, kind='process',
+                      initializer=_open_worker_reader, initargs=(indexer.xml_path, indexer.cache_path, _tokenizer))]
+        print('tokenizing', len(page_numbers), 'pages in', len(source), 'shards with', processes, 'processes')
+    else:
+        source = batched(page_numbers, batch_size)
+        # the indexer's file handle and page cache aren't thread safe, so there is one reader
+        indexer.ensure_offset_table()
+        steps = [Step('read', indexer.get_pages_by_num),
+                 Step('tokenize', _doc_freq_batch, workers=threads)]
+        print('tokenizing', len(page_numbers), 'pages with', threads, 'threads')
+    with metrics.stage('create_doc_freq', total=len(page_numbers)) as progress, \
+            Pipeline(source, steps, queue_size=max(threads, processes or 0) * 2, progress=progress) as pipeline:
+        for pages, counts in pipeline:
+            counter.update_counts(counts, pages)
+            progress.advance(pages)
+            progress.gauge('runs_spilled', len(counter.runs))
+    return counter.finish(folder/VOCABULARY_FILENAME, threshold)
+
+def update_doc_freq(doc_freq, update, indexer):
+    """
+    Patch document frequencies from create_doc_freq after Indexer.update,
+    instead of counting every page again: the old versions of changed and
+    deleted geo pages are subtracted, the new versions of changed and added
+    ones counted. A MappedVocabulary is rewritten and the new one returned;
+    as it only holds tokens above the threshold, a token that crosses it
+    here starts again from the pages counted in this update.
+    """
+    old_reader = update.old_reader()
+    delta = Counter()
+    for page_num in update.removed_geo:
+        delta.subtract(set(tokenize_page(old_reader.get_page_by_num(page_num))))
+    for page_num in update.added_geo:
+        delta.update(set(tokenize_page(indexer.get_page_by_num(page_num))))
+    if isinstance(doc_freq, MappedVocabulary):
+        doc_freq = apply_delta(doc_freq, delta)
+    else:
+        for token, change in delta.items():
+            count = doc_freq.get(token, 0) + change
+            if count > 0:
+                doc_freq[token] = count
+            else:
+                doc_freq.pop(token, None)
+    print('doc freq updated:', len(update.removed_geo), 'pages removed,', len(update.added_geo), 'added')
+    return doc_freq
+
+def create_tfidf(indexer, folder='.', engine='sparse', batch_size=1000):
+    """
+    Top 50 TF-IDF words for every geo page. engine='sparse' scores pages in
+    batches with SparseTfidf; engine='pandas' builds one DataFrame per page.
+    Document frequencies come from the doc_freq.vocab file written by
+    create_doc_freq, or from wikipedia_wordfreq.pkl in older scratch folders.
+    """
     folder = Path(folder)
-    with open(folder/'wikipedia_wordfreq.pkl', 'rb') as f:
-        wikipedia = pickle.load(f)
+    wikipedia = MappedVocabulary.open(folder)
+    if wikipedia is None:
+        with open(folder/'wikipedia_wordfreq.pkl', 'rb') as f:
+            wikipedia = pickle.load(f)
     page_numbers = indexer.get_page_numbers()
     # this makes it more likely that the early time estimates will be accurate
     random.shuffle(page_numbers)
     storage = DataFrameStorage(total=len(page_numbers), folder=folder)
+    progress = metrics.stage('create_tfidf', total=len(page_numbers))
     times = []
     print("computing TF-IDF for", len(page_numbers), "pages")
-    for page_num in page_numbers:
-        page = indexer.get_page_by_num(page_num)
+    if engine == 'sparse':
+        transform = SparseTfidf(wikipedia).transform
+    else:
+        def transform(pages):
+            return concat([make_tfidf_df(page, wikipedia) for page in pages])
+
+    def score(pages):
         start = time.time()
-        df = make_tfidf_df(page, wikipedia)
-        storage.update(df)
+        df = transform(pages)
         times.append(time.time() - start)
-        if random.randint(0, min(10000, storage.count)) == 0:
-            print('time left ~', storage.printable_time_left(), '; done:', storage.done_count())
+        return len(pages), df
+
+    # SparseTfidf grows its vocabulary as it goes, so there is one scoring
+    # thread, reading of the next batches overlaps with it
+    indexer.ensure_offset_table()
+    steps = [Step('read', indexer.get_pages_by_num), Step('score', score)]
+    with Pipeline(batched(page_numbers, batch_size), steps, queue_size=2, progress=progress) as pipeline:
+        for pages, df in pipeline:
+            storage.update(df, pages=pages)
+            progress.advance(pages)
     storage.finish()
-    avg_time = (sum(times) / len(times))
+    progress.finish()
+    if isinstance(wikipedia, MappedVocabulary):
+        wikipedia.close()
+    avg_time = (sum(times) / max(storage.count, 1))
     total_time = avg_time*len(page_numbers)
     if total_time < 60:
         print(round(avg_time, 2), 'ms per, total time:', round(total_time,1), 'seconds')
@@ -217,8 +424,4 @@ def create_tfidf(indexer, folder='.'):
         print(round(avg_time, 2), 'ms per, total time:', round(total_time/60,1), 'minutes')
     else:
         print(round(avg_time, 2), 'ms per, total time:', round(total_time/60/60,2), 'hours')
-    dfs = []
-    for fname in os.listdir(folder):
-        if 'tfidf_' in fname and '.csv' in fname:
-            dfs.append(read_csv(folder/fname))
-    return concat(dfs)
+    return read_tfidf(storage.path)
@@ -0,0 +1,248 @@
+"""
+Document frequencies counted within a memory budget, and stored as a compact
+vocabulary file that is memory-mapped instead of unpickled.
+
+SpillingCounter keeps counts in a dict until its estimated size passes the
+budget, then writes them to disk as a sorted run and starts over. finish()
+k-way merges the runs, drops tokens seen in threshold documents or fewer
+(lookup ignores those anyway) and writes the vocabulary file:
+
+    utf-8 tokens, sorted and concatenated, zero-padded to 8 bytes
+    n + 1 int64 offsets of the tokens in that blob
+    n int64 counts
+    n as an int64, then the 8 byte magic b'WPVOCAB1'
+
+so MappedVocabulary looks a token up with a binary search over the mapped file.
+"""
+from array import array
+import heapq
+from itertools import groupby
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+VOCABULARY_FILENAME = 'doc_freq.vocab'
+MAGIC = b'WPVOCAB1'
+_TRAILER = struct.Struct('q8s')
+
+# default memory budget of a SpillingCounter
+DOC_FREQ_BYTES = 1024 * 1024 * 1024
+
+# rough cost of a dict entry holding a str key and an int count, beyond the key's characters
+ENTRY_BYTES = 120
+
+# runs merged at once; more than this and they are first merged into one run
+MERGE_FAN_IN = 64
+
+# tokens in this many documents or fewer aren't kept, see tokenize.lookup
+PRUNE_THRESHOLD = 10
+
+def _write_run(path, items):
+    with open(path, 'w', encoding='utf-8', newline='\n') as f:
+        f.writelines(f'{token}\t{count}\n' for token, count in items)
+
+def _read_run(path):
+    "(token, count) pairs of a run file, in token order"
+    with open(path, encoding='utf-8', newline='\n') as f:
+        for line in f:
+            token, count = line.rsplit('\t', 1)
+            yield token, int(count)
+
+def write_vocabulary(path, items):
+    "Write (token, count) pairs, sorted by token, as a vocabulary file. Returns the number of tokens"
+    offsets = array('q', [0])
+    counts = array('q')
+    with open(path, 'wb') as f:
+        size = 0
+        for token, count in items:
+            encoded = token.encode('utf-8')
+            f.write(encoded)
+            size += len(encoded)
+            offsets.append(size)
+            counts.append(count)
+        f.write(b'\0' * (-size % 8))
+        offsets.tofile(f)
+        counts.tofile(f)
+        f.write(_TRAILER.pack(len(counts), MAGIC))
+    return len(counts)
+
+def merge_counts(*sorted_items):
+    "Merge iterables of (token, count) sorted by token, summing the counts of equal tokens"
+    for token, group in groupby(heapq.merge(*sorted_items), key=lambda item: item[0]):
+        yield token, sum(count for _, count in group)
+
+class SpillingCounter:
+    """
+    Counts tokens within roughly max_bytes of memory, spilling sorted runs
+    into a temporary folder under folder. Safe to update from several threads.
+    """
+    logger = logging.getLogger('wikidump.model.SpillingCounter')
+
+    def __init__(self, folder='.', max_bytes=DOC_FREQ_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.counts = {}
+        self.bytes = 0
+        self.documents = 0
+        self.runs = []
+        self._run_count = 0
+        self._run_folder = None
+        self._lock = threading.Lock()
+
+    def update(self, tokens):
+        "Count each token of one document once"
+        with self._lock:
+            counts = self.counts
+            for token in tokens:
+                if token in counts:
+                    counts[token] += 1
+                else:
+                    counts[token] = 1
+                    self.bytes += ENTRY_BYTES + len(token)
+            self.documents += 1
+            if self.bytes > self.max_bytes:
+                self._spill()
+
+    def update_counts(self, counter, documents=0):
+        "Add {token: count} counted elsewhere, e.g. by a worker process"
+        with self._lock:
+            counts = self.counts
+            for token, count in counter.items():
+                if token in counts:
+                    counts[token] += count
+                else:
+                    counts[token] = count
+                    self.bytes += ENTRY_BYTES + len(token)
+            self.documents += documents
+            if self.bytes > self.max_bytes:
+                self._spill()
+
+    def _spill(self):
+        if self._run_folder is None:
+            self._run_folder = tempfile.mkdtemp(prefix='doc_freq_runs', dir=self.folder)
+        path = self._run_path()
+        _write_run(path, sorted(self.counts.items()))
+        self.logger.info("spilled %d tokens to %s", len(self.counts), path)
+        self.runs.append(path)
+        self.counts = {}
+        self.bytes = 0
+        if len(self.runs) >= MERGE_FAN_IN:
+            # keeps the number of files open at once in finish() bounded
+            path = self._run_path()
+            _write_run(path, merge_counts(*[_read_run(run) for run in self.runs]))
+            for run in self.runs:
+                os.remove(run)
+            self.runs = [path]
+
+    def _run_path(self):
+        self._run_count += 1
+        return os.path.join(self._run_folder, f'{self._run_count}.run')
+
+    def finish(self, path, threshold=PRUNE_THRESHOLD):
+        """
+        Merge the runs and what is still in memory into a vocabulary file at
+        path, keeping tokens counted more than threshold times, and open it
+        """
+        with self._lock:
+            in_memory = sorted(self.counts.items())
+            self.counts = {}
+            merged = merge_counts(in_memory, *[_read_run(run) for run in self.runs])
+            kept = write_vocabulary(path, ((token, count) for token, count in merged if count > threshold))
+            self.logger.info("%d tokens kept from %d runs", kept, len(self.runs))
+            if self._run_folder is not None:
+                shutil.rmtree(self._run_folder)
+            self.runs = []
+            self._run_folder = None
+        return MappedVocabulary(path)
+
+class MappedVocabulary:
+    "Read-only, memory-mapped {token: document count} over a vocabulary file"
+    def __init__(self, path):
+        self.path = str(path)
+        self._f = open(self.path, 'rb')
+        size = os.path.getsize(self.path)
+        self._mmap = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        n, magic = _TRAILER.unpack_from(self._mmap, size - _TRAILER.size)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{self.path} is not a vocabulary file")
+        counts_start = size - _TRAILER.size - 8 * n
+        offsets_start = counts_start - 8 * (n + 1)
+        view = memoryview(self._mmap)
+        self._offsets = view[offsets_start:counts_start].cast('q')
+        self._counts = view[counts_start:size - _TRAILER.size].cast('q')
+        view.release()
+
+    @classmethod
+    def open(cls, folder):
+        "Open the vocabulary in a scratch folder, or return None if there isn't one"
+        path = os.path.join(folder, VOCABULARY_FILENAME)
+        if os.path.exists(path):
+            return cls(path)
+        return None
+
+    def __len__(self):
+        return len(self._counts)
+
+    def _token(self, i):
+        return self._mmap[self._offsets[i]:self._offsets[i+1]]
+
+    def _find(self, token):
+        "Position of a token, or -1"
+        key = token.encode('utf-8')
+        lo, hi = 0, len(self._counts)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._token(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._counts) and self._token(lo) == key:
+            return lo
+        return -1
+
+    def get(self, token, default=None):
+        i = self._find(token)
+        return default if i < 0 else self._counts[i]
+
+    def __getitem__(self, token):
+        i = self._find(token)
+        if i < 0:
+            raise KeyError(token)
+        return self._counts[i]
+
+    def __contains__(self, token):
+        return self._find(token) >= 0
+
+    def items(self):
+        "(token, count) pairs in token order"
+        for i in range(len(self._counts)):
+            yield self._token(i).decode('utf-8'), self._counts[i]
+
+    def __iter__(self):
+        for token, _ in self.items():
+            yield token
+
+    def close(self):
+        if hasattr(self, '_counts'):
+            self._offsets.release()
+            self._counts.release()
+        self._mmap.close()
+        self._f.close()
+
+def apply_delta(vocabulary, delta, threshold=PRUNE_THRESHOLD):
+    """
+    Rewrite a vocabulary with {token: change in count} added, dropping tokens
+    that end up at threshold or below. The old vocabulary is closed and the
+    new one is returned.
+    """
+    tmp_path = vocabulary.path + '.tmp'
+    merged = merge_counts(vocabulary.items(), sorted(delta.items()))
+    write_vocabulary(tmp_path, ((token, count) for token, count in merged if count > threshold))
+    vocabulary.close()
+    os.replace(tmp_path, vocabulary.path)
+    return MappedVocabulary(vocabulary.path)